@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import ChatMessage
+from .models import ChatMessage, ChatReadState
 
 admin.site.site_header = "My Custom Admin Panel bmmas"
 admin.site.site_title = "Admin Portal bmmas"
@@ -8,10 +8,23 @@ admin.site.index_title = "Welcome to My Admin Panel bmmas"
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
     list_display = ('order', 'short_message', 'sender_type', 'timestamp', 'is_read')
-    list_filter = ('sender_type', 'timestamp', 'is_read')
+    list_filter = ('sender_type', 'timestamp')
     search_fields = ('message', 'sender_type')
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_read_state()
+
+    @admin.display(boolean=True, description='Is read')
+    def is_read(self, obj):
+        return obj.is_read
+
     def short_message(self, obj):
         return (obj.message[:50] + "...") if len(obj.message) > 50 else obj.message
     
     short_message.short_description = "Message"
+
+
+@admin.register(ChatReadState)
+class ChatReadStateAdmin(admin.ModelAdmin):
+    list_display = ('order', 'side', 'last_read_id', 'read_at')
+    list_filter = ('side',)
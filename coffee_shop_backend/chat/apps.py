@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+class ChatConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'chat'
+
+    def ready(self):
+        import chat.signals  # Import signals when the app is ready
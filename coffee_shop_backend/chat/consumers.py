@@ -1,11 +1,20 @@
 import json
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.utils import timezone
+from . import history, writer
 from .models import ChatMessage
+from coffee_shop_backend import fastjson
+from orders.framing import FramedConsumerMixin, encode_frames
+from orders.outbound import OutboundQueueMixin
 from orders.models import Order
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(OutboundQueueMixin, FramedConsumerMixin, AsyncWebsocketConsumer):
+    # Dropping a message would leave a silent gap in the conversation
+    outbound_policy = 'close'
+
     async def connect(self):
         self.order_id = self.scope['url_route']['kwargs']['order_id']
         self.room_group_name = f'chat_{self.order_id}'
@@ -18,13 +27,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
 
-        # Send chat history
-        messages = await self.get_chat_history()
-        if messages:
-            await self.send(text_data=json.dumps({
-                'type': 'chat_history',
-                'messages': messages
-            }))
+        # Send chat history: what the client is missing when it tells us
+        # the last message it has, otherwise the most recent messages
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        since = self.message_id(query.get('since', [None])[0])
+        messages, has_more = await self.get_chat_history(since=since)
+        if messages or since is not None:
+            await self.send_history(messages, has_more)
 
     async def disconnect(self, close_code):
         # Leave room group
@@ -35,21 +44,22 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def receive(self, text_data):
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = fastjson.loads(text_data)
             message_type = text_data_json.get('type', 'chat_message')
 
             if message_type == 'ping':
-                await self.send(text_data=json.dumps({
+                await self.send_message({
                     'type': 'pong'
-                }))
+                })
                 return
 
             if message_type == 'get_history':
-                messages = await self.get_chat_history()
-                await self.send(text_data=json.dumps({
-                    'type': 'chat_history',
-                    'messages': messages
-                }))
+                # {"since": id} fetches newer messages, {"before": id} pages back
+                messages, has_more = await self.get_chat_history(
+                    since=self.message_id(text_data_json.get('since')),
+                    before=self.message_id(text_data_json.get('before')),
+                )
+                await self.send_history(messages, has_more)
                 return
 
             if message_type == 'chat_message':
@@ -62,15 +72,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 # Save message to database
                 saved_message = await self.save_message(message, sender_type)
 
-                # Send message to room group
+                # Send message to room group, encoded once for every socket
                 await self.channel_layer.group_send(
                     self.room_group_name,
                     {
                         'type': 'chat_message',
-                        'message': message,
-                        'sender_type': sender_type,
-                        'timestamp': saved_message['timestamp'],
-                        'is_read': False
+                        'frames': encode_frames({'type': 'chat_message', **saved_message})
                     }
                 )
 
@@ -81,30 +88,59 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def chat_message(self, event):
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'sender_type': event['sender_type'],
-            'timestamp': event['timestamp'],
-            'is_read': event['is_read']
-        }))
+        await self.send_frames(event['frames'])
+
+    async def send_history(self, messages, has_more):
+        await self.send_message({
+            'type': 'chat_history',
+            'messages': messages,
+            'has_more': has_more
+        })
+
+    @staticmethod
+    def message_id(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
 
     @database_sync_to_async
-    def get_chat_history(self):
+    def get_chat_history(self, since=None, before=None):
         try:
-            messages = ChatMessage.objects.filter(order_id=self.order_id).order_by('timestamp')
-            return [{
-                'message': msg.message,
-                'sender_type': msg.sender_type,
-                'timestamp': msg.timestamp.isoformat(),
-                'is_read': msg.is_read
-            } for msg in messages]
+            if before is not None:
+                return history.before(self.order_id, before)
+            if since is not None:
+                return history.since(self.order_id, since)
+            return history.recent(self.order_id)
         except Exception as e:
             print(f"Error fetching chat history: {str(e)}")
-            return []
+            return [], False
+
+    async def save_message(self, message, sender_type):
+        if writer.is_enabled():
+            chat_writer = await self.get_chat_writer()
+            # Not on the thread-sensitive database executor: submitting
+            # neither queries nor waits for other writes
+            return await sync_to_async(chat_writer.submit, thread_sensitive=False)(
+                self.order_id, message, sender_type
+            )
+        return await self.create_message(message, sender_type)
+
+    @database_sync_to_async
+    def get_chat_writer(self):
+        """
+        The write-behind writer, once the order is known to exist. Starting
+        the writer and the first check for each order query, so this runs
+        where database connections are managed.
+        """
+        chat_writer = writer.get_writer()
+        if not chat_writer.order_exists(self.order_id):
+            raise Exception(f"Order {self.order_id} does not exist")
+        # History picks the message up once the writer has saved it
+        return chat_writer
 
     @database_sync_to_async
-    def save_message(self, message, sender_type):
+    def create_message(self, message, sender_type):
         try:
             order = Order.objects.get(id=self.order_id)
             chat_message = ChatMessage.objects.create(
@@ -112,14 +148,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 message=message,
                 sender_type=sender_type,
                 timestamp=timezone.now(),
-                is_read=False
             )
-            return {
-                'message': chat_message.message,
-                'sender_type': chat_message.sender_type,
-                'timestamp': chat_message.timestamp.isoformat(),
-                'is_read': chat_message.is_read
-            }
+            return history.as_payload(chat_message)
         except Order.DoesNotExist:
             raise Exception(f"Order {self.order_id} does not exist")
         except Exception as e:
@@ -0,0 +1,163 @@
+"""
+Recent chat history per order, kept in the shared cache.
+
+Each order's newest ``CHAT_HISTORY_SIZE`` messages (as sent over the
+socket) live in a ring of cache slots, so sending history on connect
+normally costs no database access. Older pages and gaps longer than the
+buffer are read from the database by id.
+
+Appending uses only the cache's atomic operations, so workers sharing
+a cache never overwrite each other's messages:
+
+* The first reader claims a cycle for the order with ``add``, creates
+  the head counter, then fills the slots from the database and records
+  the lowest filled sequence number. Reading after the counter exists
+  means any message committed too early to be appended is in the read.
+* A new message, once committed, takes the next sequence number with
+  ``incr`` on the head counter and writes the slot ``seq % size`` as
+  ``(seq, payload)``. Without a counter there is nothing to append to
+  and the next reader builds from the database instead.
+* Readers fetch the slots between the floor and the head and check each
+  one holds its own sequence number. A slot that is missing, still
+  being written or already overwritten ends the cycle, and the reader
+  rebuilds.
+
+Edits, deletes and read marks change messages already in the ring, so
+they call ``forget``, which ends the cycle. Entries are keyed by cycle,
+so writes still in flight from an ended cycle are never read.
+"""
+import time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+
+CHAT_HISTORY_SIZE = getattr(settings, 'CHAT_HISTORY_SIZE', 50)
+CHAT_HISTORY_TIMEOUT = getattr(settings, 'CHAT_HISTORY_TIMEOUT', 60 * 60 * 24)
+# A cycle whose build has not finished by then is taken to have died
+CHAT_HISTORY_BUILD_TIMEOUT = 10
+
+
+def _key(order_id, *parts):
+    return ':'.join(['chat:history', str(order_id), *map(str, parts)])
+
+
+def _slot_key(order_id, cycle, seq):
+    return _key(order_id, cycle, 'slot', seq % CHAT_HISTORY_SIZE)
+
+
+def as_payload(message):
+    return {
+        'id': message.id,
+        'message': message.message,
+        'sender_type': message.sender_type,
+        'timestamp': message.timestamp.isoformat(),
+        # Annotated by with_read_state(); a message just saved is unread
+        'is_read': getattr(message, 'is_read', False),
+    }
+
+
+def _load(order_id, limit, **filters):
+    """The newest ``limit`` messages matching ``filters``, oldest first, and whether more exist."""
+    from .models import ChatMessage
+
+    messages = list(
+        ChatMessage.objects.with_read_state()
+        .filter(order_id=order_id, **filters).order_by('-id')[:limit + 1]
+    )
+    return [as_payload(message) for message in reversed(messages[:limit])], len(messages) > limit
+
+
+def recent(order_id):
+    """``(messages, has_more)`` for the newest messages of ``order_id``."""
+    cycle = cache.get(_key(order_id, 'cycle'))
+    if cycle is not None:
+        entry = _read(order_id, *cycle)
+        if entry is not None:
+            return entry
+    return _build(order_id)
+
+
+def _read(order_id, cycle, started):
+    """The ring's contents, or None when it cannot be served."""
+    head_key, meta_key = _key(order_id, cycle, 'head'), _key(order_id, cycle, 'meta')
+    cached = cache.get_many([head_key, meta_key])
+    head, meta = cached.get(head_key), cached.get(meta_key)
+    if meta is None and head is not None and time.time() - started < CHAT_HISTORY_BUILD_TIMEOUT:
+        # Still being built
+        return None
+    if head is None or meta is None:
+        forget(order_id)
+        return None
+    floor, has_more = meta
+    low = max(floor, head - CHAT_HISTORY_SIZE + 1)
+    keys = {seq: _slot_key(order_id, cycle, seq) for seq in range(low, head + 1)}
+    slots = cache.get_many(keys.values())
+    messages = {}
+    for seq, key in keys.items():
+        slot = slots.get(key)
+        if slot is None or slot[0] != seq:
+            forget(order_id)
+            return None
+        # A message committed during the build may be both read and appended
+        messages[slot[1]['id']] = slot[1]
+    return [messages[id] for id in sorted(messages)], has_more or low > floor
+
+
+def _build(order_id):
+    cycle = uuid4().hex
+    if not cache.add(_key(order_id, 'cycle'), (cycle, time.time()), CHAT_HISTORY_TIMEOUT):
+        # Another reader is building it
+        return _load(order_id, CHAT_HISTORY_SIZE)
+    cache.set(_key(order_id, cycle, 'head'), 0, CHAT_HISTORY_TIMEOUT)
+    messages, has_more = _load(order_id, CHAT_HISTORY_SIZE)
+    floor = 1 - len(messages)
+    cache.set_many({
+        _slot_key(order_id, cycle, floor + i): (floor + i, message)
+        for i, message in enumerate(messages)
+    }, CHAT_HISTORY_TIMEOUT)
+    cache.set(_key(order_id, cycle, 'meta'), (floor, has_more), CHAT_HISTORY_TIMEOUT)
+    return messages, has_more
+
+
+def since(order_id, message_id):
+    """Messages newer than ``message_id``, oldest first, and whether more follow."""
+    messages, has_more = recent(order_id)
+    if not messages or messages[0]['id'] <= message_id or not has_more:
+        return [message for message in messages if message['id'] > message_id], False
+    # The gap reaches back beyond the buffer: page forward from the database
+    from .models import ChatMessage
+
+    newer = list(
+        ChatMessage.objects.with_read_state()
+        .filter(order_id=order_id, id__gt=message_id).order_by('id')[:CHAT_HISTORY_SIZE + 1]
+    )
+    return [as_payload(message) for message in newer[:CHAT_HISTORY_SIZE]], len(newer) > CHAT_HISTORY_SIZE
+
+
+def before(order_id, message_id, limit=CHAT_HISTORY_SIZE):
+    """Up to ``limit`` messages older than ``message_id``, oldest first, and whether more precede."""
+    messages, has_more = recent(order_id)
+    if messages and messages[0]['id'] < message_id:
+        older = [message for message in messages if message['id'] < message_id]
+        if len(older) >= limit or not has_more:
+            return older[-limit:], len(older) > limit or has_more
+    return _load(order_id, limit, id__lt=message_id)
+
+
+def append(order_id, payload):
+    """Add a committed new message to the order's ring, if it has one."""
+    cycle = cache.get(_key(order_id, 'cycle'))
+    if cycle is None:
+        return
+    try:
+        seq = cache.incr(_key(order_id, cycle[0], 'head'))
+    except ValueError:
+        # Not built yet: the build reads the message from the database
+        return
+    cache.set(_slot_key(order_id, cycle[0], seq), (seq, payload), CHAT_HISTORY_TIMEOUT)
+
+
+def forget(order_id):
+    """Make the next reader rebuild the order's history; call once a change is committed."""
+    cache.delete(_key(order_id, 'cycle'))
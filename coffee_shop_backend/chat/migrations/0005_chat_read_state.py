@@ -0,0 +1,57 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def seed_read_states(apps, schema_editor):
+    """Start each side's watermark at the newest message it had marked read."""
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    ChatReadState = apps.get_model('chat', 'ChatReadState')
+
+    read = (
+        ChatMessage.objects.filter(is_read=True)
+        .values('order_id', 'sender_type')
+        .annotate(last_read_id=models.Max('id'))
+    )
+    ChatReadState.objects.bulk_create([
+        ChatReadState(
+            order_id=row['order_id'],
+            # Messages are read by the side that did not send them
+            side='client' if row['sender_type'] == 'admin' else 'admin',
+            last_read_id=row['last_read_id'],
+        )
+        for row in read
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatmessage_timestamp_default'),
+        ('orders', '0011_order_event_log'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('side', models.CharField(choices=[('client', 'Client'), ('admin', 'Admin')], max_length=10)),
+                ('last_read_id', models.BigIntegerField(default=0)),
+                ('read_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_read_states', to='orders.order')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('order', 'side'), name='chat_read_state_order_side')],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['order', 'sender_type', 'id'], name='chat_order_sender_id_idx'),
+        ),
+        migrations.RunPython(seed_read_states, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='chatmessage',
+            name='is_read',
+        ),
+    ]
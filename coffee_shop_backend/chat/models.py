@@ -1,20 +1,94 @@
 from django.db import models
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from orders.models import Order
 
+class ChatMessageQuerySet(models.QuerySet):
+    def with_read_state(self):
+        """Annotate ``is_read``: whether the other side has read up to the message"""
+        return self.annotate(is_read=models.Exists(
+            ChatReadState.objects.filter(
+                order_id=models.OuterRef('order_id'),
+                last_read_id__gte=models.OuterRef('id'),
+            ).exclude(side=models.OuterRef('sender_type'))
+        ))
+
+
 class ChatMessage(models.Model):
     SENDER_CHOICES = [
         ('client', 'Client'),
         ('admin', 'Admin'),
     ]
-    
+
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='chat_messages')
     message = models.TextField()
     sender_type = models.CharField(max_length=10, choices=SENDER_CHOICES, default='client')
-    timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    # Not auto_now_add, so write-behind rows keep the time they were sent
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = ChatMessageQuerySet.as_manager()
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['timestamp', 'id'], name='chat_timestamp_id_idx'),
+            models.Index(fields=['order', 'timestamp', 'id'], name='chat_order_timestamp_id_idx'),
+            # Unread counts: one side's messages above the other's watermark
+            models.Index(fields=['order', 'sender_type', 'id'], name='chat_order_sender_id_idx'),
+        ]
 
     def __str__(self):
         return f"Order: {self.order.id}, Sender: {self.sender_type}, Time: {self.timestamp}"
+
+
+class ChatReadState(models.Model):
+    """
+    How far one side of an order's chat has read: every message from the
+    other side with an id up to ``last_read_id`` is read. Marking a chat
+    read moves this one row instead of updating every message.
+    """
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='chat_read_states')
+    side = models.CharField(max_length=10, choices=ChatMessage.SENDER_CHOICES)
+    last_read_id = models.BigIntegerField(default=0)
+    read_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'side'], name='chat_read_state_order_side'),
+        ]
+
+    def __str__(self):
+        return f"Order: {self.order_id}, {self.side} read up to {self.last_read_id}"
+
+    @staticmethod
+    def other_side(side):
+        return 'client' if side == 'admin' else 'admin'
+
+    @classmethod
+    def mark(cls, order_id, side, last_read_id):
+        """Move ``side``'s watermark up to ``last_read_id``; it never moves back"""
+        now = timezone.now()
+        moved = cls.objects.filter(
+            order_id=order_id, side=side, last_read_id__lt=last_read_id
+        ).update(last_read_id=last_read_id, read_at=now)
+        if not moved:
+            # No row yet (or it is already further along, which this keeps)
+            cls.objects.bulk_create(
+                [cls(order_id=order_id, side=side, last_read_id=last_read_id, read_at=now)],
+                ignore_conflicts=True,
+            )
+
+    @classmethod
+    def unread_counts(cls, orders, side):
+        """``{order id: messages side has not read}`` for ``orders``, in one query"""
+        return dict(orders.annotate(
+            read_state=models.FilteredRelation(
+                'chat_read_states', condition=models.Q(chat_read_states__side=side)
+            ),
+        ).annotate(unread=models.Count(
+            'chat_messages',
+            filter=models.Q(
+                chat_messages__sender_type=cls.other_side(side),
+                chat_messages__id__gt=Coalesce('read_state__last_read_id', 0),
+            ),
+        )).values_list('pk', 'unread'))
@@ -2,7 +2,13 @@ from rest_framework import serializers
 from .models import ChatMessage
 
 class ChatMessageSerializer(serializers.ModelSerializer):
+    # Derived from the read watermarks (ChatMessage.objects.with_read_state())
+    is_read = serializers.SerializerMethodField()
+
     class Meta:
         model = ChatMessage
         fields = ['id', 'order', 'sender_type', 'message', 'timestamp', 'is_read']
-        read_only_fields = ['timestamp', 'is_read']
+        read_only_fields = ['timestamp']
+
+    def get_is_read(self, obj):
+        return getattr(obj, 'is_read', False)
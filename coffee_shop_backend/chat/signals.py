@@ -0,0 +1,22 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import history
+from .models import ChatMessage
+
+
+@receiver(post_save, sender=ChatMessage)
+def update_chat_history(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        payload = history.as_payload(instance)
+        transaction.on_commit(lambda: history.append(instance.order_id, payload))
+    else:
+        transaction.on_commit(lambda: history.forget(instance.order_id))
+
+
+@receiver(post_delete, sender=ChatMessage)
+def drop_chat_history(sender, instance, **kwargs):
+    transaction.on_commit(lambda: history.forget(instance.order_id))
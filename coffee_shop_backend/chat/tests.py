@@ -0,0 +1,306 @@
+import json
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from orders.models import Order, Table
+from orders.routing import application
+from orders.tests import use_own_cache
+
+from . import history, writer
+from .models import ChatMessage, ChatReadState
+
+
+class ChatHistoryTests(TestCase):
+    def setUp(self):
+        use_own_cache(self)
+        table = Table.objects.create(table_number=1, is_occupied=True)
+        self.order = Order.objects.create(table=table)
+        self.size = history.CHAT_HISTORY_SIZE
+        self.addCleanup(setattr, history, 'CHAT_HISTORY_SIZE', self.size)
+        history.CHAT_HISTORY_SIZE = 5
+
+    def post(self, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            return [
+                ChatMessage.objects.create(order=self.order, message=f'message {i}').id
+                for i in range(count)
+            ]
+
+    def ids(self, messages):
+        return [message['id'] for message in messages]
+
+    def test_recent_is_served_from_cache_after_first_read(self):
+        ids = self.post(8)
+        messages, has_more = history.recent(self.order.id)
+        self.assertEqual(self.ids(messages), ids[-5:])
+        self.assertTrue(has_more)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(history.recent(self.order.id), (messages, has_more))
+        self.assertEqual(len(queries), 0)
+
+    def test_new_messages_are_appended_without_a_query(self):
+        ids = self.post(3)
+        history.recent(self.order.id)
+        ids += self.post(4)
+
+        with CaptureQueriesContext(connection) as queries:
+            messages, has_more = history.recent(self.order.id)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(self.ids(messages), ids[-5:])
+        self.assertTrue(has_more)
+
+    def test_message_committed_during_a_build_is_appended(self):
+        ids = self.post(2)
+        load = history._load
+
+        def load_then_change(*args, **kwargs):
+            # Another worker commits a message after this reader's query
+            loaded = load(*args, **kwargs)
+            ids.extend(self.post(1))
+            return loaded
+
+        with mock.patch.object(history, '_load', side_effect=load_then_change):
+            self.assertEqual(self.ids(history.recent(self.order.id)[0]), ids[:2])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.ids(history.recent(self.order.id)[0]), ids)
+        self.assertEqual(len(queries), 0)
+
+    def test_reader_during_a_build_does_not_write(self):
+        ids = self.post(2)
+        load = history._load
+        seen = []
+
+        def load_and_read(*args, **kwargs):
+            if not seen:
+                # A second reader arrives while the first is still loading
+                seen.append(None)
+                seen[0] = history.recent(self.order.id)
+            return load(*args, **kwargs)
+
+        with mock.patch.object(history, '_load', side_effect=load_and_read):
+            history.recent(self.order.id)
+        self.assertEqual(self.ids(seen[0][0]), ids)
+        self.assertEqual(self.ids(history.recent(self.order.id)[0]), ids)
+
+    def test_lost_slot_rebuilds_the_buffer(self):
+        ids = self.post(3)
+        history.recent(self.order.id)
+        cycle, _ = cache.get(history._key(self.order.id, 'cycle'))
+        cache.delete(history._slot_key(self.order.id, cycle, 0))
+        self.assertEqual(self.ids(history.recent(self.order.id)[0]), ids)
+
+    def test_edits_drop_the_buffer(self):
+        self.post(2)
+        history.recent(self.order.id)
+        message = ChatMessage.objects.last()
+        message.message = 'edited'
+        with self.captureOnCommitCallbacks(execute=True):
+            message.save()
+        self.assertEqual(history.recent(self.order.id)[0][-1]['message'], 'edited')
+
+    def test_since_returns_only_missing_messages(self):
+        ids = self.post(7)
+        self.assertEqual(self.ids(history.since(self.order.id, ids[4])[0]), ids[5:])
+        # Beyond the buffer the gap is paged from the database
+        messages, has_more = history.since(self.order.id, ids[0])
+        self.assertEqual(self.ids(messages), ids[1:6])
+        self.assertTrue(has_more)
+
+    def test_before_pages_back_through_older_messages(self):
+        ids = self.post(12)
+        page, has_more = history.before(self.order.id, ids[7], limit=4)
+        self.assertEqual(self.ids(page), ids[3:7])
+        self.assertTrue(has_more)
+        page, has_more = history.before(self.order.id, ids[3], limit=4)
+        self.assertEqual(self.ids(page), ids[:3])
+        self.assertFalse(has_more)
+
+    def test_read_state_changes_drop_the_buffer(self):
+        self.post(2)
+        history.recent(self.order.id)
+        self.client.post('/api/chat/messages/mark_as_read/', {'order_id': self.order.id})
+        messages, _ = history.recent(self.order.id)
+        self.assertTrue(all(message['is_read'] for message in messages))
+
+    def test_socket_reconnect_with_since(self):
+        ids = self.post(3)
+
+        async def scenario():
+            communicator = WebsocketCommunicator(
+                application, f'/ws/chat/{self.order.id}/?since={ids[1]}'
+            )
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            response = await communicator.receive_json_from()
+            await communicator.send_json_to({'type': 'get_history', 'before': ids[1]})
+            older = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return response, older
+
+        response, older = async_to_sync(scenario)()
+        self.assertEqual(response['type'], 'chat_history')
+        self.assertEqual(self.ids(response['messages']), ids[2:])
+        self.assertEqual(self.ids(older['messages']), ids[:1])
+        self.assertFalse(older['has_more'])
+
+
+class ChatReadStateTests(TestCase):
+    def setUp(self):
+        use_own_cache(self)
+        table = Table.objects.create(table_number=1, is_occupied=True)
+        self.order = Order.objects.create(table=table)
+
+    def post(self, order, *senders):
+        return [
+            ChatMessage.objects.create(order=order, message='hello', sender_type=sender).id
+            for sender in senders
+        ]
+
+    def read_state(self):
+        messages = self.client.get(f'/api/chat/messages/by_order/?order_id={self.order.id}').json()
+        return [(message['sender_type'], message['is_read']) for message in messages]
+
+    def test_marking_read_moves_one_watermark(self):
+        self.post(self.order, 'client', 'admin', 'client')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                '/api/chat/messages/mark_as_read/', {'order_id': self.order.id, 'side': 'admin'}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries if 'chat_chatmessage" SET' in query['sql']])
+        # Staff have read the customer's messages; the customer has not read theirs
+        self.assertEqual(
+            self.read_state(), [('client', True), ('admin', False), ('client', True)]
+        )
+
+        self.post(self.order, 'client')
+        self.assertEqual(self.read_state()[-1], ('client', False))
+
+    def test_watermark_never_moves_back(self):
+        first, second = self.post(self.order, 'client', 'client')
+        ChatReadState.mark(self.order.id, 'admin', second)
+        ChatReadState.mark(self.order.id, 'admin', first)
+
+        state = ChatReadState.objects.get(order=self.order, side='admin')
+        self.assertEqual(state.last_read_id, second)
+
+    def test_unread_counts_for_open_orders_in_one_query(self):
+        table = Table.objects.get()
+        quiet = Order.objects.create(table=table)
+        closed = Order.objects.create(table=table, status='paid')
+        ids = self.post(self.order, 'client', 'client', 'admin', 'client')
+        self.post(closed, 'client')
+        ChatReadState.mark(self.order.id, 'admin', ids[0])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/chat/messages/unread_counts/')
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(response.json(), {str(self.order.id): 2, str(quiet.id): 0})
+
+        counts = self.client.get('/api/chat/messages/unread_counts/?side=client').json()
+        self.assertEqual(counts[str(self.order.id)], 1)
+
+
+class ChatWriterTests(TestCase):
+    def setUp(self):
+        use_own_cache(self)
+        table = Table.objects.create(table_number=1, is_occupied=True)
+        self.order = Order.objects.create(table=table)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log_dir = Path(directory.name)
+
+    def make_writer(self):
+        # Flushed explicitly: the test database is only visible to this thread
+        chat_writer = writer.ChatWriter(self.log_dir, batch_size=10000, interval=3600)
+        self.addCleanup(chat_writer.close)
+        return chat_writer
+
+    def test_messages_are_written_in_one_batch_on_flush(self):
+        chat_writer = self.make_writer()
+        payloads = [chat_writer.submit(self.order.id, f'message {i}', 'client') for i in range(20)]
+        self.assertEqual(ChatMessage.objects.count(), 0)
+        self.assertEqual([p['id'] for p in payloads], sorted({p['id'] for p in payloads}))
+        self.assertEqual(history.recent(self.order.id), ([], False))
+
+        with CaptureQueriesContext(connection) as queries:
+            chat_writer.flush()
+        self.assertLessEqual(len(queries), 3)
+        saved = list(ChatMessage.objects.order_by('id').values_list('id', 'message', 'timestamp'))
+        self.assertEqual([row[0] for row in saved], [p['id'] for p in payloads])
+        self.assertEqual(saved[0][2].isoformat(), payloads[0]['timestamp'])
+        self.assertEqual(list(self.log_dir.glob('*.flushing')), [])
+        # Flushed messages are appended to the history read before the flush
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(history.recent(self.order.id)[0][-1]['id'], payloads[-1]['id'])
+        self.assertEqual(len(queries), 0)
+
+    def test_queued_messages_are_in_history_before_the_flush(self):
+        chat_writer = self.make_writer()
+        history.recent(self.order.id)
+        payloads = [chat_writer.submit(self.order.id, f'message {i}', 'client') for i in range(3)]
+
+        # As any worker sharing the cache would see it
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(history.recent(self.order.id), (payloads, False))
+            self.assertEqual(history.since(self.order.id, payloads[0]['id'])[0], payloads[1:])
+        self.assertEqual(len(queries), 0)
+        chat_writer.flush()
+        self.assertEqual(history.recent(self.order.id), (payloads, False))
+
+    def test_order_existence_is_checked_once(self):
+        chat_writer = self.make_writer()
+        self.assertTrue(chat_writer.order_exists(self.order.id))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(chat_writer.order_exists(str(self.order.id)))
+        self.assertEqual(len(queries), 0)
+        self.assertFalse(chat_writer.order_exists(self.order.id + 1000))
+
+    def test_socket_messages_are_queued_after_the_order_check(self):
+        chat_writer = self.make_writer()
+
+        async def scenario():
+            communicator = WebsocketCommunicator(application, f'/ws/chat/{self.order.id}/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            message = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return message
+
+        # The order exists only in this test's transaction, so the check
+        # must use the database executor's connection to find it
+        with override_settings(CHAT_WRITE_BEHIND=True), \
+                mock.patch.object(writer, 'get_writer', return_value=chat_writer):
+            message = async_to_sync(scenario)()
+        self.assertEqual(message['message'], 'hello')
+        chat_writer.flush()
+        self.assertEqual(list(ChatMessage.objects.values_list('message', flat=True)), ['hello'])
+
+    def test_log_of_a_crashed_process_is_replayed(self):
+        rows = [
+            {'id': 1000 + i, 'order_id': self.order.id, 'message': f'lost {i}',
+             'sender_type': 'client', 'timestamp': '2026-01-01T12:00:00+00:00'}
+            for i in range(3)
+        ]
+        # A pid above any kernel's pid_max never belongs to a live process
+        log = self.log_dir / 'chat-99999999.log'
+        log.write_text(''.join(json.dumps(row) + '\n' for row in rows) + '{"partial')
+        ChatMessage.objects.create(id=1000, order=self.order, message='lost 0')
+
+        self.make_writer()
+        self.assertEqual(
+            list(ChatMessage.objects.order_by('id').values_list('message', flat=True)),
+            ['lost 0', 'lost 1', 'lost 2'],
+        )
+        self.assertFalse(log.exists())
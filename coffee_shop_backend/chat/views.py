@@ -1,16 +1,21 @@
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from .models import ChatMessage
+from django.db.models import Max
+from . import history
+from .models import ChatMessage, ChatReadState
 from .serializers import ChatMessageSerializer
+from orders.events import CLOSED_STATUSES
 from orders.models import Order
+from orders.pagination import ChatMessageCursorPagination
 
 class ChatMessageViewSet(viewsets.ModelViewSet):
     serializer_class = ChatMessageSerializer
     queryset = ChatMessage.objects.all()
+    pagination_class = ChatMessageCursorPagination
 
     def get_queryset(self):
-        queryset = ChatMessage.objects.all()
+        queryset = ChatMessage.objects.with_read_state()
         order_id = self.request.query_params.get('order_id', None)
         if order_id is not None:
             queryset = queryset.filter(order_id=order_id)
@@ -18,12 +23,45 @@ class ChatMessageViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['post'])
     def mark_as_read(self, request):
+        """
+        Move the read watermark of ``side`` (both sides if omitted) up to
+        ``last_read_id``, or to the order's newest message.
+        """
         order_id = request.data.get('order_id')
-        if order_id:
-            messages = ChatMessage.objects.filter(order_id=order_id)
-            messages.update(is_read=True)
-            return Response({'status': 'messages marked as read'})
-        return Response({'error': 'order_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if not order_id:
+            return Response({'error': 'order_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        side = request.data.get('side')
+        sides = dict(ChatMessage.SENDER_CHOICES)
+        if side is not None and side not in sides:
+            return Response({'error': f'side must be one of {", ".join(sides)}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        last_read_id = request.data.get('last_read_id')
+        if last_read_id is None:
+            last_read_id = ChatMessage.objects.filter(order_id=order_id).aggregate(Max('id'))['id__max']
+            if last_read_id is None:
+                return Response({'status': 'messages marked as read'})
+        else:
+            try:
+                last_read_id = int(last_read_id)
+            except (TypeError, ValueError):
+                return Response({'error': 'last_read_id must be a message id'}, status=status.HTTP_400_BAD_REQUEST)
+            if not Order.objects.filter(pk=order_id).exists():
+                return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        for reader in [side] if side else sides:
+            ChatReadState.mark(order_id, reader, last_read_id)
+        history.forget(order_id)
+        return Response({'status': 'messages marked as read'})
+
+    @action(detail=False, methods=['get'])
+    def unread_counts(self, request):
+        """Unread messages per open order for ``side`` (default ``admin``), in one query"""
+        side = request.query_params.get('side', 'admin')
+        if side not in dict(ChatMessage.SENDER_CHOICES):
+            return Response({'error': 'side must be client or admin'}, status=status.HTTP_400_BAD_REQUEST)
+        orders = Order.objects.exclude(status__in=CLOSED_STATUSES)
+        return Response(ChatReadState.unread_counts(orders, side))
 
     @action(detail=False, methods=['get'])
     def by_order(self, request):
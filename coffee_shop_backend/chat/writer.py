@@ -0,0 +1,268 @@
+"""
+Optional write-behind persistence for chat messages (CHAT_WRITE_BEHIND).
+
+Instead of one INSERT per message on the consumer's database thread,
+``submit`` assigns the message an id, appends it to a per-process log
+and returns at once, so the message can be fanned out immediately. A
+background thread writes queued messages with one ``bulk_create`` once
+``CHAT_WRITE_BATCH_SIZE`` are waiting or ``CHAT_WRITE_INTERVAL`` seconds
+have passed, and again when the process exits.
+
+Ids are snowflakes: milliseconds since ``EPOCH``, a 10-bit worker number
+taken from the pid and a 12-bit sequence. They increase with time like
+the database's own ids, so history ordering and cursors are unchanged.
+On SQLite the first snowflake written also raises the table's
+AUTOINCREMENT sequence past it, so messages saved the usual way (with
+write-behind off, or from the REST API) take ids above it from then on.
+
+Queued messages are appended to the shared history (chat.history) on
+submit and again once written, so history sent on connect and ``since``
+catch-up include them on every worker. The one gap: if another change
+makes the history rebuild from the database before the flush, messages
+still queued are missing from it until the flush, at most
+``CHAT_WRITE_INTERVAL`` later. Older pages (``before``) are read from
+the database only.
+
+The log makes a crash lose nothing: it is rotated on every flush and
+removed once the batch is committed. Logs left behind by processes that
+are no longer running are replayed when the next writer starts; inserts
+ignore rows that already exist, so replaying is always safe.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.db import IntegrityError, connection
+
+from . import history
+
+logger = logging.getLogger(__name__)
+
+CHAT_WRITE_BATCH_SIZE = getattr(settings, 'CHAT_WRITE_BATCH_SIZE', 100)
+CHAT_WRITE_INTERVAL = getattr(settings, 'CHAT_WRITE_INTERVAL', 0.5)
+KNOWN_ORDERS_LIMIT = 10000
+
+EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+
+class SnowflakeIds:
+    def __init__(self, worker):
+        self.worker = worker & ((1 << WORKER_BITS) - 1)
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            now_ms = int((time.time() - EPOCH.timestamp()) * 1000)
+            if now_ms <= self.last_ms:
+                # Same millisecond, or the clock went back: keep counting
+                # from the last one so ids never repeat or decrease
+                now_ms = self.last_ms
+                self.sequence = (self.sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+                if self.sequence == 0:
+                    now_ms += 1
+            else:
+                self.sequence = 0
+            self.last_ms = now_ms
+            return (now_ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker << SEQUENCE_BITS) | self.sequence
+
+
+class ChatWriter:
+    def __init__(self, log_dir, batch_size=CHAT_WRITE_BATCH_SIZE, interval=CHAT_WRITE_INTERVAL):
+        self.log_dir = Path(log_dir)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.ids = SnowflakeIds(os.getpid())
+        self.known_orders = set()
+        self.pending = []
+        self.unwritten = []
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+        self.recover()
+        self.log_path = self.log_dir / f'chat-{os.getpid()}.log'
+        self.log = open(self.log_path, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.run, name='chat-writer', daemon=True)
+        self.thread.start()
+
+    # Called from consumers
+
+    def order_exists(self, order_id):
+        """Whether ``order_id`` exists, querying only the first time it is seen."""
+        from orders.models import Order
+
+        order_id = int(order_id)
+        if order_id in self.known_orders:
+            return True
+        if not Order.objects.filter(pk=order_id).exists():
+            return False
+        if len(self.known_orders) >= KNOWN_ORDERS_LIMIT:
+            self.known_orders.clear()
+        self.known_orders.add(order_id)
+        return True
+
+    def submit(self, order_id, message, sender_type):
+        """Queue a message for writing and return its payload."""
+        timestamp = datetime.now(dt_timezone.utc)
+        row = {
+            'id': self.ids.next(),
+            'order_id': int(order_id),
+            'message': message,
+            'sender_type': sender_type,
+            'timestamp': timestamp.isoformat(),
+        }
+        with self.lock:
+            self.log.write(json.dumps(row) + '\n')
+            self.log.flush()
+            self.pending.append(row)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wakeup.set()
+        payload = as_payload(row)
+        history.append(row['order_id'], payload)
+        return payload
+
+    # Writing
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error writing chat messages")
+        connection.close()
+
+    def flush(self):
+        """Write everything queued so far; safe to call from any thread."""
+        with self.flush_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, []
+                # New messages go to a fresh log while this batch is written
+                self.generation += 1
+                flushing = self.log_dir / f'chat-{os.getpid()}.{self.generation}.flushing'
+                self.log.close()
+                os.replace(self.log_path, flushing)
+                self.log = open(self.log_path, 'a', encoding='utf-8')
+                self.unwritten.append(flushing)
+            try:
+                write_rows(batch)
+            except Exception:
+                # Keep the batch (and its log) for the next attempt
+                with self.lock:
+                    self.pending[:0] = batch
+                raise
+            for path in self.unwritten:
+                path.unlink()
+            self.unwritten = []
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.flush()
+        with self.lock:
+            self.log.close()
+        if self.log_path.exists() and not self.log_path.stat().st_size:
+            self.log_path.unlink()
+
+    def recover(self):
+        """Replay logs left behind by processes that are no longer running."""
+        for path in sorted(self.log_dir.glob('chat-*')):
+            pid = int(path.name.split('-', 1)[1].split('.', 1)[0])
+            if pid != os.getpid() and _is_running(pid):
+                continue
+            with open(path, encoding='utf-8') as log:
+                rows = [json.loads(line) for line in log if line.endswith('\n')]
+            if rows:
+                logger.warning(f"Replaying {len(rows)} unwritten chat messages from {path.name}")
+                write_rows(rows)
+            path.unlink()
+
+
+def as_payload(row):
+    return {
+        'id': row['id'],
+        'message': row['message'],
+        'sender_type': row['sender_type'],
+        'timestamp': row['timestamp'],
+        'is_read': False,
+    }
+
+
+def write_rows(rows):
+    from .models import ChatMessage
+
+    def build(rows):
+        return [
+            ChatMessage(
+                id=row['id'],
+                order_id=row['order_id'],
+                message=row['message'],
+                sender_type=row['sender_type'],
+                timestamp=datetime.fromisoformat(row['timestamp']),
+            )
+            for row in rows
+        ]
+
+    try:
+        ChatMessage.objects.bulk_create(build(rows), ignore_conflicts=True)
+    except IntegrityError:
+        # An order was deleted after its messages were accepted
+        from orders.models import Order
+
+        existing = set(Order.objects.filter(
+            pk__in={row['order_id'] for row in rows}
+        ).values_list('pk', flat=True))
+        kept = [row for row in rows if row['order_id'] in existing]
+        logger.warning(f"Dropping {len(rows) - len(kept)} chat messages for deleted orders")
+        ChatMessage.objects.bulk_create(build(kept), ignore_conflicts=True)
+        rows = kept
+    # bulk_create sends no signals. Rows appended on submit are appended
+    # again, for a history rebuilt meanwhile; readers drop the duplicates
+    for row in rows:
+        history.append(row['order_id'], as_payload(row))
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """The process-wide writer, started on first use."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            log_dir = getattr(settings, 'CHAT_WRITE_LOG_DIR', Path(settings.BASE_DIR) / 'chat_write_log')
+            _writer = ChatWriter(log_dir)
+            atexit.register(_writer.close)
+        return _writer
+
+
+def is_enabled():
+    return getattr(settings, 'CHAT_WRITE_BEHIND', False)
@@ -5,20 +5,22 @@ ASGI config for coffee_shop_backend project.
 import os
 import django
 from django.core.asgi import get_asgi_application
+from django.urls import re_path
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'coffee_shop_backend.settings')
 django.setup()
 
 from chat.routing import websocket_urlpatterns as chat_websocket_urlpatterns
+from orders.middleware import TokenAuthMiddlewareStack
+from orders.routing import http_urlpatterns as orders_http_urlpatterns
 from orders.routing import websocket_urlpatterns as orders_websocket_urlpatterns
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": URLRouter(orders_http_urlpatterns + [re_path(r"", get_asgi_application())]),
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+        TokenAuthMiddlewareStack(
             URLRouter(
                 orders_websocket_urlpatterns +
                 chat_websocket_urlpatterns
@@ -0,0 +1,96 @@
+"""
+Response compression negotiated from ``Accept-Encoding``.
+
+Brotli is offered when the ``brotli`` package is installed, gzip always.
+Only complete (non-streaming) text responses of at least
+``COMPRESSION_MIN_SIZE`` bytes are compressed: below that the headers
+and CPU cost more than the bytes saved, and streamed responses (event
+streams, static files served by WhiteNoise, which has its own
+precompressed copies) must not be buffered.
+"""
+import re
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = getattr(settings, 'COMPRESSION_MIN_SIZE', 1024)
+# Quick settings suited to bodies compressed on every request
+BROTLI_QUALITY = 4
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'application/xml', 'text/')
+
+ACCEPT_ENCODING_ITEM = re.compile(r'^\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?\s*$')
+
+
+def available_encodings():
+    """Supported content codings, most preferred first."""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(accept_encoding, encodings=None):
+    """The coding in ``encodings`` the client weights highest, or None for identity."""
+    encodings = encodings or available_encodings()
+    weights = {}
+    for item in accept_encoding.split(','):
+        match = ACCEPT_ENCODING_ITEM.match(item)
+        if not match:
+            continue
+        try:
+            weight = float(match[2]) if match[2] is not None else 1.0
+        except ValueError:
+            continue
+        weights[match[1].lower()] = weight
+    best, best_weight = None, 0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get('*', 0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(content, quality=BROTLI_QUALITY)
+    return compress_string(content)
+
+
+def is_compressible(content_type):
+    content_type = content_type.split(';')[0].strip().lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) or content_type.endswith('+json')
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """Compress large text responses with the best coding the client accepts."""
+
+    def process_response(self, request, response):
+        if (
+            response.streaming
+            or response.has_header('Content-Encoding')
+            or len(response.content) < COMPRESSION_MIN_SIZE
+            or not is_compressible(response.get('Content-Type', ''))
+        ):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+        compressed = compress(response.content, encoding)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        # The compressed bytes differ from the ones a strong ETag named
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
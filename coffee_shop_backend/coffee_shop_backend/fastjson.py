@@ -0,0 +1,81 @@
+"""
+JSON encoding for API responses, request bodies and WebSocket frames.
+
+orjson is used when it is installed (``pip install orjson``); otherwise
+everything falls back to the standard library and DRF's own renderer and
+parser. Output matches DRF's ``JSONRenderer`` with the project's
+settings (compact, UTF-8, U+2028/U+2029 escaped), and types JSON has no
+form for (Decimal, datetime, lazy strings, ...) go through DRF's
+``JSONEncoder`` in both cases. Anything orjson refuses, such as integers
+wider than 64 bits, is encoded by the fallback instead.
+"""
+import io
+import json
+
+from django.conf import settings
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoder = JSONEncoder()
+
+if orjson is not None:
+    # Datetimes are handed to DRF's encoder, which writes UTC as 'Z'
+    OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def dumps(obj):
+    """``obj`` as JSON text, for WebSocket frames."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_encoder.default, option=OPTIONS).decode()
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, cls=JSONEncoder)
+
+
+def loads(text):
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """``JSONRenderer`` that renders with orjson when the output would be the same."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None or data is None or not self.compact or self.ensure_ascii
+            or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            body = orjson.dumps(data, default=_encoder.default, option=OPTIONS)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escaped by JSONRenderer too: valid JSON, but line breaks in JavaScript
+        return body.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class FastJSONParser(JSONParser):
+    """``JSONParser`` that parses UTF-8 bodies with orjson."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        body = stream.read()
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError:
+            # Let the stock parser accept or reject what orjson would not
+            return super().parse(io.BytesIO(body), media_type, parser_context)
@@ -0,0 +1,277 @@
+"""
+SQLite-backed channel layer for running several ASGI workers on one host.
+
+InMemoryChannelLayer only reaches consumers in the same process, so group
+sends from one daphne worker never arrive at sockets held by another.
+This layer keeps messages and group memberships in a shared SQLite file
+in WAL mode, which needs no extra service and works for any number of
+processes on the same machine.
+
+Every event loop that opens channels gets a random client id, and its
+consumers' channels look like ``specific.<client id>!<suffix>``. Messages
+for them are stored with the client id as their target and a single task
+per client moves them into local queues, so the cost of polling does not
+grow with the number of open sockets.
+"""
+import asyncio
+import random
+import sqlite3
+import string
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channel_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    target TEXT NOT NULL,
+    expires REAL NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS channel_messages_target ON channel_messages (target, id);
+CREATE INDEX IF NOT EXISTS channel_messages_channel ON channel_messages (channel, expires);
+CREATE TABLE IF NOT EXISTS channel_groups (
+    grp TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (grp, channel)
+);
+"""
+
+
+def _random_string(length=12):
+    return ''.join(random.choice(string.ascii_letters) for _ in range(length))
+
+
+def _target(channel):
+    """Client id for process-specific channels, the name itself otherwise."""
+    if '!' in channel:
+        return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+    return channel
+
+
+class _Receiver:
+    """Local queues of one event loop, fed by a single polling task."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.client_id = _random_string()
+        self.queues = {}
+        self.task = None
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, poll_interval=0.01, batch_size=100):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        # A single thread owns the connection: statements never block an
+        # event loop and never need a lock of their own
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='channel-layer')
+        self._db = None
+        self._receivers = {}  # client id -> _Receiver
+        self._last_cleanup = 0
+
+    # Storage, only ever called on the executor thread
+
+    def _connection(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _insert(self, channels, body):
+        """Queue ``body`` on every channel with room; returns the full ones."""
+        db = self._connection()
+        now = time.time()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            placeholders = ','.join('?' * len(channels))
+            depth = dict(db.execute(
+                'SELECT channel, COUNT(*) FROM channel_messages '
+                f'WHERE channel IN ({placeholders}) AND expires > ? GROUP BY channel',
+                (*channels, now),
+            ).fetchall())
+            rows, full = [], []
+            for channel in channels:
+                if depth.get(channel, 0) >= self.get_capacity(channel):
+                    full.append(channel)
+                else:
+                    rows.append((channel, _target(channel), now + self.expiry, body))
+            db.executemany(
+                'INSERT INTO channel_messages (channel, target, expires, body) VALUES (?, ?, ?, ?)',
+                rows,
+            )
+        return full
+
+    def _group_channels(self, group):
+        return [row[0] for row in self._connection().execute(
+            'SELECT channel FROM channel_groups WHERE grp = ? AND expires > ?', (group, time.time())
+        )]
+
+    def _group_send(self, group, body):
+        channels = self._group_channels(group)
+        if channels:
+            # Like the other layers, group sends silently skip full channels
+            self._insert(channels, body)
+
+    def _take(self, target, limit, column='target'):
+        """Remove and return up to ``limit`` live (channel, body) rows for ``target``."""
+        db = self._connection()
+        now = time.time()
+        if now - self._last_cleanup > 1:
+            self._clean_expired(db, now)
+        # Idle polls only read, so they never take the write lock
+        pending = db.execute(
+            f'SELECT 1 FROM channel_messages WHERE {column} = ? LIMIT 1', (target,)
+        ).fetchone()
+        if pending is None:
+            return []
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute(
+                'SELECT id, channel, body FROM channel_messages '
+                f'WHERE {column} = ? AND expires > ? ORDER BY id LIMIT ?',
+                (target, now, limit),
+            ).fetchall()
+            if rows:
+                db.execute(
+                    f'DELETE FROM channel_messages WHERE id IN ({",".join("?" * len(rows))})',
+                    [row[0] for row in rows],
+                )
+        return [(channel, body) for _, channel, body in rows]
+
+    def _clean_expired(self, db, now):
+        self._last_cleanup = now
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            # As in the in-memory layer, a channel that let a message expire
+            # is treated as gone and leaves its groups
+            db.execute(
+                'DELETE FROM channel_groups WHERE expires <= ? OR channel IN '
+                '(SELECT channel FROM channel_messages WHERE expires <= ?)',
+                (now, now),
+            )
+            db.execute('DELETE FROM channel_messages WHERE expires <= ?', (now,))
+
+    def _group_add(self, group, channel):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO channel_groups (grp, channel, expires) VALUES (?, ?, ?)',
+            (group, channel, time.time() + self.group_expiry),
+        )
+
+    def _group_discard(self, group, channel):
+        self._connection().execute(
+            'DELETE FROM channel_groups WHERE grp = ? AND channel = ?', (group, channel)
+        )
+
+    def _flush(self):
+        db = self._connection()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('DELETE FROM channel_messages')
+            db.execute('DELETE FROM channel_groups')
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+        if await self._run(self._insert, [channel], self.serialize(message)):
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        receiver = self._receivers.get(_target(channel))
+        if receiver is None or receiver.loop is not asyncio.get_running_loop():
+            # Normal channels are rare (workers); poll them directly
+            while True:
+                rows = await self._run(self._take, channel, 1, 'channel')
+                if rows:
+                    return self.deserialize(rows[0][1])
+                await asyncio.sleep(self.poll_interval)
+
+        queue = receiver.queues.setdefault(channel, asyncio.Queue())
+        if receiver.task is None or receiver.task.done():
+            receiver.task = asyncio.ensure_future(self._receive_loop(receiver))
+        try:
+            return await queue.get()
+        except asyncio.CancelledError:
+            # The consumer is going away; stop collecting for its channel
+            receiver.queues.pop(channel, None)
+            raise
+
+    async def new_channel(self, prefix='specific'):
+        receiver = self._receiver()
+        channel = f'{prefix}.{receiver.client_id}!{_random_string()}'
+        # Register now so messages sent before the first receive() are kept
+        receiver.queues[channel] = asyncio.Queue()
+        return channel
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self._run(self._group_add, group, channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        await self._run(self._group_discard, group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        await self._run(self._group_send, group, self.serialize(message))
+
+    async def flush(self):
+        await self._run(self._flush)
+
+    async def close(self):
+        for receiver in self._receivers.values():
+            if receiver.task is not None:
+                receiver.task.cancel()
+        self._receivers.clear()
+
+    # Receiving
+
+    def _receiver(self):
+        loop = asyncio.get_running_loop()
+        for client_id, receiver in list(self._receivers.items()):
+            if receiver.loop is loop:
+                return receiver
+            if receiver.loop.is_closed():
+                del self._receivers[client_id]
+        receiver = _Receiver(loop)
+        self._receivers[receiver.client_id] = receiver
+        return receiver
+
+    async def _receive_loop(self, receiver):
+        while receiver.queues:
+            rows = await self._run(self._take, receiver.client_id, self.batch_size)
+            for channel, body in rows:
+                queue = receiver.queues.get(channel)
+                if queue is not None:
+                    queue.put_nowait(self.deserialize(body))
+            if len(rows) < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    def serialize(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def deserialize(self, body):
+        return msgpack.unpackb(body, raw=False)
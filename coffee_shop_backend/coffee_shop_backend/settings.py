@@ -48,18 +48,127 @@ INSTALLED_APPS = [
 ]
 
 ASGI_APPLICATION = 'coffee_shop_backend.asgi.application'
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+# The in-memory layer only reaches sockets held by the same process. Set
+# CHANNEL_LAYER_BACKEND=sqlite to run several ASGI workers on one box
+# (they share CHANNEL_LAYER_PATH), or =redis with CHANNEL_LAYER_URL for
+# workers spread over several hosts (needs channels_redis installed).
+CHANNEL_LAYER_BACKEND = os.environ.get('CHANNEL_LAYER_BACKEND', 'memory')
+if CHANNEL_LAYER_BACKEND == 'sqlite':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'coffee_shop_backend.layers.SQLiteChannelLayer',
+            'CONFIG': {
+                'path': os.environ.get('CHANNEL_LAYER_PATH', str(BASE_DIR / 'channels.sqlite3')),
+            },
+        }
+    }
+elif CHANNEL_LAYER_BACKEND == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [os.environ.get('CHANNEL_LAYER_URL', 'redis://127.0.0.1:6379/0')],
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
+    }
+
+# The default cache holds per-order versions (orders.conditional) and chat
+# history. It is per-process unless CACHE_BACKEND=redis with CACHE_URL;
+# run several workers with the redis cache, or each one keeps serving what
+# it cached itself. Rendered catalog listings (orders.catalog) get a
+# file-based cache that every worker and management command (e.g.
+# warm_catalog_cache) on the box shares without extra services. It is kept
+# to that one use: FileBasedCache lists its whole directory to cull on
+# every set(), and its add() is not atomic.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('CACHE_URL', 'redis://127.0.0.1:6379/1'),
+        }
     }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+CACHES['catalog'] = {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': BASE_DIR / '.django_cache',
 }
 
+# Rendered menu/category listings are invalidated on any catalog change;
+# the timeout only bounds how long an unused listing stays in the cache
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Widths of the WebP/JPEG variants generated for menu item images
+MENU_IMAGE_WIDTHS = (160, 320, 640)
+
+# Order events kept for clients reconnecting with ?since=<seq>, and the
+# most open orders sent to a client that has been away for longer
+ORDER_EVENT_BUFFER = 1000
+ORDER_SNAPSHOT_LIMIT = 200
+
+# Frames queued per WebSocket connection before the consumer's policy
+# (drop the oldest, or close) applies, and server heartbeats: a client that
+# sends nothing for the timeout is disconnected (see orders.outbound)
+WEBSOCKET_QUEUE_SIZE = 64
+WEBSOCKET_HEARTBEAT_INTERVAL = 20
+WEBSOCKET_HEARTBEAT_TIMEOUT = 60
+
+# Order tracking without a WebSocket (see orders.streams): event streams
+# end after ORDER_STREAM_TIMEOUT seconds and the browser reconnects, with
+# a keepalive comment every ORDER_STREAM_KEEPALIVE seconds; long polls
+# wait at most ORDER_LONG_POLL_TIMEOUT seconds for a change
+ORDER_STREAM_TIMEOUT = 300
+ORDER_STREAM_KEEPALIVE = 15
+ORDER_LONG_POLL_TIMEOUT = 25
+
+# Most recent chat messages per order kept in the cache for socket history
+CHAT_HISTORY_SIZE = 50
+
+# Persist chat messages in batches from a background writer instead of one
+# INSERT per message (see chat.writer); enable with CHAT_WRITE_BEHIND=1
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND') == '1'
+CHAT_WRITE_BATCH_SIZE = 100
+CHAT_WRITE_INTERVAL = 0.5
+CHAT_WRITE_LOG_DIR = BASE_DIR / 'chat_write_log'
+
+# Users behind JWTs are cached per process for REST and WebSocket auth.
+# Changes reach other processes through a stamp in the default cache;
+# without a shared cache the TTL bounds how long they see a deactivated
+# account
+AUTH_USER_CACHE_SIZE = 1024
+AUTH_USER_CACHE_TTL = 60
+
+# Responses smaller than this are sent uncompressed; larger text bodies are
+# gzipped, or brotli-compressed when the brotli package is installed
+COMPRESSION_MIN_SIZE = 1024
+
 GRAPPELLI_ADMIN_TITLE = "BMMAS Admin Panel"
 
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'orders.auth.CachedJWTAuthentication',
+    ),
+    # orjson when installed, DRF's own JSON handling otherwise
+    'DEFAULT_RENDERER_CLASSES': (
+        'coffee_shop_backend.fastjson.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'coffee_shop_backend.fastjson.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ),
 }
 SIMPLE_JWT = {
@@ -105,6 +214,7 @@ AUTH_USER_MODEL = 'auth.User'  # Use the default Django User model
 MIDDLEWARE = [
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'coffee_shop_backend.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
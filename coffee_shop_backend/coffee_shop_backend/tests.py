@@ -0,0 +1,190 @@
+import gzip
+import io
+import json
+import subprocess
+import sys
+import tempfile
+import textwrap
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase
+from django.utils.translation import gettext_lazy
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.serializer_helpers import ReturnDict, ReturnList
+
+from . import fastjson
+from .compression import CompressionMiddleware, available_encodings, choose_encoding
+from .fastjson import FastJSONParser, FastJSONRenderer
+from .layers import SQLiteChannelLayer
+
+# Stands in for a second ASGI worker: joins the group, says so, then prints
+# the first message it receives
+WORKER = textwrap.dedent("""
+    import asyncio, json, sys
+    from coffee_shop_backend.layers import SQLiteChannelLayer
+
+    async def main():
+        layer = SQLiteChannelLayer(sys.argv[1])
+        channel = await layer.new_channel()
+        await layer.group_add('orders', channel)
+        print('ready', flush=True)
+        message = await asyncio.wait_for(layer.receive(channel), timeout=10)
+        print(json.dumps(message), flush=True)
+        await layer.close()
+
+    asyncio.run(main())
+""")
+
+
+class SQLiteChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = str(Path(directory.name) / 'channels.sqlite3')
+
+    def make_layer(self, **config):
+        layer = SQLiteChannelLayer(self.path, **config)
+        self.addCleanup(async_to_sync(layer.close))
+        return layer
+
+    def test_group_send_reaches_other_processes(self):
+        workers = [
+            subprocess.Popen(
+                [sys.executable, '-c', WORKER, self.path],
+                cwd=Path(__file__).resolve().parent.parent,
+                stdout=subprocess.PIPE, text=True,
+            )
+            for _ in range(2)
+        ]
+        for worker in workers:
+            self.addCleanup(worker.kill)
+            self.assertEqual(worker.stdout.readline().strip(), 'ready')
+
+        async_to_sync(self.make_layer().group_send)(
+            'orders', {'type': 'new_order', 'order': {'id': 7}}
+        )
+
+        for worker in workers:
+            output, _ = worker.communicate(timeout=15)
+            self.assertEqual(json.loads(output), {'type': 'new_order', 'order': {'id': 7}})
+            self.assertEqual(worker.returncode, 0)
+
+    def test_send_and_group_membership(self):
+        layer = self.make_layer()
+        other_worker = self.make_layer()
+
+        async def scenario():
+            first = await layer.new_channel()
+            second = await layer.new_channel()
+            await layer.group_add('kitchen', first)
+            await layer.group_add('kitchen', second)
+            await layer.group_discard('kitchen', second)
+
+            await other_worker.group_send('kitchen', {'type': 'order_update', 'id': 1})
+            await other_worker.send(second, {'type': 'direct'})
+            return await layer.receive(first), await layer.receive(second)
+
+        grouped, direct = async_to_sync(scenario)()
+        self.assertEqual(grouped, {'type': 'order_update', 'id': 1})
+        self.assertEqual(direct, {'type': 'direct'})
+
+    def test_send_to_full_channel_raises(self):
+        layer = self.make_layer(capacity=2)
+
+        async def scenario():
+            channel = await layer.new_channel()
+            await layer.send(channel, {'type': 'one'})
+            await layer.send(channel, {'type': 'two'})
+            await layer.send(channel, {'type': 'three'})
+
+        with self.assertRaises(ChannelFull):
+            async_to_sync(scenario)()
+
+
+class FastJSONTests(SimpleTestCase):
+    data = {
+        'id': 7,
+        'total': Decimal('12.50'),
+        'when': datetime(2024, 5, 1, 9, 30, 0, 123456, tzinfo=dt_timezone.utc),
+        'elsewhere': datetime(2024, 5, 1, 9, 30, tzinfo=dt_timezone(timedelta(hours=2))),
+        'day': date(2024, 5, 1),
+        'label': gettext_lazy('Pending'),
+        'text': 'Caf\u00e9 \u2615 line\u2028separator\u2029',
+        'counts': {3: 1, 10: 0},
+        'rows': ReturnList([ReturnDict({'a': 1.5, 'b': None, 'c': True}, serializer=None)], serializer=None),
+        'huge': 2 ** 70,
+    }
+
+    def test_renderer_output_matches_drf(self):
+        self.assertEqual(FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+
+    def test_renderer_without_orjson(self):
+        with mock.patch.object(fastjson, 'orjson', None):
+            self.assertEqual(FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+
+    def test_parser(self):
+        body = '{"status": "ready", "items": [{"menu_item": 1, "quantity": 2}], "huge": %d}' % 2 ** 70
+        parsed = FastJSONParser().parse(io.BytesIO(body.encode()))
+        self.assertEqual(parsed, json.loads(body))
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(io.BytesIO(b'{"status": '))
+
+    def test_frames_round_trip(self):
+        message = {'type': 'order_update', 'order': {'id': 1, 'notes': 'Café'}, 'seq': 3}
+        self.assertEqual(fastjson.loads(fastjson.dumps(message)), message)
+        with mock.patch.object(fastjson, 'orjson', None):
+            self.assertEqual(fastjson.dumps(message), json.dumps(message))
+        with self.assertRaises(json.JSONDecodeError):
+            fastjson.loads('not json')
+
+
+class CompressionTests(SimpleTestCase):
+    def respond(self, response, accept_encoding='gzip, deflate, br'):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def json_response(self, size=4096, **headers):
+        return HttpResponse(json.dumps(['x' * 10] * (size // 14)), content_type='application/json', **headers)
+
+    def test_choose_encoding(self):
+        self.assertEqual(choose_encoding('gzip, deflate, br', ('br', 'gzip')), 'br')
+        self.assertEqual(choose_encoding('br;q=0.5, gzip', ('br', 'gzip')), 'gzip')
+        self.assertEqual(choose_encoding('br;q=0, *', ('br', 'gzip')), 'gzip')
+        self.assertEqual(choose_encoding('gzip;q=0', ('br', 'gzip')), None)
+        self.assertEqual(choose_encoding('', ('br', 'gzip')), None)
+        self.assertEqual(choose_encoding('identity', ('br', 'gzip')), None)
+
+    def test_large_json_is_compressed(self):
+        original = self.json_response(headers={'ETag': '"abc"'})
+        body = original.content
+        response = self.respond(original)
+        encoding = available_encodings()[0]
+        self.assertEqual(response['Content-Encoding'], encoding)
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertLess(len(response.content), len(body))
+        self.assertEqual(response['ETag'], 'W/"abc"')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        if encoding == 'gzip':
+            self.assertEqual(gzip.decompress(response.content), body)
+
+    def test_left_alone(self):
+        small = self.respond(self.json_response(size=100))
+        self.assertFalse(small.has_header('Content-Encoding'))
+        self.assertFalse(small.has_header('Vary'))
+
+        identity = self.respond(self.json_response(), accept_encoding='')
+        self.assertFalse(identity.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', identity['Vary'])
+
+        image = self.respond(HttpResponse(b'\0' * 4096, content_type='image/jpeg'))
+        self.assertFalse(image.has_header('Content-Encoding'))
+
+        stream = self.respond(StreamingHttpResponse(iter([b'data: x\n\n'] * 500), content_type='text/event-stream'))
+        self.assertFalse(stream.has_header('Content-Encoding'))
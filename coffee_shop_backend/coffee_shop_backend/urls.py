@@ -1,11 +1,17 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from orders.images import serve_variant
 
 urlpatterns = [
     path('grappelli/', include('grappelli.urls')),
     path('admin/', admin.site.urls),
     path('api/', include('orders.urls')),
     path('api/chat/', include('chat.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+]
+if settings.DEBUG:
+    # Development only, like static() below; in production the web server
+    # serves media and these headers (see orders.images)
+    urlpatterns.append(re_path(r'^media/menu_items/variants/(?P<path>.+)$', serve_variant))
+urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -0,0 +1,149 @@
+"""
+Cached resolution of the user behind a JWT, for REST requests
+(``CachedJWTAuthentication``) and WebSocket connects
+(``orders.middleware.TokenAuthMiddleware``).
+
+Validating a token needs no database access, but simplejwt then loads the
+user on every request. Here users are kept in a per-process LRU of
+``AUTH_USER_CACHE_SIZE`` entries for up to ``AUTH_USER_CACHE_TTL``
+seconds, so a steady stream of requests from the same staff accounts
+makes no auth queries.
+
+Each entry remembers the user's stamp in the shared cache as it was
+before the user was loaded, and a hit is only served while the stamp is
+unchanged. Saving or deleting a user replaces its stamp once the change
+commits (see orders.signals), so every process sharing the cache reloads
+the user on its next request. A hit therefore costs one cache read but
+no query. With a per-process default cache the stamp is only seen by
+the process that made the change, and the TTL bounds how long the
+others serve a deactivated account.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+AUTH_USER_CACHE_SIZE = getattr(settings, 'AUTH_USER_CACHE_SIZE', 1024)
+AUTH_USER_CACHE_TTL = getattr(settings, 'AUTH_USER_CACHE_TTL', 60)
+
+NOT_CACHED = object()
+
+
+class PrincipalCache:
+    """
+    Thread-safe LRU of users by id whose entries expire after ``ttl``
+    seconds, or as soon as they are asked for with a different stamp.
+    """
+
+    def __init__(self, size=AUTH_USER_CACHE_SIZE, ttl=AUTH_USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, stamp=None):
+        """The cached user (``None`` for one known not to exist) or ``NOT_CACHED``."""
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return NOT_CACHED
+            user, expires, cached_stamp = entry
+            if expires < time.monotonic() or cached_stamp != stamp:
+                del self.entries[user_id]
+                return NOT_CACHED
+            self.entries.move_to_end(user_id)
+        # Callers may set attributes on request.user; keep the cached one clean
+        return copy.copy(user)
+
+    def set(self, user_id, user, stamp=None):
+        with self.lock:
+            self.entries[user_id] = (user, time.monotonic() + self.ttl, stamp)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def forget(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+principals = PrincipalCache()
+
+
+def _key(user_id):
+    # Token claims carry ids as given to them; str() matches 7 and '7'
+    return str(user_id)
+
+
+def _stamp_key(user_id):
+    return f'auth:user:{_key(user_id)}:stamp'
+
+
+def cached_user(user_id):
+    """The user for ``user_id`` without touching the database, or ``NOT_CACHED``."""
+    return principals.get(_key(user_id), cache.get(_stamp_key(user_id)))
+
+
+def resolve_user(user_id):
+    """The user for ``user_id`` (``None`` if there is none), loading it on a miss."""
+    stamp = cache.get(_stamp_key(user_id))
+    user = principals.get(_key(user_id), stamp)
+    if user is NOT_CACHED:
+        # Loaded after reading the stamp, so a change committed since replaces it
+        user = load_user(user_id)
+        principals.set(_key(user_id), user, stamp)
+        user = copy.copy(user)
+    return user
+
+
+def load_user(user_id):
+    return get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+
+
+def forget_user(user):
+    """Make every process reload ``user``; call once a change is committed."""
+    user_id = getattr(user, api_settings.USER_ID_FIELD)
+    # Outlives any entry stored under the stamp it replaces
+    cache.set(_stamp_key(user_id), uuid4().hex, AUTH_USER_CACHE_TTL)
+    principals.forget(_key(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """``JWTAuthentication`` that resolves users through the principal cache."""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        user = resolve_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(
+                api_settings.REVOKE_TOKEN_CLAIM
+            ) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(
+                    _("The user's password has been changed."), code="password_changed"
+                )
+
+        return user
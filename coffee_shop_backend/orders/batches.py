@@ -0,0 +1,43 @@
+"""
+Work collected over one transaction and done once it commits.
+
+``collect`` adds to the current transaction's batch of a given name and,
+the first time, schedules the batch's flush with ``on_commit``. The
+connection keeps only a weak reference to the batch; the strong one is
+held by the scheduled callback. When a rollback (of the transaction, or
+of the savepoint the batch was started in) discards that callback, the
+batch is freed with it, so nothing recorded in a rolled-back transaction
+leaks into the next one.
+"""
+import weakref
+
+from django.db import transaction
+
+
+class Batch(dict):
+    """A dict that can be weakly referenced"""
+
+
+def collect(name, add, flush, using=None):
+    """
+    Call ``add(batch)`` on the current transaction's batch ``name``, and
+    ``flush(batch)`` once that transaction commits (at once outside one).
+    """
+    db = transaction.get_connection(using)
+    ref = db.__dict__.get(name)
+    batch = ref() if ref is not None else None
+    if batch is not None:
+        add(batch)
+        return
+
+    batch = Batch()
+    add(batch)
+    ref = db.__dict__[name] = weakref.ref(batch)
+
+    def run():
+        # Changes made from now on belong to a new batch
+        if db.__dict__.get(name) is ref:
+            del db.__dict__[name]
+        flush(batch)
+
+    transaction.on_commit(run, using=using)
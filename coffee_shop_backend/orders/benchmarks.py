@@ -0,0 +1,261 @@
+"""
+Micro-benchmarks run by ``python manage.py benchmark``.
+
+Each benchmark is a function registered with :func:`benchmark`. It receives
+a ``report(label, value)`` callable and any fixtures it creates are rolled
+back by the command, so running them against a dev database is safe.
+"""
+import time
+from decimal import Decimal
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def timed(func, repeat=1):
+    """Best wall time of ``repeat`` runs of ``func``, in milliseconds."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def make_orders(count, lines=2):
+    """Bulk insert ``count`` orders with ``lines`` lines each."""
+    from .models import Category, MenuItem, Order, OrderItem, Table
+
+    category = Category.objects.create(name='Benchmark')
+    menu_items = MenuItem.objects.bulk_create([
+        MenuItem(name=f'Bench item {i}', description='', price=Decimal('3.20'), category=category)
+        for i in range(lines)
+    ])
+    table, _ = Table.objects.get_or_create(table_number=9999, defaults={'is_occupied': True})
+    orders = Order.objects.bulk_create([
+        Order(table=table, status='paid', total_amount=Decimal('3.20') * lines)
+        for _ in range(count)
+    ])
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, menu_item=menu_item, quantity=1,
+                  unit_price=menu_item.price, subtotal=menu_item.price)
+        for order in orders
+        for menu_item in menu_items
+    ])
+    return orders
+
+
+@benchmark('pagination')
+def pagination_benchmark(report, orders=20000, page_size=50):
+    """Compare keyset cursor pages of /api/orders/ with OFFSET paging at increasing depth."""
+    from django.contrib.auth.models import User
+    from rest_framework.test import force_authenticate
+
+    from .models import Order
+    from .pagination import KeysetCursorPagination
+    from .views import OrderViewSet
+
+    make_orders(orders, lines=1)
+    user = User.objects.create_user('benchmark-pagination')
+    view = OrderViewSet.as_view({'get': 'list'})
+    factory = APIRequestFactory()
+
+    url = f'/api/orders/?page_size={page_size}'
+    pages = orders // page_size
+    checkpoints = {0, pages // 2, pages - 1}
+    for page in range(pages):
+        request = factory.get(url)
+        force_authenticate(request, user=user)
+        if page in checkpoints:
+            with CaptureQueriesContext(connection) as queries:
+                elapsed = timed(lambda: view(request).data)
+            report(f'GET keyset page {page}', f'{elapsed:.2f} ms, {len(queries)} queries')
+        url = view(request).data['next']
+
+    # The same comparison without serialization, on the raw page query
+    queryset = Order.objects.order_by('-created_at', '-id')
+    paginator = KeysetCursorPagination()
+    paginator.ordering = ('-created_at', '-id')
+    for offset in sorted(page * page_size for page in checkpoints):
+        if offset:
+            anchor = queryset[offset - 1]
+            position = paginator._get_position_from_instance(anchor, paginator.ordering)
+            keyset = queryset.filter(paginator._after(position, reverse=False))
+        else:
+            keyset = queryset
+        keyset_ms = timed(lambda: list(keyset[:page_size + 1]), repeat=5)
+        offset_ms = timed(lambda: list(queryset[offset:offset + page_size + 1]), repeat=5)
+        report(f'rows at depth {offset}', f'keyset {keyset_ms:.2f} ms, OFFSET {offset_ms:.2f} ms')
+
+
+@benchmark('channel_layer')
+def channel_layer_benchmark(report, subscribers=50, messages=200):
+    """Group fan-out throughput of the SQLite channel layer against the in-memory one."""
+    import asyncio
+    import tempfile
+
+    from channels.layers import InMemoryChannelLayer
+
+    from coffee_shop_backend.layers import SQLiteChannelLayer
+
+    async def fan_out(layer):
+        channels = [await layer.new_channel() for _ in range(subscribers)]
+        for channel in channels:
+            await layer.group_add('benchmark', channel)
+
+        async def drain(channel):
+            for _ in range(messages):
+                await layer.receive(channel)
+
+        started = time.perf_counter()
+        readers = asyncio.gather(*(drain(channel) for channel in channels))
+        for i in range(messages):
+            await layer.group_send('benchmark', {'type': 'order.update', 'seq': i})
+            # Stay under the per-channel capacity like a real stream would
+            await asyncio.sleep(0)
+        await readers
+        elapsed = time.perf_counter() - started
+        await layer.close()
+        return elapsed
+
+    with tempfile.TemporaryDirectory() as directory:
+        layers = {
+            'in-memory': InMemoryChannelLayer(capacity=messages),
+            'sqlite': SQLiteChannelLayer(f'{directory}/channels.sqlite3', capacity=messages),
+        }
+        for label, layer in layers.items():
+            elapsed = asyncio.run(fan_out(layer))
+            delivered = subscribers * messages
+            report(
+                f'{label} {messages} group sends to {subscribers} subscribers',
+                f'{elapsed * 1000:.0f} ms, {delivered / elapsed:,.0f} deliveries/s',
+            )
+
+
+@benchmark('framing')
+def framing_benchmark(report, events=200):
+    """CPU per event fan-out and frame size: JSON per socket against encode-once JSON and MessagePack."""
+    import json
+
+    from . import events as order_events
+    from .framing import encode, encode_frames
+    from .models import Order
+    from .serializers import OrderSerializer
+
+    order = Order.objects.with_details().get(pk=make_orders(1, lines=3)[0].pk)
+    message = order_events.as_message(1, 'order_update', OrderSerializer(order).data)
+
+    def cpu(func):
+        started = time.process_time()
+        for _ in range(events):
+            func()
+        return (time.process_time() - started) / events * 1000
+
+    for subscribers in (100, 1000):
+        per_socket = cpu(lambda: [json.dumps(message) for _ in range(subscribers)])
+        shared = cpu(lambda: [frames['json'] for frames in [encode_frames(message)] for _ in range(subscribers)])
+        report(
+            f'{subscribers} subscribers, CPU per event',
+            f'JSON per socket {per_socket:.3f} ms, encoded once {shared:.3f} ms',
+        )
+
+    json_bytes = len(encode(message, 'json').encode())
+    msgpack_bytes = len(encode(message, 'msgpack'))
+    report('bytes per frame', f'JSON {json_bytes}, MessagePack {msgpack_bytes}')
+    for subscribers in (100, 1000):
+        report(
+            f'{subscribers} subscribers, bytes on the wire per event',
+            f'JSON {json_bytes * subscribers:,}, MessagePack {msgpack_bytes * subscribers:,}',
+        )
+
+
+@benchmark('order_serializer')
+def order_serializer_benchmark(report, orders=500, lines=3):
+    """Per-order cost of OrderSerializer against OrderReadSerializer, from instances and from rows."""
+    from .models import Order
+    from .serializers import OrderReadSerializer, OrderSerializer
+
+    ids = [order.pk for order in make_orders(orders, lines=lines)]
+    queryset = Order.objects.filter(pk__in=ids).order_by('-created_at', '-id')
+    instances = list(queryset.with_details())
+
+    def per_order(func):
+        return timed(func, repeat=5) * 1000 / orders
+
+    drf = per_order(lambda: OrderSerializer(instances, many=True).data)
+    fast = per_order(lambda: OrderReadSerializer(instances, many=True).data)
+    report(f'serialize, {lines} lines per order', f'OrderSerializer {drf:.1f} µs, OrderReadSerializer {fast:.1f} µs ({drf / fast:.1f}x)')
+
+    drf = per_order(lambda: OrderSerializer(list(queryset.with_details()), many=True).data)
+    fast = per_order(lambda: OrderReadSerializer(list(queryset.with_details()), many=True).data)
+    rows = per_order(lambda: OrderReadSerializer.from_queryset(queryset))
+    report('load and serialize', f'OrderSerializer {drf:.1f} µs, instances {fast:.1f} µs, rows {rows:.1f} µs')
+
+
+@benchmark('api_render')
+def api_render_benchmark(report, orders=200, menu_items=100, repeat=200):
+    """p50/p99 render time and body size of /api/orders/ and /api/menu-items/ per renderer and coding."""
+    from django.contrib.auth.models import User
+    from rest_framework.renderers import JSONRenderer
+    from rest_framework.test import force_authenticate
+
+    from coffee_shop_backend import compression
+    from coffee_shop_backend.fastjson import FastJSONRenderer
+
+    from .loadtest import percentile
+    from .models import Category, MenuItem
+    from .views import MenuItemViewSet, OrderViewSet
+
+    make_orders(orders, lines=3)
+    category = Category.objects.create(name='Benchmark menu')
+    MenuItem.objects.bulk_create([
+        MenuItem(name=f'Menu item {i}', description='Steamed milk, double shot, cinnamon',
+                 price=Decimal('4.10'), category=category)
+        for i in range(menu_items)
+    ])
+    user = User.objects.create_user('benchmark-render')
+    factory = APIRequestFactory()
+
+    request = factory.get(f'/api/orders/?page_size={orders}')
+    force_authenticate(request, user=user)
+    order_page = OrderViewSet.as_view({'get': 'list'})(request).data
+    # The menu listing view answers from its cache of rendered bytes, so
+    # serialize its rows directly
+    request = factory.get('/api/menu-items/')
+    menu = MenuItemViewSet.serializer_class(
+        MenuItem.objects.select_related('category'), many=True, context={'request': request}
+    ).data
+
+    endpoints = {
+        f'/api/orders/ ({orders} orders)': order_page,
+        f'/api/menu-items/ ({menu_items} items)': menu,
+    }
+    for label, payload in endpoints.items():
+        for renderer in (JSONRenderer(), FastJSONRenderer()):
+            times = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                body = renderer.render(payload)
+                times.append((time.perf_counter() - started) * 1000)
+            report(
+                f'{label} {type(renderer).__name__}',
+                f'p50 {percentile(times, 0.5):.3f} ms, p99 {percentile(times, 0.99):.3f} ms',
+            )
+        sizes = [f'identity {len(body):,}']
+        for encoding in ('gzip', 'br'):
+            if encoding in compression.available_encodings():
+                compressed = compression.compress(body, encoding)
+                ms = timed(lambda: compression.compress(body, encoding), repeat=20)
+                sizes.append(f'{encoding} {len(compressed):,} ({ms:.2f} ms)')
+        report(f'{label} bytes', ', '.join(sizes))
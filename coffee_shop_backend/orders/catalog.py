@@ -0,0 +1,92 @@
+"""
+Rendered-response cache for the public menu catalog.
+
+Menu and category listings are cached as rendered bytes under a key that
+includes a catalog version. Saving or deleting any MenuItem or Category
+replaces the version (see orders.signals), which orphans every cached
+listing at once. Each cached body carries a strong ETag, so clients that
+revalidate with If-None-Match get a 304 straight from the cache without
+touching the database.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.connection import ConnectionProxy
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_CACHE_TIMEOUT = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# Shared by every worker on the box; see settings.CACHES
+cache = ConnectionProxy(caches, 'catalog')
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # A random token rather than a counter, so an evicted version can
+        # never come back and resurrect listings cached under it
+        cache.add(CATALOG_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    cache.set(CATALOG_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def catalog_cache_key(request):
+    # Absolute image URLs depend on the scheme and host the client used
+    parts = [
+        get_catalog_version(),
+        request.scheme,
+        request.get_host(),
+        request.get_full_path(),
+        request.accepted_media_type,
+    ]
+    digest = hashlib.sha256('|'.join(parts).encode()).hexdigest()
+    return f'catalog:response:{digest}'
+
+
+class CachedCatalogMixin:
+    """Serve ``list`` from the catalog cache; other actions are untouched."""
+
+    def list(self, request, *args, **kwargs):
+        # orders.conditional imports this module
+        from .conditional import etag_matches
+
+        # The browsable API needs the live Response to render, so only the
+        # JSON representation is cached
+        if request.accepted_renderer.format != 'json':
+            return super().list(request, *args, **kwargs)
+
+        key = catalog_cache_key(request)
+        cached = cache.get(key)
+        if cached is None:
+            response = super().list(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            body = request.accepted_renderer.render(
+                response.data, request.accepted_media_type, self.get_renderer_context()
+            )
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+            renderer = request.accepted_renderer
+            content_type = renderer.media_type
+            if renderer.charset:
+                content_type = f'{content_type}; charset={renderer.charset}'
+            cached = (etag, content_type, body)
+            cache.set(key, cached, CATALOG_CACHE_TIMEOUT)
+
+        etag, content_type, body = cached
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and etag_matches(if_none_match, etag):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type=content_type)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        patch_vary_headers(response, ['Accept'])
+        return response
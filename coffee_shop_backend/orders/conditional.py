@@ -0,0 +1,109 @@
+"""
+Conditional GET for single orders (``retrieve`` and ``track``).
+
+An order's representation changes when the order row is saved, when its
+lines change (which touches ``updated_at``, see orders.signals) and when
+a menu item it contains is renamed (which moves the catalog version).
+The ETag hashes those together with the request's query string (sparse
+fieldsets shape the body) and the negotiated media type.
+
+``updated_at`` is kept in the cache under ``order:version:<id>`` and
+overwritten when a change commits, so a client revalidating an unchanged
+order gets its 304 from one cache read, without a query or the
+serializer. Writers always overwrite rather than delete the entry, so a
+reader that loaded the old value just before a commit cannot put it
+back afterwards.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from rest_framework.response import Response
+
+from .catalog import get_catalog_version
+
+ORDER_VERSION_TIMEOUT = getattr(settings, 'ORDER_VERSION_TIMEOUT', 60 * 60 * 24)
+
+
+def order_version_key(order_id):
+    return f'order:version:{order_id}'
+
+
+def get_order_version(order_id):
+    """``updated_at`` of the order, or None when there is no such order."""
+    from .models import Order
+
+    key = order_version_key(order_id)
+    updated_at = cache.get(key)
+    if updated_at is None:
+        updated_at = Order.objects.filter(pk=order_id).values_list('updated_at', flat=True).first()
+        if updated_at is None:
+            return None
+        # add, not set: never replace a value a committed change just wrote
+        cache.add(key, updated_at, ORDER_VERSION_TIMEOUT)
+    return updated_at
+
+
+def set_order_version(order_id, updated_at):
+    cache.set(order_version_key(order_id), updated_at, ORDER_VERSION_TIMEOUT)
+
+
+def validators(request, order_id):
+    """``(etag, last_modified)`` for the order, or None when there is no such order."""
+    if not str(order_id).isdigit():
+        return None
+    updated_at = get_order_version(order_id)
+    if updated_at is None:
+        return None
+    parts = [
+        str(order_id),
+        updated_at.isoformat(),
+        get_catalog_version(),
+        request.META.get('QUERY_STRING', ''),
+        request.accepted_media_type,
+    ]
+    etag = '"%s"' % hashlib.sha256('|'.join(parts).encode()).hexdigest()[:32]
+    return etag, int(updated_at.timestamp())
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Whether an If-None-Match header matches ``etag``. The comparison is
+    weak: CompressionMiddleware sends compressed bodies as W/"...".
+    """
+    return if_none_match.strip() == '*' or etag in [
+        tag.removeprefix('W/') for tag in parse_etags(if_none_match)
+    ]
+
+
+def is_not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # Clients may keep the body but must revalidate before using it
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+class ConditionalOrderMixin:
+    """Answer ``retrieve``-style actions with a 304 when the client's copy is current."""
+
+    def conditional_response(self, request, render):
+        """``render()``'s Response with validators, or a 304 without calling it."""
+        # Read before rendering: a change racing with the render then
+        # makes the ETag stale, never the body
+        current = validators(request, self.kwargs[self.lookup_url_kwarg or self.lookup_field])
+        if current is None:
+            return Response(render())
+        if is_not_modified(request, *current):
+            return set_validators(HttpResponseNotModified(), *current)
+        return set_validators(Response(render()), *current)
@@ -1,11 +1,17 @@
 import json
 import logging
+from collections import deque
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.dateparse import parse_datetime
+from . import events
+from coffee_shop_backend import fastjson
+from .framing import FramedConsumerMixin
+from .outbound import OutboundQueueMixin
 from .models import Order
 from chat.models import ChatMessage
-from .serializers import OrderSerializer
+from .serializers import OrderReadSerializer
 from django.db import transaction
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth import get_user_model
@@ -14,84 +20,162 @@ from urllib.parse import parse_qs
 
 logger = logging.getLogger(__name__)
 
-class MenuOrdersConsumer(AsyncWebsocketConsumer):
+# Sent when a stream filter names a status, table or category that cannot exist
+CLOSE_BAD_FILTER = 4000
+
+class OrderStreamMixin:
+    """
+    Catch a client up once it has joined an order group: the events it
+    missed since ``?since=<seq>`` while the server still has them, or else
+    a snapshot of the open orders. Live events the catch-up already
+    covered are dropped.
+
+    ``?status=``, ``?table=`` and ``?category=`` (comma separated or
+    repeated) narrow the stream to matching orders. Instead of
+    ``stream_group`` the consumer then joins the finer groups of the first
+    of those it was given (see events.route_groups) and checks the others
+    itself; an event reaching it through two groups is sent once. A value
+    no order can have closes the socket with ``CLOSE_BAD_FILTER`` rather
+    than leaving it in no group at all.
+    """
+    stream_group = None
+    seq = 0
+    filters = None
+
+    def query_params(self):
+        return parse_qs(self.scope.get('query_string', b'').decode())
+
+    def parse_filters(self):
+        """The requested filters by dimension; ValueError if a value is invalid."""
+        query = self.query_params()
+        valid = {
+            'status': lambda value: value in dict(Order.STATUS_CHOICES),
+            'table': str.isdigit,
+            'category': str.isdigit,
+        }
+        filters = {}
+        for dimension in events.ROUTE_DIMENSIONS:
+            if dimension not in query:
+                continue
+            values = {value for param in query[dimension] for value in param.split(',') if value}
+            invalid = sorted(value for value in values if not valid[dimension](value))
+            if invalid or not values:
+                raise ValueError(f"Invalid {dimension} filter: {', '.join(invalid)}")
+            filters[dimension] = values
+        return filters
+
+    async def join_stream(self):
+        """Join the stream's groups; False once the socket was closed for bad filters."""
+        try:
+            self.filters = self.parse_filters()
+        except ValueError as e:
+            logger.warning(f"Rejecting order stream: {str(e)}")
+            await self.accept()
+            await self.close(code=CLOSE_BAD_FILTER)
+            return False
+        self.recent_seqs = deque(maxlen=64)
+        if self.filters:
+            dimension = next(iter(self.filters))
+            self.stream_groups = [
+                events.route_group(dimension, value) for value in sorted(self.filters[dimension])
+            ]
+        else:
+            self.stream_groups = [self.stream_group]
+        for group in self.stream_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        return True
+
+    async def leave_stream(self):
+        for group in getattr(self, 'stream_groups', ()):
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def send_catch_up(self):
+        try:
+            since = int(self.query_params()['since'][0])
+        except (KeyError, ValueError):
+            since = None
+        messages, self.seq = await self.get_catch_up(since)
+        for message in messages:
+            await self.send_message(message)
+
+    @database_sync_to_async
+    def get_catch_up(self, since):
+        if since is not None:
+            missed = events.catch_up(since, self.filters)
+            if missed is not None:
+                return missed, max([since] + [message['seq'] for message in missed])
+        orders, seq = events.snapshot(self.filters)
+        return [{'type': 'initial_orders', 'orders': orders, 'seq': seq}], seq
+
+    async def send_order_event(self, event):
+        if event['seq'] <= self.seq or event['seq'] in self.recent_seqs:
+            return
+        if self.filters and not events.matches(event.get('routes'), self.filters):
+            return
+        self.recent_seqs.append(event['seq'])
+        if 'frames' in event:
+            await self.send_frames(event['frames'])
+        else:
+            await self.send_message(events.as_message(event['seq'], event['type'], event['order']))
+
+class MenuOrdersConsumer(OrderStreamMixin, OutboundQueueMixin, FramedConsumerMixin, AsyncWebsocketConsumer):
+    stream_group = "menu_orders"
+
     async def connect(self):
         try:
-            # Join the menu orders group
-            await self.channel_layer.group_add("menu_orders", self.channel_name)
+            # Join the menu orders group (or the filtered ones)
+            if not await self.join_stream():
+                return
             await self.accept()
             logger.info("Client connected to menu orders WebSocket")
-            
-            # Send initial orders data
-            orders = await self.get_all_orders()
-            await self.send(text_data=json.dumps({
-                'type': 'initial_orders',
-                'orders': orders
-            }))
+            await self.send_catch_up()
         except Exception as e:
             logger.error(f"Error in menu connect: {str(e)}")
             await self.close()
 
     async def disconnect(self, close_code):
         try:
-            await self.channel_layer.group_discard("menu_orders", self.channel_name)
+            await self.leave_stream()
             logger.info(f"Client disconnected from menu orders WebSocket with code: {close_code}")
         except Exception as e:
             logger.error(f"Error in menu disconnect: {str(e)}")
 
     async def receive(self, text_data):
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = fastjson.loads(text_data)
             message_type = text_data_json.get('type')
             
             if message_type == 'create_order':
                 # Handle new order creation from menu
                 order_data = text_data_json.get('order')
-                new_order = await self.create_order(order_data)
-                if new_order:
-                    serialized_order = await self.serialize_order(new_order)
-                    await self.broadcast_new_order(serialized_order)
+                # orders.events announces it to every group once committed
+                await self.create_order(order_data)
             
         except json.JSONDecodeError:
             logger.error("Invalid JSON format received in menu")
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'error',
                 'message': 'Invalid JSON format'
-            }))
+            })
         except Exception as e:
             logger.error(f"Error in menu receive: {str(e)}")
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'error',
                 'message': str(e)
-            }))
+            })
 
     async def order_update(self, event):
         try:
-            await self.send(text_data=json.dumps({
-                'type': 'order_update',
-                'order': event['order']
-            }))
+            await self.send_order_event(event)
         except Exception as e:
             logger.error(f"Error in menu order_update: {str(e)}")
 
     async def new_order(self, event):
         try:
-            await self.send(text_data=json.dumps({
-                'type': 'new_order',
-                'order': event['order']
-            }))
+            await self.send_order_event(event)
         except Exception as e:
             logger.error(f"Error in menu new_order: {str(e)}")
 
-    @database_sync_to_async
-    def get_all_orders(self):
-        try:
-            orders = Order.objects.all().order_by('-created_at')[:50]
-            return OrderSerializer(orders, many=True).data
-        except Exception as e:
-            logger.error(f"Error getting menu orders: {str(e)}")
-            return []
-
     @database_sync_to_async
     def create_order(self, order_data):
         try:
@@ -101,50 +185,23 @@ class MenuOrdersConsumer(AsyncWebsocketConsumer):
             logger.error(f"Error creating order: {str(e)}")
             raise
 
-    @database_sync_to_async
-    def serialize_order(self, order):
-        return OrderSerializer(order).data
-
-    async def broadcast_new_order(self, order_data):
-        await self.channel_layer.group_send(
-            "menu_orders",
-            {
-                "type": "new_order",
-                "order": order_data
-            }
-        )
-        # Also broadcast to the orders group for admin
-        await self.channel_layer.group_send(
-            "orders",
-            {
-                "type": "new_order",
-                "order": order_data
-            }
-        )
-
-class OrderConsumer(AsyncWebsocketConsumer):
+class OrderConsumer(OrderStreamMixin, OutboundQueueMixin, FramedConsumerMixin, AsyncWebsocketConsumer):
+    stream_group = "orders"
+
     async def connect(self):
-        await self.channel_layer.group_add("orders", self.channel_name)
+        if not await self.join_stream():
+            return
         await self.accept()
         
-        # Send initial orders
-        orders = await self.get_orders()
-        await self.send(text_data=json.dumps({
-            'type': 'initial_orders',
-            'orders': orders
-        }))
+        # Send what the client missed, or the open orders
+        await self.send_catch_up()
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard("orders", self.channel_name)
-
-    @database_sync_to_async
-    def get_orders(self):
-        orders = Order.objects.all().order_by('-created_at')
-        return OrderSerializer(orders, many=True).data
+        await self.leave_stream()
 
     async def receive(self, text_data):
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = fastjson.loads(text_data)
             message_type = text_data_json.get('type')
             
             if message_type == 'order_update':
@@ -161,29 +218,51 @@ class OrderConsumer(AsyncWebsocketConsumer):
                 )
                 
         except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'error',
                 'message': 'Invalid JSON format'
-            }))
+            })
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_message({
                 'type': 'error',
                 'message': str(e)
-            }))
+            })
 
     async def order_message(self, event):
         message = event['message']
-        await self.send(text_data=json.dumps(message))
+        await self.send_message(message)
+
+    async def new_order(self, event):
+        await self.send_order_event(event)
+
+    async def order_update(self, event):
+        await self.send_order_event(event)
+
+class OrderTrackingConsumer(OutboundQueueMixin, FramedConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Live status of one order. The database is read on connect and on an
+    explicit ``get_status``; updates are forwarded straight from the event
+    payload, skipping any older than the state this client already has.
+    """
+    updated_at = None
 
-class OrderTrackingConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def get_order(self, order_id):
         try:
-            order = Order.objects.get(id=order_id)
-            return OrderSerializer(order).data
+            order = Order.objects.with_details().get(id=order_id)
+            return OrderReadSerializer(order).data
         except Order.DoesNotExist:
             return None
 
+    def is_stale(self, order_data):
+        updated_at = parse_datetime(order_data.get('updated_at') or '')
+        if updated_at is None:
+            return False
+        if self.updated_at is not None and updated_at < self.updated_at:
+            return True
+        self.updated_at = updated_at
+        return False
+
     async def connect(self):
         try:
             self.order_id = self.scope['url_route']['kwargs']['order_id']
@@ -205,10 +284,11 @@ class OrderTrackingConsumer(AsyncWebsocketConsumer):
             await self.accept()
             
             # Send initial order data
-            await self.send(text_data=json.dumps({
+            self.is_stale(order_data)
+            await self.send_message({
                 'type': 'order_update',
                 'order': order_data
-            }))
+            })
             
             logger.info(f"Client connected to order tracking WebSocket for order {self.order_id}")
 
@@ -228,27 +308,32 @@ class OrderTrackingConsumer(AsyncWebsocketConsumer):
 
     async def receive(self, text_data):
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = fastjson.loads(text_data)
             message_type = text_data_json.get('type')
             
             if message_type == 'get_status':
                 order_data = await self.get_order(self.order_id)
                 if order_data:
-                    await self.send(text_data=json.dumps({
+                    self.is_stale(order_data)
+                    await self.send_message({
                         'type': 'order_update',
                         'order': order_data
-                    }))
+                    })
 
         except Exception as e:
             logger.error(f"Error in receive: {str(e)}")
 
     async def order_update(self, event):
         try:
-            order_data = await self.get_order(self.order_id)
-            if order_data:
-                await self.send(text_data=json.dumps({
-                    'type': 'order_update',
-                    'order': order_data
-                }))
+            if self.is_stale(event['order']):
+                return
+            if event['type'] == 'order_update' and 'frames' in event:
+                await self.send_frames(event['frames'])
+            else:
+                # Trackers only know order_update messages
+                await self.send_message(events.as_message(event['seq'], 'order_update', event['order']))
         except Exception as e:
             logger.error(f"Error in order_update: {str(e)}")
+
+    async def new_order(self, event):
+        await self.order_update(event)
@@ -0,0 +1,303 @@
+"""
+Post-commit dispatch of order changes to WebSocket groups.
+
+``order_changed`` only records the order's id in the current
+transaction's batch (see orders.batches). Once the transaction commits, every order recorded during it
+is loaded once (conditional updates hand over the order they reloaded,
+see orders.signals), serialized once and sent as a single event to each
+group that follows orders, however many times it was saved in between:
+
+    {"type": "new_order" | "order_update", "order": {...OrderReadSerializer...}}
+
+The kitchen (``orders``), menu (``menu_orders``) and tracking
+(``order_<id>``) consumers all receive that same payload. Loading and
+recording run on a background thread, and so does sending, except with
+the in-memory channel layer, whose sends are scheduled on the server's
+event loop. Request latency includes neither.
+
+Each event is also sent to one group per value it can be filtered on
+(``route_groups``): ``orders.status.<status>`` for its new status and
+the one it left, ``orders.table.<table id>`` and
+``orders.category.<category id>`` for every category on the order.
+Screens that subscribe with filters join only those groups, so their
+traffic grows with the orders they show rather than with all orders.
+
+Every event is also written to ``OrderEvent`` and carries its id as
+``seq``. At least the newest ``ORDER_EVENT_BUFFER`` events are kept
+(older ones are pruned in batches, in the transaction that records new
+ones), so a client that reconnects with the last seq it saw can be sent
+just the events it missed (``catch_up``); one that has been away longer
+gets a bounded snapshot of the open orders instead (``snapshot``).
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import SyncToAsync, async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from django.db.models import Max, Min
+
+from . import batches
+from .framing import encode_frames
+from .models import Order
+
+logger = logging.getLogger(__name__)
+
+ORDER_GROUPS = ('orders', 'menu_orders')
+# What order streams can be filtered on, in the order consumers prefer to
+# subscribe by
+ROUTE_DIMENSIONS = ('status', 'table', 'category')
+ORDER_EVENT_BUFFER = getattr(settings, 'ORDER_EVENT_BUFFER', 1000)
+ORDER_SNAPSHOT_LIMIT = getattr(settings, 'ORDER_SNAPSHOT_LIMIT', 200)
+# The buffer is trimmed once per this many events, so it holds up to
+# ORDER_EVENT_BUFFER + ORDER_EVENT_PRUNE_EVERY of them
+ORDER_EVENT_PRUNE_EVERY = getattr(settings, 'ORDER_EVENT_PRUNE_EVERY', 100)
+ORDER_EVENT_WRITE_ATTEMPTS = 5
+# Orders no screen needs to act on any more
+CLOSED_STATUSES = Order.FINAL_STATUSES
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='order-events')
+
+
+def order_groups(order_id):
+    return (*ORDER_GROUPS, f'order_{order_id}')
+
+
+def route_group(dimension, value):
+    return f'orders.{dimension}.{value}'
+
+
+def routes_for(order, previous_status=None):
+    """The values ``order``'s event can be filtered on, by dimension, as strings."""
+    statuses = [order.status]
+    if previous_status and previous_status != order.status:
+        statuses.append(previous_status)
+    return {
+        'status': statuses,
+        'table': [str(order.table_id)],
+        'category': sorted({
+            str(item.menu_item.category_id) for item in order.orderitem_set.all()
+        }),
+    }
+
+
+def route_groups(routes):
+    return [
+        route_group(dimension, value)
+        for dimension, values in routes.items()
+        for value in values
+    ]
+
+
+def matches(routes, filters):
+    """Whether an event with ``routes`` passes every dimension of ``filters``."""
+    if not routes:
+        # Recorded before events carried routes
+        return True
+    return all(
+        filters[dimension].intersection(routes.get(dimension, ()))
+        for dimension in filters
+    )
+
+
+def order_changed(order, created=False, previous_status=None):
+    """Publish ``order`` once the current transaction commits."""
+    def add(batch):
+        # An order created and then updated in one transaction is still
+        # new, and screens filtering on the status it had before the
+        # transaction must hear that it left
+        was_created, left = batch.get(order.pk, (False, previous_status))
+        batch[order.pk] = (was_created or created, left)
+
+    batches.collect('order_events', add, _flush)
+
+
+def _flush(batch):
+    changes = {order_id: created for order_id, (created, _) in batch.items()}
+    previous_statuses = {order_id: left for order_id, (_, left) in batch.items()}
+    dispatch(changes, previous_statuses)
+
+
+def dispatch(changes, previous_statuses=None, orders=None):
+    """
+    ``publish`` on the background thread, or here when there is no one to
+    hand the fan-out to (see ``_in_background``). Call it once the changes
+    have committed.
+    """
+    if _in_background():
+        _executor.submit(_publish_in_background, changes, previous_statuses, _fan_out_loop(), orders)
+    else:
+        publish(changes, previous_statuses, orders=orders)
+
+
+def _server_loop():
+    """
+    The ASGI server's event loop when called from one of its sync threads
+    (a view, or database_sync_to_async), else None
+    """
+    loop = getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
+    return loop if loop is not None and loop.is_running() else None
+
+
+def _fan_out_loop():
+    # The in-memory layer's queues belong to the server's event loop and
+    # must be fed there; other layers can be sent to from any thread
+    if isinstance(get_channel_layer(), InMemoryChannelLayer):
+        return _server_loop()
+    return None
+
+
+def _in_background():
+    configured = getattr(settings, 'ORDER_EVENTS_ASYNC', None)
+    if configured is not None:
+        return configured
+    # Without a server loop (a shell, a management command) there is no
+    # in-memory listener to hand the fan-out to, so publish inline
+    return not isinstance(get_channel_layer(), InMemoryChannelLayer) or _server_loop() is not None
+
+
+def publish(changes, previous_statuses=None, loop=None, orders=None):
+    """
+    Send one event per order for ``changes``, a {order id: created} dict;
+    ``previous_statuses`` maps ids to the status each order had before.
+    ``orders`` already loaded with their details are not loaded again.
+    With ``loop``, the group sends are scheduled on it rather than made
+    here.
+    """
+    from .models import OrderEvent
+    from .serializers import OrderReadSerializer
+
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    loaded = {order.pk: order for order in orders or ()}
+    missing = [order_id for order_id in changes if order_id not in loaded]
+    if missing:
+        # Orders created inside a transaction that was rolled back are simply gone
+        loaded.update(Order.objects.with_details().in_bulk(missing))
+    previous_statuses = previous_statuses or {}
+    records = _record([
+        OrderEvent(
+            order_id=order_id,
+            kind='new_order' if changes[order_id] else 'order_update',
+            payload=OrderReadSerializer(loaded[order_id]).data,
+            routes=routes_for(loaded[order_id], previous_statuses.get(order_id)),
+        )
+        for order_id in changes
+        if order_id in loaded
+    ])
+
+    deliveries = []
+    for record in records:
+        message = as_message(record.pk, record.kind, record.payload)
+        # Encoded here once; consumers send these bytes to every socket
+        event = {**message, 'frames': encode_frames(message), 'routes': record.routes}
+        deliveries.extend(
+            (record.order_id, group, event)
+            for group in [*order_groups(record.order_id), *route_groups(record.routes)]
+        )
+    if not deliveries:
+        return
+    if loop is not None:
+        asyncio.run_coroutine_threadsafe(_send_all(channel_layer, deliveries), loop)
+    else:
+        async_to_sync(_send_all)(channel_layer, deliveries)
+
+
+def _record(records):
+    """
+    Insert ``records`` and, every ``ORDER_EVENT_PRUNE_EVERY`` events, drop
+    the ones older than the buffer, in one write transaction. A write that
+    finds the database locked is retried rather than losing the events.
+    """
+    from .models import OrderEvent
+
+    if not records:
+        return records
+    for attempt in range(ORDER_EVENT_WRITE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                records = OrderEvent.objects.bulk_create(records)
+                first, last = records[0].pk, records[-1].pk
+                if last // ORDER_EVENT_PRUNE_EVERY > (first - 1) // ORDER_EVENT_PRUNE_EVERY:
+                    OrderEvent.objects.filter(pk__lte=last - ORDER_EVENT_BUFFER).delete()
+            return records
+        except OperationalError as e:
+            if 'locked' not in str(e) or attempt == ORDER_EVENT_WRITE_ATTEMPTS - 1:
+                raise
+            for record in records:
+                record.pk = None
+            time.sleep(0.05 * 2 ** attempt)
+
+
+async def _send_all(channel_layer, deliveries):
+    for order_id, group, event in deliveries:
+        try:
+            await channel_layer.group_send(group, event)
+        except Exception:
+            logger.exception(f"Error broadcasting order {order_id} to {group}")
+
+
+def _publish_in_background(changes, previous_statuses, loop=None, orders=None):
+    try:
+        publish(changes, previous_statuses, loop, orders)
+    except Exception:
+        logger.exception("Error publishing order events")
+    finally:
+        # This thread outlives any request, so nothing else closes its connection
+        connection.close()
+
+
+def as_message(seq, kind, order_data):
+    return {'type': kind, 'order': order_data, 'seq': seq}
+
+
+def catch_up(since, filters=None):
+    """
+    Messages for the events after ``since`` (that pass ``filters``) in
+    order, or None when the buffer no longer reaches back that far and a
+    snapshot is needed.
+    """
+    from .models import OrderEvent
+
+    # Pruning only ever drops the oldest events, so everything after
+    # ``since`` is still here when it reaches the oldest one kept. Ids can
+    # skip values, so the first event after ``since`` proves nothing.
+    bounds = OrderEvent.objects.aggregate(oldest=Min('pk'), latest=Max('pk'))
+    if bounds['oldest'] is None or not bounds['oldest'] - 1 <= since <= bounds['latest']:
+        return None
+    events = (
+        OrderEvent.objects.filter(pk__gt=since).order_by('pk')
+        .values_list('pk', 'kind', 'payload', 'routes')
+    )
+    return [
+        as_message(seq, kind, payload)
+        for seq, kind, payload, routes in events
+        if not filters or matches(routes, filters)
+    ]
+
+
+def snapshot(filters=None):
+    """The newest open orders (that pass ``filters``) and the seq they are current as of."""
+    from .models import OrderEvent, OrderItem
+    from .serializers import OrderReadSerializer
+
+    # Read the seq first: events racing with the query are sent again
+    # rather than lost
+    seq = OrderEvent.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    orders = Order.objects.exclude(status__in=CLOSED_STATUSES)
+    filters = filters or {}
+    if 'status' in filters:
+        orders = orders.filter(status__in=filters['status'])
+    if 'table' in filters:
+        orders = orders.filter(table_id__in=filters['table'])
+    if 'category' in filters:
+        orders = orders.filter(
+            pk__in=OrderItem.objects.filter(menu_item__category_id__in=filters['category'])
+            .values('order_id')
+        )
+    orders = orders.order_by('-created_at', '-id')[:ORDER_SNAPSHOT_LIMIT]
+    return OrderReadSerializer.from_queryset(orders), seq
@@ -0,0 +1,98 @@
+"""
+Sparse fieldsets and expansion for read endpoints.
+
+``?fields=id,status,total_amount`` limits each object to those keys, and
+``?expand=table`` replaces a related id with the related object. Viewsets
+using :class:`FieldsetViewMixin` read the same request when building their
+queryset, so relations nobody asked for are never joined or prefetched:
+a tablet badge asking for three fields costs a single query.
+"""
+from rest_framework.exceptions import ValidationError
+
+
+def parse_names(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+class Fieldset:
+    """The fields (``None`` for all) and expansions one request asked for."""
+
+    def __init__(self, fields=None, expand=()):
+        self.fields = fields
+        self.expand = frozenset(expand)
+
+    def wants(self, name):
+        return self.fields is None or name in self.fields
+
+    def expands(self, name):
+        return name in self.expand and self.wants(name)
+
+    def prune(self, representation):
+        if self.fields is None:
+            return representation
+        return {key: value for key, value in representation.items() if key in self.fields}
+
+
+FULL = Fieldset()
+
+
+class FieldsetViewMixin:
+    """
+    Parse ``?fields=`` and ``?expand=`` for ``fieldset_actions``; other
+    actions (writes included) always get the full representation. The
+    fieldset is handed to serializers through their context.
+    """
+    fieldset_actions = ('list', 'retrieve')
+    # Relations ?expand= may nest in place of their id
+    expandable = ()
+
+    def get_fieldset(self):
+        if not hasattr(self, '_fieldset'):
+            self._fieldset = self.parse_fieldset()
+        return self._fieldset
+
+    def parse_fieldset(self):
+        params = self.request.query_params
+        if self.action not in self.fieldset_actions or not ('fields' in params or 'expand' in params):
+            return FULL
+
+        fields = parse_names(params['fields']) if 'fields' in params else None
+        expand = parse_names(params.get('expand', ''))
+        errors = {}
+        unknown = sorted((fields or set()) - set(self.get_fieldset_names()) - set(self.expandable))
+        if unknown:
+            errors['fields'] = [f"Unknown field(s): {', '.join(unknown)}"]
+        unknown = sorted(expand - set(self.expandable))
+        if unknown:
+            errors['expand'] = [f"Cannot expand: {', '.join(unknown)}"]
+        if errors:
+            raise ValidationError(errors)
+        return Fieldset(fields, expand)
+
+    def get_fieldset_names(self):
+        """Every key the full representation has"""
+        serializer = self.serializer_class()
+        return [name for name, field in serializer.fields.items() if not field.write_only]
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fieldset'] = self.get_fieldset()
+        return context
+
+
+class FieldsetSerializerMixin:
+    """Drop the fields the context's fieldset leaves out and nest expanded relations."""
+    # Name -> callable returning the field that represents the relation nested
+    expansions = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fieldset = self.context.get('fieldset', FULL)
+        if fieldset is FULL:
+            return
+        for name, field in list(self.fields.items()):
+            if not field.write_only and not fieldset.wants(name):
+                del self.fields[name]
+        for name, make_field in self.expansions.items():
+            if fieldset.expands(name):
+                self.fields[name] = make_field()
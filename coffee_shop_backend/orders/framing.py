@@ -0,0 +1,57 @@
+"""
+WebSocket frame encoding shared by the order and chat consumers.
+
+Clients that offer the ``msgpack`` subprotocol get binary MessagePack
+frames (and may send them); everyone else gets JSON text as before.
+Group events carry their client-facing message already encoded in both
+formats (see ``encode_frames``), so fanning an event out encodes it once
+per format instead of once per socket.
+"""
+import msgpack
+
+from coffee_shop_backend import fastjson
+
+SUBPROTOCOL = 'msgpack'
+
+
+def encode(message, encoding):
+    if encoding == 'msgpack':
+        return msgpack.packb(message, use_bin_type=True)
+    return fastjson.dumps(message)
+
+
+def encode_frames(message):
+    """``message`` encoded once for every supported encoding."""
+    return {'json': encode(message, 'json'), 'msgpack': encode(message, 'msgpack')}
+
+
+class FramedConsumerMixin:
+    """Negotiates the encoding on accept and sends every frame in it."""
+    encoding = 'json'
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None and SUBPROTOCOL in self.scope.get('subprotocols', ()):
+            subprotocol = SUBPROTOCOL
+        if subprotocol == SUBPROTOCOL:
+            self.encoding = 'msgpack'
+        await super().accept(subprotocol=subprotocol, headers=headers)
+
+    async def send_message(self, message):
+        await self.send_frame(encode(message, self.encoding))
+
+    async def send_frames(self, frames):
+        """Send this socket's encoding from pre-encoded ``frames``."""
+        await self.send_frame(frames[self.encoding])
+
+    async def send_frame(self, frame):
+        if self.encoding == 'msgpack':
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def websocket_receive(self, message):
+        # Hand binary frames to receive() as the JSON text it expects
+        if message.get('bytes') is not None and self.encoding == 'msgpack':
+            decoded = msgpack.unpackb(message['bytes'], raw=False)
+            message = {'type': message['type'], 'text': fastjson.dumps(decoded)}
+        await super().websocket_receive(message)
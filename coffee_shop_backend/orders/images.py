@@ -0,0 +1,144 @@
+"""
+Resized WebP/JPEG variants of MenuItem.image for responsive menus.
+
+Variants are written next to the originals under ``menu_items/variants/``
+with the hash of the original's bytes in the filename, so a URL never
+changes meaning and can be cached forever (see ``serve_variant``). The
+generated names are recorded in ``MenuItem.image_variants``:
+
+    {"source": "menu_items/latte.jpg",
+     "webp": {"160": "menu_items/variants/latte.3f2a9c1d04b7.160w.webp", ...},
+     "jpeg": {"160": "menu_items/variants/latte.3f2a9c1d04b7.160w.jpg", ...}}
+
+Uploads are processed on a background thread after the transaction
+commits; ``regenerate_menu_images`` rebuilds everything with a process
+pool.
+
+``serve_variant`` is only routed when DEBUG is on, as Django's static
+file view is not meant for production. There the web server serves
+MEDIA_ROOT and should send the same headers for the variants, e.g. with
+nginx:
+
+    location /media/menu_items/variants/ {
+        alias <MEDIA_ROOT>/menu_items/variants/;
+        add_header Cache-Control "public, max-age=31536000, immutable";
+    }
+"""
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.views.static import serve
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+VARIANT_WIDTHS = getattr(settings, 'MENU_IMAGE_WIDTHS', (160, 320, 640))
+VARIANT_DIR = 'menu_items/variants'
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='menu-images')
+
+
+def generate_variants(name):
+    """
+    Write every width/format variant of the stored image ``name`` and
+    return its manifest. Existing files are reused, so this is idempotent.
+    Plain data in and out, so it can run in a worker process.
+    """
+    with default_storage.open(name, 'rb') as original:
+        data = original.read()
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(name))[0]
+
+    source = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    manifest = {'source': name}
+    for key, (pil_format, extension, save_options) in FORMATS.items():
+        manifest[key] = {}
+        for width in variant_widths(source.width):
+            target = f'{VARIANT_DIR}/{stem}.{digest}.{width}w.{extension}'
+            if not default_storage.exists(target):
+                variant = source.copy()
+                # Never wider than the source, so the height needs no bound
+                variant.thumbnail((width, source.height), Image.LANCZOS)
+                if pil_format == 'JPEG' and variant.mode not in ('RGB', 'L'):
+                    variant = variant.convert('RGB')
+                buffer = io.BytesIO()
+                variant.save(buffer, pil_format, **save_options)
+                default_storage.save(target, ContentFile(buffer.getvalue()))
+            manifest[key][str(width)] = target
+    return manifest
+
+
+def variant_widths(source_width):
+    """
+    The configured widths narrower than the source, plus the source's own
+    width in place of the ones it cannot fill: images are never upscaled,
+    and srcset must advertise each variant's real width.
+    """
+    widths = [width for width in VARIANT_WIDTHS if width < source_width]
+    if len(widths) < len(VARIANT_WIDTHS):
+        widths.append(source_width)
+    return widths
+
+
+def store_manifest(menu_item_id, manifest):
+    """Record ``manifest`` unless the item's image changed meanwhile."""
+    from .catalog import bump_catalog_version
+    from .models import MenuItem
+
+    updated = MenuItem.objects.filter(
+        pk=menu_item_id, image=manifest['source']
+    ).update(image_variants=manifest)
+    if updated:
+        bump_catalog_version()
+
+
+def refresh_variants(menu_item_id, name):
+    try:
+        store_manifest(menu_item_id, generate_variants(name))
+    except Exception:
+        logger.exception(f"Error generating image variants for menu item {menu_item_id}")
+
+
+def _refresh_in_background(menu_item_id, name):
+    try:
+        refresh_variants(menu_item_id, name)
+    finally:
+        # This thread outlives any request, so nothing else closes its connection
+        connection.close()
+
+
+def schedule_variants(menu_item):
+    """Queue variant generation for ``menu_item`` if its image changed."""
+    name = menu_item.image.name if menu_item.image else None
+    if not name or (menu_item.image_variants or {}).get('source') == name:
+        return
+    if getattr(settings, 'MENU_IMAGE_ASYNC', True):
+        _executor.submit(_refresh_in_background, menu_item.pk, name)
+    else:
+        refresh_variants(menu_item.pk, name)
+
+
+def srcset(manifest, image_format, build_url):
+    variants = (manifest or {}).get(image_format) or {}
+    return ', '.join(
+        f'{build_url(default_storage.url(name))} {width}w'
+        for width, name in sorted(variants.items(), key=lambda item: int(item[0]))
+    )
+
+
+def serve_variant(request, path):
+    """Serve a content-hashed variant with far-future caching headers (DEBUG only)."""
+    response = serve(request, path, document_root=os.path.join(settings.MEDIA_ROOT, VARIANT_DIR))
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
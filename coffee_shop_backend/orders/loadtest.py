@@ -0,0 +1,206 @@
+"""
+In-process WebSocket load test, run by ``python manage.py socket_load_test``.
+
+Kitchen screens (``/ws/orders/``), tracking tablets (``/ws/order/<id>/``)
+and chat sessions (a customer and a staff socket on ``/ws/chat/<id>/``)
+connect to the project's real ASGI application through channels' test
+communicators, so routing, middleware, consumers, the channel layer and
+the database all take part but no network is used. Status changes are
+then made through the ``update_status`` endpoint at a fixed rate while
+chat messages are sent at another, and every frame each socket receives
+is timestamped.
+
+Latency is measured from just before ``update_status`` is called (or the
+chat message is sent) to the moment each socket receives the event.
+Order events are matched by the order and status they carry (each step
+of ``STATUS_FLOW`` happens once per order), chat messages by their text.
+"""
+import asyncio
+import itertools
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+
+# Each order walks through these, one status change per event
+STATUS_FLOW = ('confirmed', 'preparing', 'ready', 'delivered', 'paid')
+
+
+@dataclass
+class Result:
+    events: int = 0
+    chat_messages: int = 0
+    order_expected: int = 0
+    order_latencies: list = field(default_factory=list)
+    chat_expected: int = 0
+    chat_latencies: list = field(default_factory=list)
+    connect_seconds: float = 0
+    event_seconds: float = 0
+    cpu_seconds: float = 0
+    peak_rss_kb: int = 0
+    traced_peak: int = None
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def make_orders(count):
+    from .models import Category, MenuItem, Order, OrderItem, Table
+
+    category = Category.objects.create(name='Load test')
+    menu_item = MenuItem.objects.create(
+        name='Load test coffee', description='', price=Decimal('3.20'), category=category
+    )
+    table = Table.objects.create(table_number=9999, is_occupied=True)
+    orders = Order.objects.bulk_create([
+        Order(table=table, status='pending', total_amount=Decimal('3.20'))
+        for _ in range(count)
+    ])
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, menu_item=menu_item, quantity=1,
+                  unit_price=menu_item.price, subtotal=menu_item.price)
+        for order in orders
+    ])
+    return [order.pk for order in orders]
+
+
+def update_status(order_id, status):
+    """Call the real endpoint; its event is published after it returns."""
+    from rest_framework.test import APIRequestFactory
+
+    from .views import OrderViewSet
+
+    view = OrderViewSet.as_view({'post': 'update_status'})
+    request = APIRequestFactory().post(
+        f'/api/orders/{order_id}/update_status/', {'status': status}, format='json'
+    )
+    response = view(request, pk=order_id)
+    if response.status_code != 200:
+        raise RuntimeError(f'update_status failed: {response.data}')
+
+
+class Socket:
+    """A connected communicator and the time each frame arrived."""
+
+    def __init__(self, application, path):
+        self.communicator = WebsocketCommunicator(application, path)
+        self.received = []
+        self.reader = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError(f'Could not connect to {self.communicator.scope["path"]}')
+
+        async def read():
+            while True:
+                output = await self.communicator.receive_output(timeout=3600)
+                if output['type'] != 'websocket.send':
+                    return
+                self.received.append((time.perf_counter(), json.loads(output['text'])))
+
+        self.reader = asyncio.get_running_loop().create_task(read())
+
+    async def close(self):
+        self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+async def run(application, kitchens=50, trackers=200, chats=100, events=200, rate=50,
+              chat_rate=20, orders=None, drain=2.0, trace_memory=False):
+    """Drive ``application`` and return a :class:`Result`."""
+    if trace_memory:
+        tracemalloc.start()
+    result = Result()
+    orders = orders or max(trackers, chats, 1)
+    order_ids = await database_sync_to_async(make_orders)(orders)
+
+    started = time.perf_counter()
+    kitchen_sockets = [Socket(application, '/ws/orders/') for _ in range(kitchens)]
+    tracker_sockets = {}
+    for i in range(trackers):
+        order_id = order_ids[i % len(order_ids)]
+        tracker_sockets.setdefault(order_id, []).append(Socket(application, f'/ws/order/{order_id}/'))
+    chat_sessions = [
+        [Socket(application, f'/ws/chat/{order_ids[i % len(order_ids)]}/') for _ in range(2)]
+        for i in range(chats)
+    ]
+    sockets = kitchen_sockets + [
+        socket for group in list(tracker_sockets.values()) + chat_sessions for socket in group
+    ]
+    for socket in sockets:
+        await socket.connect()
+    result.connect_seconds = time.perf_counter() - started
+    # Leave the catch-up and history frames out of the measurements
+    await asyncio.sleep(0.1)
+    for socket in sockets:
+        socket.received.clear()
+
+    events = min(events, len(order_ids) * len(STATUS_FLOW))
+    sent_at = {}
+    chat_sent_at = {}
+
+    async def change_statuses():
+        steps = itertools.product(STATUS_FLOW, order_ids)
+        for _ in range(events):
+            status, order_id = next(steps)
+            sent_at[order_id, status] = time.perf_counter()
+            await database_sync_to_async(update_status)(order_id, status)
+            result.order_expected += kitchens + len(tracker_sockets.get(order_id, ()))
+            await asyncio.sleep(1 / rate)
+
+    async def chat():
+        if not chat_sessions:
+            return
+        duration = events / rate
+        for n in range(int(duration * chat_rate)):
+            session = chat_sessions[n % len(chat_sessions)]
+            text = f'load test message {n}'
+            chat_sent_at[text] = time.perf_counter()
+            await session[n % 2].communicator.send_json_to(
+                {'type': 'chat_message', 'message': text, 'sender_type': 'client'}
+            )
+            result.chat_expected += len(session)
+            await asyncio.sleep(1 / chat_rate)
+
+    def measure():
+        result.order_latencies, result.chat_latencies = [], []
+        for socket in sockets:
+            for at, message in socket.received:
+                step = (message.get('order') or {}).get('id'), (message.get('order') or {}).get('status')
+                if message['type'] in ('order_update', 'new_order') and step in sent_at:
+                    result.order_latencies.append(at - sent_at[step])
+                elif message['type'] == 'chat_message' and message.get('message') in chat_sent_at:
+                    result.chat_latencies.append(at - chat_sent_at[message['message']])
+        return (len(result.order_latencies) >= result.order_expected
+                and len(result.chat_latencies) >= result.chat_expected)
+
+    cpu_started, started = time.process_time(), time.perf_counter()
+    await asyncio.gather(change_statuses(), chat())
+    # Wait for the last deliveries, up to ``drain`` seconds
+    deadline = time.perf_counter() + drain
+    while not measure() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    result.cpu_seconds = time.process_time() - cpu_started
+    result.event_seconds = time.perf_counter() - started
+    result.events = len(sent_at)
+    result.chat_messages = len(chat_sent_at)
+
+    for socket in sockets:
+        await socket.close()
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    result.peak_rss_kb = maxrss // 1024 if sys.platform == 'darwin' else maxrss
+    if trace_memory:
+        result.traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from orders.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Run the named micro-benchmarks (all of them by default); fixtures are rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Benchmarks to run')
+        parser.add_argument('--list', action='store_true', help='List available benchmarks')
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for name, func in sorted(BENCHMARKS.items()):
+                self.stdout.write(f'{name}: {(func.__doc__ or "").strip()}')
+            return
+
+        names = options['names'] or sorted(BENCHMARKS)
+        unknown = [name for name in names if name not in BENCHMARKS]
+        if unknown:
+            raise CommandError(f'Unknown benchmark(s): {", ".join(unknown)}')
+
+        for name in names:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+
+            def report(label, value):
+                self.stdout.write(f'  {label:<40} {value}')
+
+            with transaction.atomic():
+                BENCHMARKS[name](report)
+                transaction.set_rollback(True)
@@ -0,0 +1,33 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from orders import rollups
+from orders.models import HourlyItemSales, HourlySales
+
+
+class Command(BaseCommand):
+    help = 'Backfill or rebuild the hourly sales rollup used by the analytics endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='First day to rebuild (YYYY-MM-DD), default: all history')
+        parser.add_argument('--end', help='Last day to rebuild (YYYY-MM-DD), default: all history')
+
+    def parse_day(self, value, at):
+        if value is None:
+            return None
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError(f'Invalid date {value!r}. Use YYYY-MM-DD')
+        return timezone.make_aware(datetime.combine(day, at))
+
+    def handle(self, *args, **options):
+        start = self.parse_day(options['start'], time.min)
+        end = self.parse_day(options['end'], time.max)
+        rollups.rebuild(start=start, end=end)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt sales rollup: {HourlySales.objects.count()} order buckets, '
+            f'{HourlyItemSales.objects.count()} item buckets'
+        ))
@@ -0,0 +1,44 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+
+from orders import images
+from orders.models import MenuItem
+
+
+def _init_worker():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'coffee_shop_backend.settings')
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = 'Regenerate resized WebP/JPEG variants for every menu item image'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes')
+        parser.add_argument('--missing', action='store_true',
+                            help='Only process items whose variants are out of date')
+
+    def handle(self, *args, **options):
+        items = [
+            (pk, name, variants)
+            for pk, name, variants in MenuItem.objects.exclude(image='').exclude(
+                image__isnull=True
+            ).values_list('pk', 'image', 'image_variants')
+            if not options['missing'] or (variants or {}).get('source') != name
+        ]
+
+        # Resizing is CPU bound, so fan out to processes; the manifests are
+        # written back from this process
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker) as pool:
+            futures = {pool.submit(images.generate_variants, name): pk for pk, name, _ in items}
+            for future in as_completed(futures):
+                pk = futures[future]
+                try:
+                    images.store_manifest(pk, future.result())
+                    self.stdout.write(f'Menu item {pk}: ok')
+                except Exception as e:
+                    self.stderr.write(f'Menu item {pk}: {e}')
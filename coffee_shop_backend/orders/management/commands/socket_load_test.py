@@ -0,0 +1,91 @@
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from orders import loadtest
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive the ASGI application with in-process kitchen, tracking and chat sockets and '
+        'report fan-out latency, CPU per event and peak memory; runs against a throwaway database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kitchens', type=int, default=50, help='Sockets on /ws/orders/')
+        parser.add_argument('--trackers', type=int, default=200, help='Sockets tracking one order each')
+        parser.add_argument('--chats', type=int, default=100, help='Chat sessions (two sockets each)')
+        parser.add_argument('--orders', type=int, help='Orders to spread trackers and chats over')
+        parser.add_argument('--events', type=int, default=200, help='Status changes to make')
+        parser.add_argument('--rate', type=float, default=50, help='Status changes per second')
+        parser.add_argument('--chat-rate', type=float, default=20, help='Chat messages per second')
+        parser.add_argument('--drain', type=float, default=5, help='Seconds to wait for late deliveries')
+        parser.add_argument('--channel-layer', choices=['memory', 'configured'], default='memory',
+                            help='Use an in-memory channel layer (default) or the configured one')
+        parser.add_argument('--trace-memory', action='store_true',
+                            help='Also report the Python allocation peak (slows the run down)')
+
+    def handle(self, *args, **options):
+        from coffee_shop_backend.asgi import application
+
+        overrides = {
+            # Keep the run's orders, chat history and menu out of the caches
+            # a running server uses
+            'CACHES': {
+                alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': alias}
+                for alias in ('default', 'catalog')
+            },
+        }
+        if options['channel_layer'] == 'memory':
+            overrides['CHANNEL_LAYERS'] = {
+                'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 1000}}
+            }
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(**overrides):
+                result = async_to_sync(loadtest.run)(
+                    application,
+                    kitchens=options['kitchens'],
+                    trackers=options['trackers'],
+                    chats=options['chats'],
+                    orders=options['orders'],
+                    events=options['events'],
+                    rate=options['rate'],
+                    chat_rate=options['chat_rate'],
+                    drain=options['drain'],
+                    trace_memory=options['trace_memory'],
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.report(result)
+
+    def report(self, result):
+        def line(label, value):
+            self.stdout.write(f'  {label:<28} {value}')
+
+        def latencies(values, expected):
+            if not values:
+                return f'0/{expected} delivered'
+            ms = [value * 1000 for value in values]
+            return (
+                f'{len(values)}/{expected} delivered, '
+                f'p50 {loadtest.percentile(ms, 0.5):.1f} ms, p90 {loadtest.percentile(ms, 0.9):.1f} ms, '
+                f'p99 {loadtest.percentile(ms, 0.99):.1f} ms, max {max(ms):.1f} ms'
+            )
+
+        self.stdout.write(self.style.MIGRATE_HEADING('Socket load test'))
+        line('connect', f'{result.connect_seconds:.2f} s')
+        line('order events', f'{result.events} in {result.event_seconds:.2f} s')
+        line('order fan-out', latencies(result.order_latencies, result.order_expected))
+        line('chat messages', f'{result.chat_messages}')
+        line('chat fan-out', latencies(result.chat_latencies, result.chat_expected))
+        sent = result.events + result.chat_messages
+        if sent:
+            line('CPU per event', f'{result.cpu_seconds / sent * 1000:.2f} ms '
+                                  f'({result.cpu_seconds:.2f} s for {sent} order events and chat messages)')
+        line('peak RSS', f'{result.peak_rss_kb / 1024:.1f} MiB')
+        if result.traced_peak is not None:
+            line('peak Python allocations', f'{result.traced_peak / 1024 / 1024:.1f} MiB')
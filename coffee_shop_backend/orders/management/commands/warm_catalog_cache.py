@@ -0,0 +1,38 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from orders.models import Category
+from orders.views import CategoryViewSet, MenuItemViewSet
+
+
+class Command(BaseCommand):
+    help = 'Prefill the menu catalog cache with the listings tablets request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='localhost:8000',
+                            help='Host the tablets use, as image URLs are absolute')
+        parser.add_argument('--scheme', default='http', choices=['http', 'https'])
+
+    def handle(self, *args, **options):
+        factory = APIRequestFactory()
+        extra = {'HTTP_HOST': options['host'], 'secure': options['scheme'] == 'https'}
+
+        menu_paths = ['/api/menu-items/', '/api/menu-items/?available=true']
+        for category_id in Category.objects.values_list('id', flat=True):
+            menu_paths.append(f'/api/menu-items/?category={category_id}')
+            menu_paths.append(f'/api/menu-items/?category={category_id}&available=true')
+
+        menu_view = MenuItemViewSet.as_view({'get': 'list'})
+        for path in menu_paths:
+            self.warm(menu_view, factory.get(path, **extra), path)
+
+        # The category listing requires a login; the cached body is the
+        # same for every authenticated user
+        request = factory.get('/api/categories/', **extra)
+        force_authenticate(request, user=User(username='catalog-warmup'))
+        self.warm(CategoryViewSet.as_view({'get': 'list'}), request, '/api/categories/')
+
+    def warm(self, view, request, path):
+        response = view(request)
+        self.stdout.write(f'{response.status_code} {path} {response.get("ETag", "")}')
@@ -1,46 +1,52 @@
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import AccessToken
-from django.contrib.auth import get_user_model
 from urllib.parse import parse_qs
 import logging
 
+from . import auth
+
 logger = logging.getLogger(__name__)
 
-@database_sync_to_async
-def get_user(token_key):
+async def get_user(token_key):
     try:
         access_token = AccessToken(token_key)
-        user = get_user_model().objects.get(id=access_token['user_id'])
-        return user
+        user_id = access_token[api_settings.USER_ID_CLAIM]
     except Exception as e:
         logger.error(f"Token validation error: {str(e)}")
         return AnonymousUser()
 
+    # Only go to the database thread when the user is not cached
+    user = auth.cached_user(user_id)
+    if user is auth.NOT_CACHED:
+        user = await database_sync_to_async(auth.resolve_user)(user_id)
+    if not api_settings.USER_AUTHENTICATION_RULE(user):
+        return AnonymousUser()
+    return user
+
 class TokenAuthMiddleware(BaseMiddleware):
+    """
+    Sets ``scope['user']`` from a ``?token=<access token>`` query parameter.
+    Connections without one (order tracking, chat) stay anonymous.
+    """
     async def __call__(self, scope, receive, send):
         try:
             query_string = scope.get('query_string', b'').decode()
             query_params = parse_qs(query_string)
             token = query_params.get('token', [None])[0]
-            
-            # Allow public access for order tracking
-            if 'order' in scope.get('path', ''):
-                scope['user'] = AnonymousUser()
-                return await super().__call__(scope, receive, send)
-            
-            # For other routes, require authentication
+
             if token:
-                scope['user'] = await get_user(token)
+                user = await get_user(token)
             else:
-                scope['user'] = AnonymousUser()
-                
+                user = AnonymousUser()
+
         except Exception as e:
             logger.error(f"Error in TokenAuthMiddleware: {str(e)}")
-            scope['user'] = AnonymousUser()
-            
-        return await super().__call__(scope, receive, send)
+            user = AnonymousUser()
+
+        return await super().__call__(dict(scope, user=user), receive, send)
 
 def TokenAuthMiddlewareStack(inner):
     return TokenAuthMiddleware(inner)
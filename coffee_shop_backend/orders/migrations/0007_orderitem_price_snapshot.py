@@ -0,0 +1,37 @@
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+
+
+def backfill_price_snapshot(apps, schema_editor):
+    OrderItem = apps.get_model('orders', 'OrderItem')
+    MenuItem = apps.get_model('orders', 'MenuItem')
+
+    # Existing lines only know the current menu price, which is the best
+    # snapshot available for them
+    OrderItem.objects.filter(unit_price__isnull=True).update(
+        unit_price=Subquery(
+            MenuItem.objects.filter(pk=OuterRef('menu_item_id')).values('price')[:1]
+        )
+    )
+    OrderItem.objects.update(subtotal=F('quantity') * F('unit_price'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0006_add_tracking_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=6, null=True),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=8),
+        ),
+        migrations.RunPython(backfill_price_snapshot, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_rollup(apps, schema_editor):
+    from orders.rollups import rebuild
+    rebuild(apps=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0008_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HourlySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('confirmed', 'Confirmed'), ('preparing', 'Preparing'), ('ready', 'Ready'), ('delivered', 'Delivered'), ('paid', 'Paid'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('order_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Hourly sales',
+                'constraints': [models.UniqueConstraint(fields=('hour', 'status'), name='hourly_sales_bucket')],
+            },
+        ),
+        migrations.CreateModel(
+            name='HourlyItemSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('quantity', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('menu_item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hourly_sales', to='orders.menuitem')),
+            ],
+            options={
+                'verbose_name_plural': 'Hourly item sales',
+                'constraints': [models.UniqueConstraint(fields=('hour', 'menu_item'), name='hourly_item_sales_bucket')],
+            },
+        ),
+        migrations.RunPython(build_rollup, migrations.RunPython.noop),
+    ]
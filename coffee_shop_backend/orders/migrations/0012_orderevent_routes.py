@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0011_order_event_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderevent',
+            name='routes',
+            field=models.JSONField(default=dict),
+        ),
+    ]
@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Sum
+from django.dispatch import Signal
 from django.utils import timezone
 
 class Category(models.Model):
@@ -18,6 +20,8 @@ class MenuItem(models.Model):
     price = models.DecimalField(max_digits=6, decimal_places=2)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='items')
     image = models.ImageField(upload_to='menu_items/', null=True, blank=True)
+    # Resized WebP/JPEG renditions of image, maintained by orders.images
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     is_available = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -33,6 +37,82 @@ class Table(models.Model):
     def __str__(self):
         return f"Table {self.table_number}"
 
+class OrderQuerySet(models.QuerySet):
+    def with_details(self, table=True, items=True):
+        """
+        Load everything the order serializers read in a fixed number of
+        queries; sparse fieldsets can leave the table or the lines out
+        """
+        queryset = self
+        if table:
+            queryset = queryset.select_related('table')
+        if items:
+            queryset = queryset.prefetch_related(
+                models.Prefetch(
+                    'orderitem_set',
+                    queryset=OrderItem.objects.select_related('menu_item'),
+                )
+            )
+        return queryset
+
+    def transition(self, pk, status, version=None):
+        """Move order ``pk`` to ``status`` if the state machine allows it from its current status"""
+        if status not in self.model.TRANSITIONS:
+            raise ValueError(f"Invalid status: {status}")
+        return self.compare_and_set(pk, {'status': status}, version, statuses=self.model.sources(status))
+
+    def compare_and_set(self, pk, changes, version=None, statuses=None):
+        """
+        Write ``changes`` to order ``pk`` with a single ``UPDATE ... WHERE
+        id`` (``AND version`` when ``version`` is given, ``AND status`` one
+        of ``statuses``), without loading the order first or recalculating
+        its total, and return the order reloaded with its details. When no
+        row matches, raises DoesNotExist, InvalidTransition (its status is
+        not one of ``statuses``) or OrderConflict (its version is not
+        ``version``).
+        """
+        rows = self.filter(pk=pk)
+        if version is not None:
+            rows = rows.filter(version=version)
+        values = {**changes, 'version': F('version') + 1, 'updated_at': timezone.now()}
+
+        order = None
+        with transaction.atomic(savepoint=False):
+            # One statement per status the order may be in, so the status it
+            # left is known without reading it; only cancelling has several
+            for source in [None] if statuses is None else statuses:
+                if (rows if source is None else rows.filter(status=source)).update(**values):
+                    order = self.with_details().get(pk=pk)
+                    order_updated.send(sender=self.model, order=order, previous_status=source)
+                    break
+        if order is None:
+            raise self._mismatch(pk, changes, statuses)
+        return order
+
+    def _mismatch(self, pk, changes, statuses):
+        """Why a compare-and-set matched no row, as the exception to raise"""
+        status = self.filter(pk=pk).values_list('status', flat=True).first()
+        if status is None:
+            return self.model.DoesNotExist(f"Order #{pk} does not exist")
+        if statuses is not None and status not in statuses:
+            return InvalidTransition(f"Order #{pk} cannot move from {status} to {changes.get('status')}")
+        return OrderConflict(f"Order #{pk} was changed by someone else; reload it and try again")
+
+
+class OrderConflict(Exception):
+    """A compare-and-swap update found the order changed since the client read it"""
+
+
+class InvalidTransition(Exception):
+    """The state machine does not let the order leave its current status that way"""
+
+
+# Sent for writes made by OrderQuerySet.compare_and_set, which bypass save()
+# and so post_save; orders.signals keeps events, the sales rollup and the
+# cached order version current from it
+order_updated = Signal()
+
+
 class Order(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -43,6 +123,18 @@ class Order(models.Model):
         ('paid', 'Paid'),
         ('cancelled', 'Cancelled'),
     ]
+    # The statuses each status may move to; paid and cancelled are final
+    TRANSITIONS = {
+        'pending': ('confirmed', 'cancelled'),
+        'confirmed': ('preparing', 'cancelled'),
+        'preparing': ('ready', 'cancelled'),
+        'ready': ('delivered', 'cancelled'),
+        'delivered': ('paid', 'cancelled'),
+        'paid': (),
+        'cancelled': (),
+    }
+    # No transition leaves these
+    FINAL_STATUSES = tuple(status for status, targets in TRANSITIONS.items() if not targets)
     
     table = models.ForeignKey(Table, on_delete=models.CASCADE)
     items = models.ManyToManyField(MenuItem, through='OrderItem')
@@ -52,23 +144,79 @@ class Order(models.Model):
     user_agent = models.CharField(max_length=512, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Moved by every write to the row, so a writer can tell the order it
+    # read is still the current one
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='order_created_id_idx'),
+        ]
+
+    def prefetch_details(self):
+        """Attach the related rows the order serializers read to this instance"""
+        models.prefetch_related_objects(
+            [self],
+            'table',
+            models.Prefetch(
+                'orderitem_set',
+                queryset=OrderItem.objects.select_related('menu_item'),
+            ),
+        )
+        return self
+
+    def forget_details(self):
+        """Drop prefetched lines after they were rewritten outside the cache"""
+        getattr(self, '_prefetched_objects_cache', {}).pop('orderitem_set', None)
     
     def calculate_total(self):
         total = 0
         if self.pk:  # Only calculate if the order exists in the database
-            total = sum(item.quantity * item.menu_item.price for item in self.orderitem_set.all())
+            total = self.orderitem_set.aggregate(total=Sum('subtotal'))['total'] or 0
         return total
     
-    def save(self, *args, **kwargs):
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_rollup_state()
+        return instance
+
+    def remember_rollup_state(self):
+        """Record the fields the sales rollup buckets on, to diff on the next save"""
+        self._rollup_state = (
+            self.__dict__.get('status'),
+            self.__dict__.get('total_amount'),
+            self.__dict__.get('created_at'),
+        )
+
+    @classmethod
+    def sources(cls, status):
+        """The statuses an order may move to ``status`` from"""
+        return [source for source, targets in cls.TRANSITIONS.items() if status in targets]
+
+    def save(self, *args, recalculate=True, **kwargs):
         # Remove force_insert if it's in kwargs
         kwargs.pop('force_insert', None)
+        if self.pk is not None and not self._state.adding:
+            self.version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+
+        # Callers that already know the total (e.g. OrderSerializer.create)
+        # skip the recalculation round-trip and save exactly once
+        if not recalculate:
+            return super().save(*args, **kwargs)
         
-        is_new = self.pk is None
-        if is_new:
-            super().save(*args, **kwargs)  # Save first to get a primary key
-            
-        self.total_amount = self.calculate_total()
-        super().save(*args, **kwargs)  # Save again with the calculated total
+        # One transaction, so the saves below publish a single order event
+        with transaction.atomic():
+            is_new = self.pk is None
+            if is_new:
+                super().save(*args, **kwargs)  # Save first to get a primary key
+
+            self.total_amount = self.calculate_total()
+            super().save(*args, **kwargs)  # Save again with the calculated total
         
     def __str__(self):
         return f"Order #{self.pk} - {self.status}"
@@ -79,10 +227,20 @@ class OrderItem(models.Model):
     menu_item = models.ForeignKey(MenuItem, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
     notes = models.TextField(blank=True)
-    
-    @property
-    def subtotal(self):
-        return self.quantity * self.menu_item.price
+    # Price snapshot taken when the line is ordered, so revenue never
+    # changes when the menu is edited and never needs a join to MenuItem
+    unit_price = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True)
+    subtotal = models.DecimalField(max_digits=8, decimal_places=2, default=0, editable=False)
+
+    def snapshot_price(self, menu_item=None):
+        """Fill unit_price and subtotal; used before bulk_create, which skips save()"""
+        if self.unit_price is None:
+            self.unit_price = (menu_item or self.menu_item).price
+        self.subtotal = self.quantity * self.unit_price
+
+    def save(self, *args, **kwargs):
+        self.snapshot_price()
+        super().save(*args, **kwargs)
 
 class OrderReview(models.Model):
     order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='review')
@@ -90,9 +248,67 @@ class OrderReview(models.Model):
     comment = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='review_created_id_idx'),
+        ]
+
     def __str__(self):
         return f"Review for Order #{self.order.id}"
 
+class HourlySales(models.Model):
+    """
+    Orders and revenue per UTC hour and status, maintained incrementally by
+    orders.rollups as orders are created, change status or are deleted.
+    """
+    hour = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    order_count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "Hourly sales"
+        constraints = [
+            models.UniqueConstraint(fields=['hour', 'status'], name='hourly_sales_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.hour:%Y-%m-%d %H:00} {self.status}: {self.order_count}"
+
+
+class HourlyItemSales(models.Model):
+    """Quantity and revenue per UTC hour and menu item, for paid orders only."""
+    hour = models.DateTimeField()
+    menu_item = models.ForeignKey(MenuItem, on_delete=models.CASCADE, related_name='hourly_sales')
+    quantity = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = "Hourly item sales"
+        constraints = [
+            models.UniqueConstraint(fields=['hour', 'menu_item'], name='hourly_item_sales_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.hour:%Y-%m-%d %H:00} {self.menu_item_id}: {self.quantity}"
+
+
+class OrderEvent(models.Model):
+    """
+    Recent order events, kept as a bounded replay buffer by orders.events.
+    The id doubles as the event's sequence number.
+    """
+    order_id = models.IntegerField()
+    kind = models.CharField(max_length=20)
+    payload = models.JSONField()
+    # Values subscribers can filter the event on (events.routes_for)
+    routes = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"#{self.pk} {self.kind} for order {self.order_id}"
+
+
 class BrokenItem(models.Model):
     item_name = models.CharField(max_length=200)
     description = models.TextField()
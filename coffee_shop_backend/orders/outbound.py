@@ -0,0 +1,119 @@
+"""
+Bounded send queues and heartbeats for WebSocket consumers.
+
+Without a queue, a handler that sends to a client which has stopped
+reading waits on the server, and the consumer stops taking messages from
+the channel layer until its channel is full. ``OutboundQueueMixin`` puts
+frames on a per-connection queue of ``WEBSOCKET_QUEUE_SIZE`` drained by
+a background task instead. When the queue is full the consumer's
+``outbound_policy`` applies: ``'drop_oldest'`` discards the oldest queued
+frame (the order streams, where every event carries the order's whole
+state), ``'close'`` evicts the connection (chat, where a gap would go
+unnoticed).
+
+Every ``WEBSOCKET_HEARTBEAT_INTERVAL`` seconds the server sends
+``{"type": "heartbeat"}``, which clients answer. A connection that has
+sent nothing for ``WEBSOCKET_HEARTBEAT_TIMEOUT`` seconds is evicted.
+Evicting runs the consumer's ``disconnect`` so its groups are discarded
+at once, without waiting for the server to notice the socket is gone.
+"""
+import asyncio
+import logging
+from collections import Counter, deque
+
+from django.conf import settings
+
+from .framing import encode_frames
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_QUEUE_SIZE = getattr(settings, 'WEBSOCKET_QUEUE_SIZE', 64)
+WEBSOCKET_HEARTBEAT_INTERVAL = getattr(settings, 'WEBSOCKET_HEARTBEAT_INTERVAL', 20)
+WEBSOCKET_HEARTBEAT_TIMEOUT = getattr(settings, 'WEBSOCKET_HEARTBEAT_TIMEOUT', 60)
+
+# Per process: frames dropped and connections evicted, by reason
+counters = Counter()
+
+HEARTBEAT = encode_frames({'type': 'heartbeat'})
+
+# Close codes in the application range, as 4004 for unknown orders
+CLOSE_SLOW = 4008
+CLOSE_DEAD = 4009
+
+
+class OutboundQueueMixin:
+    """Queue outgoing frames per connection; goes before FramedConsumerMixin."""
+    outbound_policy = 'drop_oldest'
+    outbound = None
+    evicted = False
+
+    async def __call__(self, scope, receive, send):
+        self.outbound_tasks = []
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            for task in self.outbound_tasks:
+                task.cancel()
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol=subprotocol, headers=headers)
+        loop = asyncio.get_running_loop()
+        self.outbound = deque()
+        self.outbound_ready = asyncio.Event()
+        self.last_received = loop.time()
+        self.outbound_tasks += [
+            loop.create_task(self.send_outbound()),
+            loop.create_task(self.send_heartbeats()),
+        ]
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if self.evicted:
+            return
+        if self.outbound is None:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        if len(self.outbound) >= WEBSOCKET_QUEUE_SIZE:
+            if self.outbound_policy == 'close':
+                await self.evict('slow', CLOSE_SLOW)
+                return
+            self.outbound.popleft()
+            counters['dropped'] += 1
+        self.outbound.append((text_data, bytes_data, close))
+        self.outbound_ready.set()
+
+    async def send_outbound(self):
+        while True:
+            while not self.outbound:
+                self.outbound_ready.clear()
+                await self.outbound_ready.wait()
+            text_data, bytes_data, close = self.outbound.popleft()
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def send_heartbeats(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(WEBSOCKET_HEARTBEAT_INTERVAL)
+            if loop.time() - self.last_received > WEBSOCKET_HEARTBEAT_TIMEOUT:
+                await self.evict('dead', CLOSE_DEAD)
+                return
+            await self.send_frames(HEARTBEAT)
+
+    async def websocket_receive(self, message):
+        if self.outbound is not None:
+            self.last_received = asyncio.get_running_loop().time()
+        await super().websocket_receive(message)
+
+    async def evict(self, reason, code):
+        """Close the connection and leave its groups now."""
+        self.evicted = True
+        counters[f'evicted_{reason}'] += 1
+        logger.warning(f"Evicting {reason} WebSocket client {self.channel_name}")
+        self.outbound.clear()
+        current = asyncio.current_task()
+        for task in self.outbound_tasks:
+            if task is not current:
+                task.cancel()
+        try:
+            await self.disconnect(code)
+        finally:
+            await self.close(code)
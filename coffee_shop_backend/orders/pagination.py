@@ -0,0 +1,118 @@
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Cursor pagination keyed on (ordering field, id).
+
+    DRF's CursorPagination positions on a single field and falls back to an
+    OFFSET when several rows share a value. Adding the primary key to the
+    position makes every cursor unique, so each page is a plain indexed
+    range scan of page_size + 1 rows however deep the client goes.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = getattr(settings, 'API_PAGE_SIZE', 50)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 200)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            reverse, current_position = False, None
+        else:
+            reverse, current_position = self.cursor.reverse, self.cursor.position
+
+        if reverse:
+            queryset = queryset.order_by(*self._reversed_ordering())
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if current_position is not None:
+            queryset = queryset.filter(self._after(current_position, reverse))
+
+        # One extra row tells us whether there is a page after this one
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_following = len(results) > len(self.page)
+        following_position = (
+            self._get_position_from_instance(self.page[-1], self.ordering)
+            if has_following else None
+        )
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = current_position is not None
+            self.has_previous = has_following
+            self.next_position = current_position
+            self.previous_position = following_position
+        else:
+            self.has_next = has_following
+            self.has_previous = current_position is not None
+            self.next_position = following_position
+            self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[-1], self.ordering)
+        else:
+            position = self.next_position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.page:
+            position = self._get_position_from_instance(self.page[0], self.ordering)
+        else:
+            position = self.previous_position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def _reversed_ordering(self):
+        return tuple(
+            field[1:] if field.startswith('-') else '-' + field
+            for field in self.ordering
+        )
+
+    def _get_position_from_instance(self, instance, ordering):
+        field_name = ordering[0].lstrip('-')
+        value = getattr(instance, field_name)
+        return f'{value.isoformat()}|{instance.pk}'
+
+    def _after(self, position, reverse):
+        """Rows strictly after ``position`` in the direction being read."""
+        try:
+            value, pk = position.rsplit('|', 1)
+            pk = int(pk)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+
+        field_name = self.ordering[0].lstrip('-')
+        descending = self.ordering[0].startswith('-') != reverse
+        lookup = 'lt' if descending else 'gt'
+        # The redundant inclusive bound lets the database seek the
+        # (field, id) index instead of scanning it for the OR
+        return Q(**{f'{field_name}__{lookup}e': value}) & (
+            Q(**{f'{field_name}__{lookup}': value}) | Q(**{f'pk__{lookup}': pk})
+        )
+
+
+class ChatMessageCursorPagination(KeysetCursorPagination):
+    ordering = ('timestamp', 'id')
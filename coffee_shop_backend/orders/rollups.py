@@ -0,0 +1,194 @@
+"""
+Incremental hourly sales rollup behind OrderViewSet.analytics.
+
+Every order contributes its total and a count of one to the
+(hour, status) bucket it currently sits in, and paid orders also
+contribute their lines to (hour, menu item) buckets. Saves move the
+order between buckets by applying deltas, so analytics reads cost one
+row per bucket instead of one row per order. ``rebuild`` recomputes the
+rollup from the orders table and is exposed as the
+``rebuild_sales_rollup`` management command.
+"""
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+
+from django.apps import apps as django_apps
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, F, Q, Sum, Value, When
+from django.db.models.functions import TruncHour
+
+PAID = 'paid'
+
+
+def bucket_hour(created_at):
+    return created_at.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def _add(model, lookup, **deltas):
+    """Add ``deltas`` to the bucket matching ``lookup``, creating it if needed."""
+    increments = {field: F(field) + delta for field, delta in deltas.items()}
+    if model.objects.filter(**lookup).update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **deltas)
+    except IntegrityError:
+        # Another writer created the bucket between our update and insert
+        model.objects.filter(**lookup).update(**increments)
+
+
+class _MissingBucket(Exception):
+    pass
+
+
+def _add_all(model, buckets):
+    """
+    Add each ``(lookup, deltas)`` in ``buckets`` with a single UPDATE. When
+    a bucket does not exist yet that UPDATE is rolled back, and every
+    bucket goes through ``_add`` instead.
+    """
+    if len(buckets) == 1:
+        lookup, deltas = buckets[0]
+        _add(model, lookup, **deltas)
+        return
+    increments = {
+        field: F(field) + Case(
+            *[When(Q(**lookup), then=Value(deltas[field])) for lookup, deltas in buckets],
+            default=Value(0),
+            output_field=model._meta.get_field(field),
+        )
+        for field in buckets[0][1]
+    }
+    matching = reduce(or_, [Q(**lookup) for lookup, _ in buckets])
+    try:
+        with transaction.atomic():
+            if model.objects.filter(matching).update(**increments) != len(buckets):
+                raise _MissingBucket
+    except _MissingBucket:
+        for lookup, deltas in buckets:
+            _add(model, lookup, **deltas)
+
+
+def _merge(changes, model, lookup, **deltas):
+    bucket = changes.setdefault((model, tuple(lookup.items())), dict.fromkeys(deltas, 0))
+    for field, delta in deltas.items():
+        bucket[field] += delta
+
+
+def _merge_items(changes, order, hour, sign):
+    from .models import HourlyItemSales
+
+    # Prefetched lines cost no query
+    for line in order.orderitem_set.all():
+        _merge(
+            changes, HourlyItemSales, {'hour': hour, 'menu_item_id': line.menu_item_id},
+            quantity=sign * line.quantity,
+            amount=sign * (line.subtotal or Decimal('0')),
+        )
+
+
+def order_changes(order, previous_state, changes=None):
+    """
+    The deltas moving ``order`` from the bucket described by
+    ``previous_state`` (a ``(status, total_amount, created_at)`` tuple, or
+    None for a new order) to the bucket it is in now, added to
+    ``changes``, for ``apply``.
+
+    Item buckets follow the order into and out of ``paid``. Lines edited
+    while an order stays paid only adjust the order totals; run
+    ``rebuild_sales_rollup`` after such edits to correct item totals.
+    """
+    from .models import HourlySales
+
+    changes = {} if changes is None else changes
+    status, amount, hour = order.status, Decimal(order.total_amount or 0), bucket_hour(order.created_at)
+    if previous_state is not None and previous_state[0] is not None:
+        old_status, old_amount, old_created_at = previous_state
+        old_amount = Decimal(old_amount or 0)
+        old_hour = bucket_hour(old_created_at)
+        if (old_status, old_amount, old_hour) == (status, amount, hour):
+            return changes
+        _merge(changes, HourlySales, {'hour': old_hour, 'status': old_status},
+               amount=-old_amount, order_count=-1)
+        if old_status == PAID and status != PAID:
+            _merge_items(changes, order, old_hour, -1)
+    else:
+        old_status = None
+
+    _merge(changes, HourlySales, {'hour': hour, 'status': status}, amount=amount, order_count=1)
+    if status == PAID and old_status != PAID:
+        _merge_items(changes, order, hour, 1)
+    return changes
+
+
+def apply(changes):
+    """Write ``changes`` from ``order_changes``, with one UPDATE per model when every bucket exists."""
+    buckets = {}
+    for (model, lookup), deltas in changes.items():
+        if any(deltas.values()):
+            buckets.setdefault(model, []).append((dict(lookup), deltas))
+    for model, model_buckets in buckets.items():
+        _add_all(model, model_buckets)
+
+
+def apply_order_change(order, previous_state):
+    """Move ``order`` between buckets; see ``order_changes``."""
+    apply(order_changes(order, previous_state))
+
+
+def remove_order(order, state):
+    """Take a deleted order out of the bucket described by ``state``."""
+    from .models import HourlySales
+
+    status, amount, created_at = state
+    if status is None:
+        return
+    hour = bucket_hour(created_at)
+    changes = {}
+    _merge(changes, HourlySales, {'hour': hour, 'status': status},
+           amount=-Decimal(amount or 0), order_count=-1)
+    if status == PAID:
+        _merge_items(changes, order, hour, -1)
+    apply(changes)
+
+
+def rebuild(start=None, end=None, apps=django_apps):
+    """
+    Recompute the rollup from scratch for orders created in
+    ``[start, end]`` (aware datetimes aligned to the hour, or None for an
+    open bound). ``apps`` lets migrations pass their historical registry.
+    """
+    Order = apps.get_model('orders', 'Order')
+    OrderItem = apps.get_model('orders', 'OrderItem')
+    HourlySales = apps.get_model('orders', 'HourlySales')
+    HourlyItemSales = apps.get_model('orders', 'HourlyItemSales')
+
+    def bounded(queryset, field):
+        if start is not None:
+            queryset = queryset.filter(**{f'{field}__gte': start})
+        if end is not None:
+            queryset = queryset.filter(**{f'{field}__lte': end})
+        return queryset
+
+    order_buckets = bounded(Order.objects.all(), 'created_at').annotate(
+        hour=TruncHour('created_at', tzinfo=dt_timezone.utc)
+    ).values('hour', 'status').annotate(
+        amount=Sum('total_amount'), order_count=Count('id')
+    ).order_by()
+    item_buckets = bounded(OrderItem.objects.filter(order__status=PAID), 'order__created_at').annotate(
+        hour=TruncHour('order__created_at', tzinfo=dt_timezone.utc)
+    ).values('hour', 'menu_item_id').annotate(
+        quantity=Sum('quantity'), amount=Sum('subtotal')
+    ).order_by()
+
+    with transaction.atomic():
+        bounded(HourlySales.objects.all(), 'hour').delete()
+        bounded(HourlyItemSales.objects.all(), 'hour').delete()
+        HourlySales.objects.bulk_create(
+            [HourlySales(**bucket) for bucket in order_buckets], batch_size=500
+        )
+        HourlyItemSales.objects.bulk_create(
+            [HourlyItemSales(**bucket) for bucket in item_buckets], batch_size=500
+        )
@@ -1,8 +1,9 @@
 from channels.routing import ProtocolTypeRouter, URLRouter
+from django.core.asgi import get_asgi_application
 from django.urls import re_path
-from . import consumers
+from . import consumers, streams
 from chat.consumers import ChatConsumer
-from channels.auth import AuthMiddlewareStack
+from .middleware import TokenAuthMiddlewareStack
 
 websocket_urlpatterns = [
     re_path(r'ws/orders/$', consumers.OrderConsumer.as_asgi()),
@@ -10,8 +11,15 @@ websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<order_id>\d+)/$', ChatConsumer.as_asgi()),
 ]
 
+# Served ahead of Django: their clients wait without holding a thread
+http_urlpatterns = [
+    re_path(r'^api/orders/(?P<order_id>\d+)/events/$', streams.OrderEventStreamConsumer.as_asgi()),
+    re_path(r'^api/orders/(?P<order_id>\d+)/poll/$', streams.OrderLongPollConsumer.as_asgi()),
+]
+
 application = ProtocolTypeRouter({
-    'websocket': AuthMiddlewareStack(
+    'http': URLRouter(http_urlpatterns + [re_path(r'', get_asgi_application())]),
+    'websocket': TokenAuthMiddlewareStack(
         URLRouter(websocket_urlpatterns)
     ),
 })
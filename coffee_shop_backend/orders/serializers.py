@@ -1,4 +1,13 @@
+from decimal import Decimal
+
 from rest_framework import serializers
+from rest_framework.fields import DateTimeField, DecimalField
+from rest_framework.settings import ISO_8601, api_settings
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .fieldsets import FULL, FieldsetSerializerMixin
+from .images import FORMATS, srcset
 from .models import Category, MenuItem, Table, Order, OrderItem, BrokenItem, OrderReview
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.models import User, Group
@@ -9,15 +18,18 @@ class CategorySerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'description', 'created_at']
         read_only_fields = ['created_at']
 
-class MenuItemSerializer(serializers.ModelSerializer):
+class MenuItemSerializer(FieldsetSerializerMixin, serializers.ModelSerializer):
+    expansions = {'category': lambda: CategorySerializer(read_only=True)}
+
     category_name = serializers.CharField(source='category.name', read_only=True)
     image_url = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = MenuItem
         fields = [
             'id', 'name', 'description', 'price', 'category',
-            'category_name', 'image', 'image_url', 'is_available',
+            'category_name', 'image', 'image_url', 'image_srcset', 'is_available',
             'created_at', 'updated_at'
         ]
         read_only_fields = ['created_at', 'updated_at']
@@ -28,6 +40,16 @@ class MenuItemSerializer(serializers.ModelSerializer):
             return request.build_absolute_uri(obj.image.url)
         return None
 
+    def get_image_srcset(self, obj):
+        """srcset strings per format, e.g. {'webp': 'https://…/x.160w.webp 160w, …'}"""
+        request = self.context.get('request')
+        if not obj.image_variants or not request:
+            return None
+        return {
+            image_format: srcset(obj.image_variants, image_format, request.build_absolute_uri)
+            for image_format in FORMATS
+        }
+
 
 class TableSerializer(serializers.ModelSerializer):
     class Meta:
@@ -35,6 +57,10 @@ class TableSerializer(serializers.ModelSerializer):
         fields = ['id', 'table_number', 'qr_code', 'is_occupied']
 
 class OrderItemCreateSerializer(serializers.ModelSerializer):
+    # Resolved in bulk by OrderSerializer.validate_items instead of one
+    # query per line through PrimaryKeyRelatedField
+    menu_item = serializers.IntegerField()
+
     class Meta:
         model = OrderItem
         fields = ['menu_item', 'quantity', 'notes']
@@ -46,7 +72,7 @@ class OrderItemCreateSerializer(serializers.ModelSerializer):
 
 class OrderItemSerializer(serializers.ModelSerializer):
     menu_item_name = serializers.CharField(source='menu_item.name', read_only=True)
-    menu_item_price = serializers.DecimalField(source='menu_item.price', read_only=True,
+    menu_item_price = serializers.DecimalField(source='unit_price', read_only=True,
                                              max_digits=6, decimal_places=2)
     subtotal = serializers.DecimalField(read_only=True, max_digits=8, decimal_places=2)
     
@@ -63,20 +89,35 @@ class OrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = ['id', 'table', 'table_number', 'status', 'items', 
-                 'order_items', 'total_amount', 'created_at', 'updated_at']
-        read_only_fields = ['id', 'total_amount', 'created_at', 'updated_at']
+                 'order_items', 'total_amount', 'created_at', 'updated_at', 'version']
+        read_only_fields = ['id', 'total_amount', 'created_at', 'updated_at', 'version']
 
     def validate_items(self, value):
         if not value:
             raise serializers.ValidationError("At least one item is required")
-        
+
+        # Resolve every referenced menu item with a single IN query
+        menu_items = MenuItem.objects.in_bulk({item['menu_item'] for item in value})
+
         for item in value:
-            menu_item = item['menu_item']
+            menu_item = menu_items.get(item['menu_item'])
+            if menu_item is None:
+                raise serializers.ValidationError(
+                    f"Invalid pk \"{item['menu_item']}\" - object does not exist."
+                )
             if not menu_item.is_available:
                 raise serializers.ValidationError(f"{menu_item.name} is currently not available")
+            item['menu_item'] = menu_item
         
         return value
 
+    def validate_status(self, value):
+        # Status changes go through the state machine (update_status and
+        # cancel), which also checks the version
+        if self.instance is not None and value != self.instance.status:
+            raise serializers.ValidationError("Use update_status or cancel to change the status")
+        return value
+
     def validate_table(self, value):
         if not value.is_occupied:
             raise serializers.ValidationError("Cannot create order for unoccupied table")
@@ -84,21 +125,24 @@ class OrderSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         items_data = validated_data.pop('items')
-        
-        # Create order
-        order = Order.objects.create(**validated_data)
-        
-        # Create order items
-        order_items = []
-        for item_data in items_data:
-            order_items.append(OrderItem(order=order, **item_data))
-        OrderItem.objects.bulk_create(order_items)
-        
-        # Recalculate total
-        order.save()
-        
-        # Ensure the order is refreshed from the database
-        order.refresh_from_db()
+
+        # Menu items were resolved by validate_items, so the total is known
+        # before anything is written
+        total = sum(
+            item.get('quantity', 1) * item['menu_item'].price for item in items_data
+        )
+
+        with transaction.atomic():
+            order = Order(total_amount=total, **validated_data)
+            order.save(recalculate=False)
+            order_items = []
+            for item_data in items_data:
+                order_item = OrderItem(order=order, **item_data)
+                order_item.snapshot_price(item_data['menu_item'])
+                order_items.append(order_item)
+            OrderItem.objects.bulk_create(order_items)
+
+        order.forget_details()
         return order
 
     def to_representation(self, instance):
@@ -110,21 +154,163 @@ class OrderSerializer(serializers.ModelSerializer):
         return ret
 
     def update(self, instance, validated_data):
-        if 'items' in validated_data:
-            items_data = validated_data.pop('items')
-            instance.orderitem_set.all().delete()
-            
-            for item_data in items_data:
-                OrderItem.objects.create(order=instance, **item_data)
-        
-        for attr, value in validated_data.items():
-            setattr(instance, attr, value)
-        
-        instance.save()
+        # One transaction, so the order is touched and published once
+        with transaction.atomic():
+            if 'items' in validated_data:
+                items_data = validated_data.pop('items')
+                instance.orderitem_set.all().delete()
+
+                for item_data in items_data:
+                    OrderItem.objects.create(order=instance, **item_data)
+                instance.forget_details()
+
+            for attr, value in validated_data.items():
+                setattr(instance, attr, value)
+
+            instance.save()
         return instance
 
-class OrderReviewSerializer(serializers.ModelSerializer):
-    order_id = serializers.IntegerField(source='order.id', read_only=True)
+# Bound once: OrderReadSerializer formats values exactly as these fields do
+_datetime = DateTimeField().to_representation
+_total = DecimalField(max_digits=8, decimal_places=2).to_representation
+_price = DecimalField(max_digits=6, decimal_places=2).to_representation
+
+
+def _output_timezone():
+    """The zone DRF renders datetimes in, or None where only its field will do"""
+    if settings.USE_TZ and api_settings.DATETIME_FORMAT == ISO_8601:
+        return timezone.get_current_timezone()
+    return None
+
+
+def _timestamp(value, output_timezone):
+    # DateTimeField looks the zone up per value; here it is done once per call
+    if output_timezone is None or value is None or value.tzinfo is None:
+        return _datetime(value)
+    value = value.astimezone(output_timezone).isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+
+def _money(value, field):
+    # Decimals loaded from the database already have two places, so
+    # formatting them is all the field would do; anything else goes through it
+    if type(value) is Decimal:
+        text = f'{value:f}'
+        if text[-3:-2] == '.':
+            return text
+    return field(value)
+
+
+class OrderReadSerializer:
+    """
+    Read-only stand-in for ``OrderSerializer`` on the hot paths (order
+    lists, tracking, event payloads). It produces the same representation,
+    key for key, without DRF's per-field machinery, from orders loaded with
+    ``Order.objects.with_details()``; :meth:`from_queryset` builds it from
+    ``.values()`` rows without instantiating models at all. A ``fieldset``
+    in the context (see orders.fieldsets) prunes and expands it.
+    """
+
+    def __init__(self, instance, many=False, context=None, **kwargs):
+        self.instance = instance
+        self.many = many
+        self.context = context or {}
+
+    @property
+    def data(self):
+        output_timezone = _output_timezone()
+        fieldset = self.context.get('fieldset', FULL)
+        if self.many:
+            return [self.order(order, output_timezone, fieldset) for order in self.instance]
+        return self.order(self.instance, output_timezone, fieldset)
+
+    def order(self, order, output_timezone, fieldset=FULL):
+        # Relations the fieldset leaves out may not be loaded; never touch them
+        representation = self.represent(
+            order.id, order.table_id,
+            order.table.table_number if fieldset.wants('table_number') else None,
+            order.status,
+            [
+                self.represent_item(
+                    item.id, item.menu_item_id, item.menu_item.name, item.unit_price,
+                    item.quantity, item.notes, item.subtotal,
+                )
+                for item in order.orderitem_set.all()
+            ] if fieldset.wants('order_items') else None,
+            order.total_amount, order.created_at, order.updated_at, order.version,
+            output_timezone,
+        )
+        if fieldset is FULL:
+            return representation
+        if fieldset.expands('table'):
+            representation['table'] = TableSerializer(order.table, context=self.context).data
+        return fieldset.prune(representation)
+
+    @staticmethod
+    def represent(id, table, table_number, status, order_items, total_amount,
+                  created_at, updated_at, version, output_timezone):
+        return {
+            'id': id,
+            'table': table,
+            'table_number': table_number,
+            'status': status,
+            'order_items': order_items,
+            'total_amount': _money(total_amount, _total),
+            'created_at': _timestamp(created_at, output_timezone),
+            'updated_at': _timestamp(updated_at, output_timezone),
+            'version': version,
+        }
+
+    @staticmethod
+    def represent_item(id, menu_item, menu_item_name, unit_price, quantity, notes, subtotal):
+        return {
+            'id': id,
+            'menu_item': menu_item,
+            'menu_item_name': menu_item_name,
+            'menu_item_price': _money(unit_price, _price),
+            'quantity': quantity,
+            'notes': notes,
+            'subtotal': _money(subtotal, _total),
+        }
+
+    @classmethod
+    def from_queryset(cls, orders):
+        """Representations of ``orders`` (a queryset, in its order) in two queries"""
+        rows = list(orders.values_list(
+            'id', 'table_id', 'table__table_number', 'status',
+            'total_amount', 'created_at', 'updated_at', 'version',
+        ))
+        items = {row[0]: [] for row in rows}
+        lines = OrderItem.objects.filter(order_id__in=items).order_by('order_id', 'id').values_list(
+            'order_id', 'id', 'menu_item_id', 'menu_item__name',
+            'unit_price', 'quantity', 'notes', 'subtotal',
+        )
+        for order_id, *line in lines:
+            items[order_id].append(cls.represent_item(*line))
+        output_timezone = _output_timezone()
+        return [
+            cls.represent(
+                id, table, number, status, items[id], total, created, updated, version, output_timezone
+            )
+            for id, table, number, status, total, created, updated, version in rows
+        ]
+
+
+class OrderField(serializers.Field):
+    """An order nested in its read representation; read only."""
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return OrderReadSerializer(value).data
+
+
+class OrderReviewSerializer(FieldsetSerializerMixin, serializers.ModelSerializer):
+    expansions = {'order': lambda: OrderField()}
+
+    order_id = serializers.IntegerField(read_only=True)
     order_items = serializers.SerializerMethodField()
     order_date = serializers.DateTimeField(source='order.created_at', read_only=True)
     
@@ -135,11 +321,14 @@ class OrderReviewSerializer(serializers.ModelSerializer):
         extra_kwargs = {'order': {'write_only': True}}
     
     def get_order_items(self, obj):
+        items = obj.order.orderitem_set.all()
+        if 'orderitem_set' not in getattr(obj.order, '_prefetched_objects_cache', {}):
+            items = items.select_related('menu_item')
         return [{
             'name': item.menu_item.name,
             'quantity': item.quantity,
-            'price': str(item.menu_item.price)
-        } for item in obj.order.orderitem_set.all()]
+            'price': str(item.unit_price)
+        } for item in items]
 
 class BrokenItemSerializer(serializers.ModelSerializer):
     class Meta:
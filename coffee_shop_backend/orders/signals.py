@@ -1,30 +1,129 @@
-from django.db.models.signals import post_save
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-from .models import Order
-from .serializers import OrderSerializer
+from django.utils import timezone
+from . import auth, batches, conditional, events, images, rollups
+from .catalog import bump_catalog_version
+from .models import Category, MenuItem, Order, OrderItem, order_updated
+
+
+@receiver([post_save, post_delete], sender=MenuItem)
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_catalog_cache(sender, **kwargs):
+    # Bump after commit so a concurrent reader cannot cache the old rows
+    # under the new version
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver([post_save, post_delete], sender=get_user_model())
+def invalidate_cached_principal(sender, instance, **kwargs):
+    # After commit, for the same reason as the catalog version
+    transaction.on_commit(lambda: auth.forget_user(instance))
+
+
+@receiver(post_save, sender=MenuItem)
+def generate_image_variants(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    transaction.on_commit(lambda: images.schedule_variants(instance))
+
 
 @receiver(post_save, sender=Order)
-def order_post_save(sender, instance, created, **kwargs):
-    channel_layer = get_channel_layer()
-    serialized_order = OrderSerializer(instance).data
-
-    if created:
-        # Broadcast new order
-        async_to_sync(channel_layer.group_send)(
-            "orders",
-            {
-                "type": "new_order",
-                "content": serialized_order
-            }
-        )
-    else:
-        # Broadcast order update
-        async_to_sync(channel_layer.group_send)(
-            "orders",
-            {
-                "type": "order_update",
-                "content": serialized_order
-            }
-        )
+def publish_order_change(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    # Connected before update_sales_rollup, so the remembered state still
+    # holds the status the order had before this save
+    previous = getattr(instance, '_rollup_state', None)
+    events.order_changed(instance, created, previous_status=previous[0] if previous else None)
+
+
+@receiver(post_save, sender=Order)
+def update_sales_rollup(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    rollups.apply_order_change(instance, getattr(instance, '_rollup_state', None))
+    instance.remember_rollup_state()
+
+
+@receiver(post_save, sender=Order)
+def update_order_version(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    order_written(instance.pk)
+    order_id, updated_at = instance.pk, instance.updated_at
+    transaction.on_commit(lambda: conditional.set_order_version(order_id, updated_at))
+
+
+@receiver(order_updated, sender=Order)
+def apply_order_update(sender, order, previous_status, **kwargs):
+    """
+    What the post_save receivers above do for a save, done for a
+    conditional update in one step once the transaction commits
+    """
+    def add(batch):
+        # The order as last written, and the status it had before the
+        # transaction's first update
+        batch[order.pk] = (order, batch.get(order.pk, (None, previous_status))[1])
+
+    order_written(order.pk)
+    batches.collect('order_updates', add, apply_order_updates)
+
+
+def apply_order_updates(updates):
+    changes = {}
+    for order, left in updates.values():
+        # Only the status moves an order between buckets here
+        if left is not None:
+            rollups.order_changes(order, (left, order.total_amount, order.created_at), changes)
+    rollups.apply(changes)
+    for order, _ in updates.values():
+        conditional.set_order_version(order.pk, order.updated_at)
+    events.dispatch(
+        dict.fromkeys(updates, False),
+        {order_id: left for order_id, (_, left) in updates.items()},
+        orders=[order for order, _ in updates.values()],
+    )
+
+
+@receiver([post_save, post_delete], sender=OrderItem)
+def touch_order(sender, instance, raw=False, **kwargs):
+    """
+    A changed line changes the order's representation, so move its
+    updated_at and version: once per order when the transaction commits,
+    however many of its lines changed
+    """
+    if raw:
+        return
+    batches.collect(
+        'touched_orders', lambda batch: batch.setdefault(instance.order_id, False), touch_orders
+    )
+
+
+def order_written(order_id):
+    """
+    The order row itself was written in this transaction, which moved its
+    version already; its lines need not touch it again (so the version a
+    PUT answers with is still current once it commits)
+    """
+    batches.collect('touched_orders', lambda batch: batch.__setitem__(order_id, True), touch_orders)
+
+
+def touch_orders(touched):
+    updated_at = timezone.now()
+    for order_id, written in touched.items():
+        if written:
+            continue
+        # Orders deleted along with their lines match nothing
+        if Order.objects.filter(pk=order_id).update(updated_at=updated_at, version=F('version') + 1):
+            conditional.set_order_version(order_id, updated_at)
+
+
+@receiver(pre_delete, sender=Order)
+def remove_from_sales_rollup(sender, instance, **kwargs):
+    rollups.remove_order(
+        instance, (instance.status, instance.total_amount, instance.created_at)
+    )
+
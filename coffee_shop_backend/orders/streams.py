@@ -0,0 +1,226 @@
+"""
+Order tracking over plain HTTP, for clients that cannot keep a WebSocket
+to ``ws/order/<id>/`` open.
+
+``/api/orders/<id>/events/`` is a Server-Sent Events stream: the current
+order, then every change as an ``order_update`` message (the same JSON
+the WebSocket tracker sends), with the order's ``updated_at`` as the
+event id. A comment line every ``ORDER_STREAM_KEEPALIVE`` seconds keeps
+proxies from dropping an idle stream, and the stream ends after
+``ORDER_STREAM_TIMEOUT`` seconds; EventSource then reconnects with
+``Last-Event-ID`` and gets no repeat of a state it already has.
+
+``/api/orders/<id>/poll/?since=<updated_at>`` answers at once when the
+order differs from ``since`` and otherwise waits for the next change, up
+to ``ORDER_LONG_POLL_TIMEOUT`` seconds (or ``?timeout=``, if shorter),
+then answers 204 and the client polls again.
+
+Both are channels consumers in the ``order_<id>`` group the WebSocket
+tracker uses, routed ahead of Django in the ASGI application, so a
+waiting client is a coroutine rather than a thread, holds no database
+connection and wakes only when an order event arrives. The only lookup
+they make is the order's version, which is normally a cache read (see
+orders.conditional).
+"""
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.exceptions import StopConsumer
+from channels.generic.http import AsyncHttpConsumer
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from coffee_shop_backend import fastjson
+
+from . import conditional, events
+from .framing import encode
+from .models import Order
+from .serializers import OrderReadSerializer
+
+logger = logging.getLogger(__name__)
+
+ORDER_STREAM_TIMEOUT = getattr(settings, 'ORDER_STREAM_TIMEOUT', 300)
+ORDER_STREAM_KEEPALIVE = getattr(settings, 'ORDER_STREAM_KEEPALIVE', 15)
+ORDER_LONG_POLL_TIMEOUT = getattr(settings, 'ORDER_LONG_POLL_TIMEOUT', 25)
+
+NOT_FOUND = fastjson.dumps({'error': 'Order not found'}).encode()
+
+
+@database_sync_to_async
+def get_version(order_id):
+    return conditional.get_order_version(order_id)
+
+
+@database_sync_to_async
+def get_order(order_id):
+    order = Order.objects.with_details().filter(pk=order_id).first()
+    return OrderReadSerializer(order).data if order is not None else None
+
+
+def cors_headers(scope):
+    """What CorsMiddleware would add; these responses never pass through it."""
+    origin = dict(scope.get('headers', ())).get(b'origin')
+    if origin is None:
+        return []
+    allowed = getattr(settings, 'CORS_ALLOWED_ORIGINS', ())
+    if not getattr(settings, 'CORS_ALLOW_ALL_ORIGINS', False) and origin.decode() not in allowed:
+        return []
+    headers = [(b'access-control-allow-origin', origin), (b'vary', b'Origin')]
+    if getattr(settings, 'CORS_ALLOW_CREDENTIALS', False):
+        headers.append((b'access-control-allow-credentials', b'true'))
+    return headers
+
+
+class OrderWaitConsumer(AsyncHttpConsumer):
+    """
+    Joins ``order_<id>`` and stays open after ``handle`` returns, until
+    :meth:`finish` or the client disconnects; the events go to
+    :meth:`changed`.
+    """
+    started = False
+    finished = False
+
+    async def http_request(self, message):
+        # Unlike AsyncHttpConsumer's, returns without stopping the consumer
+        if 'body' in message:
+            self.body.append(message['body'])
+        if not message.get('more_body'):
+            self.order_id = self.scope['url_route']['kwargs']['order_id']
+            self.group_name = f'order_{self.order_id}'
+            self.params = parse_qs(self.scope.get('query_string', b'').decode())
+            # Joined before the version is read, so no change falls in between
+            await self.channel_layer.group_add(self.group_name, self.channel_name)
+            self.timers = []
+            try:
+                await self.handle(b''.join(self.body))
+            except Exception:
+                logger.exception(f"Error waiting on order {self.order_id}")
+                await self.finish(500)
+
+    async def send_headers(self, **kwargs):
+        self.started = True
+        await super().send_headers(**kwargs)
+
+    def after(self, delay, coroutine_function):
+        async def run():
+            await asyncio.sleep(delay)
+            await coroutine_function()
+        self.timers.append(asyncio.get_running_loop().create_task(run()))
+
+    def since(self, header=None):
+        """The ``updated_at`` the client already has, if it said so."""
+        value = self.params.get('since', [None])[0]
+        if value is None and header is not None:
+            value = dict(self.scope.get('headers', ())).get(header, b'').decode() or None
+        return parse_datetime(value) if value else None
+
+    async def finish(self, status=None, body=b''):
+        """
+        End the response (a complete one with ``status`` and a JSON
+        ``body`` unless it has started) and stop the consumer.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        if status is None or self.started:
+            await self.send_body(b'')
+        else:
+            headers = [(b'cache-control', b'no-cache'), *cors_headers(self.scope)]
+            if body:
+                headers.append((b'content-type', b'application/json'))
+            await self.send_response(status, body, headers=headers)
+        # Stopping happens in the consumer's own loop, where StopConsumer is caught
+        await self.channel_layer.send(self.channel_name, {'type': 'wait.finished'})
+
+    async def wait_finished(self, message):
+        await self.disconnect()
+        raise StopConsumer()
+
+    async def disconnect(self):
+        for timer in getattr(self, 'timers', ()):
+            timer.cancel()
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def order_update(self, event):
+        if not self.finished:
+            order_data = event['order']
+            if event['type'] == 'order_update' and 'frames' in event:
+                frame = event['frames']['json']
+            else:
+                # Trackers only know order_update messages
+                frame = encode(events.as_message(event['seq'], 'order_update', order_data), 'json')
+            await self.changed(order_data, frame)
+
+    async def new_order(self, event):
+        await self.order_update(event)
+
+
+class OrderEventStreamConsumer(OrderWaitConsumer):
+    """``text/event-stream`` of one order's updates."""
+    updated_at = None
+
+    async def handle(self, body):
+        current = await get_version(self.order_id)
+        if current is None:
+            await self.finish(404, NOT_FOUND)
+            return
+
+        await self.send_headers(headers=[
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            # Tells nginx not to buffer the stream
+            (b'x-accel-buffering', b'no'),
+            *cors_headers(self.scope),
+        ])
+        await self.send_body(b'retry: 1000\n\n', more_body=True)
+        if self.since(b'last-event-id') != current:
+            order_data = await get_order(self.order_id)
+            if order_data is not None:
+                await self.changed(order_data, encode({'type': 'order_update', 'order': order_data}, 'json'))
+
+        self.after(ORDER_STREAM_TIMEOUT, self.finish)
+        self.keepalive()
+
+    def keepalive(self):
+        async def ping():
+            if not self.finished:
+                await self.send_body(b': keepalive\n\n', more_body=True)
+                self.keepalive()
+        self.after(ORDER_STREAM_KEEPALIVE, ping)
+
+    async def changed(self, order_data, frame):
+        updated_at = parse_datetime(order_data.get('updated_at') or '')
+        if updated_at is not None:
+            # Skip states this client was already sent, and older ones
+            if self.updated_at is not None and updated_at <= self.updated_at:
+                return
+            self.updated_at = updated_at
+        event_id = order_data.get('updated_at') or ''
+        await self.send_body(f'id: {event_id}\ndata: {frame}\n\n'.encode(), more_body=True)
+
+
+class OrderLongPollConsumer(OrderWaitConsumer):
+    """One response per change: at once if the client is behind, else on the next one."""
+
+    async def handle(self, body):
+        current = await get_version(self.order_id)
+        if current is None:
+            await self.finish(404, NOT_FOUND)
+            return
+        if self.since() != current:
+            order_data = await get_order(self.order_id)
+            await self.finish(200, encode({'type': 'order_update', 'order': order_data}, 'json').encode())
+            return
+
+        timeout = ORDER_LONG_POLL_TIMEOUT
+        try:
+            timeout = min(timeout, float(self.params['timeout'][0]))
+        except (KeyError, ValueError):
+            pass
+        self.after(max(timeout, 0), lambda: self.finish(204))
+
+    async def changed(self, order_data, frame):
+        await self.finish(200, frame.encode())
@@ -1,3 +1,1593 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+from decimal import Decimal
 
-# Create your tests here.
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.consumers import ChatConsumer
+
+from . import auth, consumers, events, framing, images, loadtest, outbound, rollups, streams
+from .catalog import bump_catalog_version
+from .framing import FramedConsumerMixin
+from .outbound import OutboundQueueMixin
+from .models import (
+    Category, HourlyItemSales, HourlySales, MenuItem, Order, OrderEvent, OrderItem, OrderReview, Table
+)
+from .consumers import OrderTrackingConsumer
+from .middleware import TokenAuthMiddleware
+from .routing import application
+from .serializers import OrderReadSerializer, OrderSerializer
+
+
+def use_own_cache(test):
+    """
+    Give ``test`` empty caches of its own. Cached order versions, chat
+    history and catalog bodies would otherwise carry over between tests,
+    whose database ids repeat, and the catalog would be written to the
+    directory a running server uses.
+    """
+    test.enterContext(override_settings(CACHES={
+        alias: {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': f'{test.id()}:{alias}',
+        }
+        for alias in ('default', 'catalog')
+    }))
+
+
+class OrderFixturesMixin:
+    """Small menu and an occupied table shared by the order tests."""
+
+    def setUp(self):
+        use_own_cache(self)
+        self.client = APIClient()
+        self.category = Category.objects.create(name='Coffee')
+        self.menu_items = [
+            MenuItem.objects.create(
+                name=f'Item {i}',
+                description='',
+                price=Decimal('2.50') + i,
+                category=self.category,
+            )
+            for i in range(10)
+        ]
+        self.table = Table.objects.create(table_number=1, is_occupied=True)
+
+    def create_order(self, line_count):
+        response = self.client.post(
+            '/api/orders/', self.order_payload(line_count), format='json'
+        )
+        return Order.objects.get(pk=response.data['id'])
+
+    def order_payload(self, line_count):
+        return {
+            'table': self.table.id,
+            'items': [
+                {'menu_item': item.id, 'quantity': 2}
+                for item in self.menu_items[:line_count]
+            ],
+        }
+
+
+class OrderCreateTests(OrderFixturesMixin, TestCase):
+    def post_order(self, line_count):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                '/api/orders/', self.order_payload(line_count), format='json'
+            )
+        self.assertEqual(response.status_code, 201, response.content)
+        return response, len(queries)
+
+    def test_create_computes_total_from_menu_prices(self):
+        response, _ = self.post_order(3)
+        order = Order.objects.get(pk=response.data['id'])
+        self.assertEqual(order.total_amount, Decimal('2') * (Decimal('2.50') + Decimal('3.50') + Decimal('4.50')))
+        self.assertEqual(order.orderitem_set.count(), 3)
+
+    def test_query_count_does_not_grow_with_lines(self):
+        self.post_order(1)  # creates this hour's sales rollup bucket
+        _, one_line = self.post_order(1)
+        _, ten_lines = self.post_order(10)
+        self.assertEqual(one_line, ten_lines)
+
+    def test_unknown_menu_item_is_rejected(self):
+        payload = self.order_payload(1)
+        payload['items'].append({'menu_item': 9999, 'quantity': 1})
+        response = self.client.post('/api/orders/', payload, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_unavailable_menu_item_is_rejected(self):
+        self.menu_items[0].is_available = False
+        self.menu_items[0].save()
+        response = self.client.post('/api/orders/', self.order_payload(2), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+
+class PriceSnapshotTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.order = self.create_order(2)
+
+    def test_lines_keep_price_after_menu_edit(self):
+        menu_item = self.menu_items[0]
+        menu_item.price = Decimal('99.00')
+        menu_item.save()
+
+        line = self.order.orderitem_set.get(menu_item=menu_item)
+        self.assertEqual(line.unit_price, Decimal('2.50'))
+        self.assertEqual(line.subtotal, Decimal('5.00'))
+        self.assertEqual(self.order.calculate_total(), Decimal('12.00'))
+
+    def test_save_snapshots_current_price(self):
+        line = OrderItem.objects.create(order=self.order, menu_item=self.menu_items[5], quantity=3)
+        self.assertEqual(line.unit_price, Decimal('7.50'))
+        self.assertEqual(line.subtotal, Decimal('22.50'))
+
+    def test_analytics_revenue_does_not_join_menu(self):
+        self.order.status = 'paid'
+        self.order.save()
+        today = self.order.created_at.date().isoformat()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                '/api/orders/analytics/', {'start_date': today, 'end_date': today}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['period_sales']['amount'], 12.0)
+        self.assertEqual(
+            sorted(item['total_sales'] for item in response.data['top_selling_items']),
+            [5.0, 7.0],
+        )
+        joins = [q['sql'] for q in queries.captured_queries if 'JOIN "orders_menuitem"' in q['sql']]
+        self.assertEqual(joins, [])
+
+
+class OrderReadQueryBudgetTests(OrderFixturesMixin, TestCase):
+    """Order read paths must not issue queries per order or per line."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('staff', password='secret')
+        self.client.force_authenticate(self.user)
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        return len(queries)
+
+    def get_ok(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    def test_list_is_constant_in_orders_and_lines(self):
+        self.create_order(1)
+        few = self.count_queries(lambda: self.get_ok('/api/orders/'))
+        for line_count in range(2, 10):
+            self.create_order(line_count)
+        many = self.count_queries(lambda: self.get_ok('/api/orders/'))
+        self.assertEqual(few, many)
+
+    def test_retrieve_is_constant_in_lines(self):
+        small = self.create_order(1)
+        large = self.create_order(10)
+        self.assertEqual(
+            self.count_queries(lambda: self.get_ok(f'/api/orders/{small.pk}/')),
+            self.count_queries(lambda: self.get_ok(f'/api/orders/{large.pk}/')),
+        )
+
+    def test_track_is_constant_in_lines(self):
+        small = self.create_order(1)
+        large = self.create_order(10)
+        self.assertEqual(
+            self.count_queries(lambda: self.get_ok(f'/api/orders/{small.pk}/track/')),
+            self.count_queries(lambda: self.get_ok(f'/api/orders/{large.pk}/track/')),
+        )
+
+    def test_broadcast_payload_is_constant_in_lines(self):
+        small = self.create_order(1)
+        large = self.create_order(10)
+        self.assertEqual(
+            self.count_queries(lambda: events.publish({small.pk: False})),
+            self.count_queries(lambda: events.publish({large.pk: False})),
+        )
+
+
+class OrderReadSerializerTests(OrderFixturesMixin, TestCase):
+    """OrderReadSerializer must render exactly what OrderSerializer does."""
+
+    def setUp(self):
+        super().setUp()
+        for line_count in (1, 3, 10):
+            self.create_order(line_count)
+        noted = self.create_order(2)
+        noted.orderitem_set.update(notes='Sans sucre, "extra" hot \u2615\n')
+        expensive = MenuItem.objects.create(
+            name='Caf\u00e9 cr\u00e8me', description='', price=Decimal('9999.99'), category=self.category
+        )
+        OrderItem.objects.create(order=noted, menu_item=expensive, quantity=7)
+        noted.save()
+        self.empty = Order.objects.create(table=self.table, status='confirmed')
+
+    def assertRendersLike(self, fast, drf):
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(fast), renderer.render(drf))
+
+    def test_prefetched_orders(self):
+        orders = Order.objects.with_details().order_by('-created_at', '-id')
+        self.assertRendersLike(
+            OrderReadSerializer(orders, many=True).data,
+            OrderSerializer(orders, many=True).data,
+        )
+
+    def test_values_rows(self):
+        orders = Order.objects.order_by('-created_at', '-id')
+        self.assertRendersLike(
+            OrderReadSerializer.from_queryset(orders),
+            OrderSerializer(orders, many=True).data,
+        )
+
+    def test_instances_fresh_from_save(self):
+        # Totals still as computed in Python, timestamps with microseconds
+        self.assertEqual(self.empty.total_amount, 0)
+        order = Order.objects.with_details().exclude(pk=self.empty.pk).first()
+        order.status = 'ready'
+        order.save()
+        for instance in (self.empty, order):
+            self.assertRendersLike(OrderReadSerializer(instance).data, OrderSerializer(instance).data)
+
+    def test_current_time_zone_is_honoured(self):
+        orders = Order.objects.with_details()
+        with timezone.override('America/New_York'):
+            self.assertRendersLike(
+                OrderReadSerializer(orders, many=True).data,
+                OrderSerializer(orders, many=True).data,
+            )
+            self.assertRendersLike(
+                OrderReadSerializer.from_queryset(Order.objects.all()),
+                OrderSerializer(orders, many=True).data,
+            )
+
+
+class FieldsetTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(User.objects.create_user('staff', password='secret'))
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        return response, [query['sql'] for query in queries.captured_queries]
+
+    def test_order_badges_skip_lines_and_table(self):
+        for line_count in (1, 5):
+            self.create_order(line_count)
+        full, full_queries = self.get('/api/orders/')
+        badges, queries = self.get('/api/orders/?fields=id,status,total_amount')
+
+        self.assertEqual(badges.status_code, 200, badges.content)
+        self.assertEqual(
+            badges.json()['results'],
+            [{key: order[key] for key in ('id', 'status', 'total_amount')} for order in full.json()['results']],
+        )
+        self.assertEqual(len(queries), len(full_queries) - 1)
+        self.assertFalse([sql for sql in queries if 'orders_orderitem' in sql or 'orders_table' in sql])
+
+    def test_order_expand_table(self):
+        order = self.create_order(2)
+        response, _ = self.get(f'/api/orders/{order.pk}/?fields=id,table&expand=table')
+        self.assertEqual(response.json(), {
+            'id': order.pk,
+            'table': {'id': self.table.pk, 'table_number': 1, 'qr_code': None, 'is_occupied': True},
+        })
+        response, queries = self.get(f'/api/orders/{order.pk}/track/?fields=status')
+        self.assertEqual(response.json(), {'status': 'pending'})
+        self.assertEqual(len(queries), 1)
+
+    def test_unknown_names_are_rejected(self):
+        response, _ = self.get('/api/orders/?fields=id,secret')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('secret', response.json()['fields'][0])
+        response, _ = self.get('/api/menu-items/?expand=items')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('expand', response.json())
+
+    def test_menu_fields_and_expand(self):
+        response, queries = self.get('/api/menu-items/?fields=id,name')
+        self.assertEqual(response.json()[0], {'id': self.menu_items[0].pk, 'name': 'Item 0'})
+        self.assertFalse([sql for sql in queries if 'orders_category' in sql])
+
+        response, _ = self.get('/api/menu-items/?fields=id,category&expand=category')
+        self.assertEqual(response.json()[0]['category']['name'], 'Coffee')
+
+    def test_review_list_queries_do_not_grow(self):
+        OrderReview.objects.create(order=self.create_order(3), rating=5)
+        _, few = self.get('/api/reviews/')
+        for line_count in (1, 2, 4):
+            OrderReview.objects.create(order=self.create_order(line_count), rating=4)
+        response, many = self.get('/api/reviews/')
+        self.assertEqual(len(response.json()['results']), 4)
+        self.assertEqual(len(few), len(many))
+
+        response, queries = self.get('/api/reviews/?fields=id,rating')
+        self.assertEqual(set(response.json()['results'][0]), {'id', 'rating'})
+        self.assertEqual(len(queries), 1)
+
+        response, _ = self.get('/api/reviews/?fields=id,order&expand=order')
+        order = response.json()['results'][0]['order']
+        self.assertEqual(len(order['order_items']), 4)
+        self.assertEqual(order['table_number'], 1)
+
+
+class ConditionalGetTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order = self.create_order(2)
+        self.url = f'/api/orders/{self.order.pk}/track/'
+
+    def get(self, url=None, **headers):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url or self.url, **headers)
+        return response, len(queries)
+
+    def test_unchanged_order_is_304_without_queries(self):
+        first, _ = self.get()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first['Cache-Control'], 'no-cache')
+        self.assertTrue(first.has_header('Last-Modified'))
+
+        for headers in (
+            {'HTTP_IF_NONE_MATCH': first['ETag']},
+            {'HTTP_IF_NONE_MATCH': 'W/' + first['ETag']},
+            {'HTTP_IF_MODIFIED_SINCE': first['Last-Modified']},
+        ):
+            response, queries = self.get(**headers)
+            self.assertEqual(response.status_code, 304, headers)
+            self.assertEqual(response['ETag'], first['ETag'])
+            self.assertEqual(queries, 0)
+
+    def test_changes_move_the_etag(self):
+        first, _ = self.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.status = 'preparing'
+            self.order.save()
+        second, _ = self.get(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()['status'], 'preparing')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            OrderItem.objects.create(order=self.order, menu_item=self.menu_items[5], quantity=1)
+        third, _ = self.get(HTTP_IF_NONE_MATCH=second['ETag'])
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(len(third.json()['order_items']), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.menu_items[0].name = 'Flat white'
+            self.menu_items[0].save()
+        fourth, _ = self.get(HTTP_IF_NONE_MATCH=third['ETag'])
+        self.assertEqual(fourth.status_code, 200)
+        self.assertEqual(fourth.json()['order_items'][0]['menu_item_name'], 'Flat white')
+
+    def test_line_changes_touch_the_order_once_per_transaction(self):
+        def touches(change):
+            with CaptureQueriesContext(connection) as queries:
+                with self.captureOnCommitCallbacks(execute=True):
+                    try:
+                        with transaction.atomic():
+                            change()
+                    except ValueError:
+                        pass
+            return [q for q in queries if q['sql'].startswith('UPDATE "orders_order"')]
+
+        def replace_lines():
+            self.order.orderitem_set.all().delete()
+            for item in self.menu_items[:3]:
+                OrderItem.objects.create(order=self.order, menu_item=item, quantity=1)
+
+        def rolled_back():
+            OrderItem.objects.create(order=self.order, menu_item=self.menu_items[5], quantity=1)
+            raise ValueError
+
+        first, _ = self.get()
+        self.assertEqual(len(touches(replace_lines)), 1)
+        second, _ = self.get(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(len(second.json()['order_items']), 3)
+        # A client that read the old lines cannot write over the new ones
+        self.assertEqual(second.json()['version'], first.json()['version'] + 1)
+
+        self.assertEqual(touches(rolled_back), [])
+        third, _ = self.get(HTTP_IF_NONE_MATCH=second['ETag'])
+        self.assertEqual(third.status_code, 304)
+
+    def test_fieldsets_have_their_own_etag(self):
+        full, _ = self.get()
+        response, _ = self.get(self.url + '?fields=status', HTTP_IF_NONE_MATCH=full['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'pending'})
+        self.assertNotEqual(response['ETag'], full['ETag'])
+
+    def test_retrieve_and_missing_orders(self):
+        first, _ = self.get(f'/api/orders/{self.order.pk}/')
+        response, _ = self.get(f'/api/orders/{self.order.pk}/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response, _ = self.get('/api/orders/9999/track/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(ORDER_EVENTS_ASYNC=False)
+class OrderEventTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.layer = get_channel_layer()
+        async_to_sync(self.layer.flush)()
+
+    def subscribe(self, group):
+        channel = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(group, channel)
+        return channel
+
+    def received(self, channel):
+        async def drain():
+            messages = []
+            while True:
+                try:
+                    messages.append(await asyncio.wait_for(self.layer.receive(channel), 0.05))
+                except asyncio.TimeoutError:
+                    return messages
+        return async_to_sync(drain)()
+
+    def test_new_order_is_announced_once_to_every_group(self):
+        kitchen, menu = self.subscribe('orders'), self.subscribe('menu_orders')
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.create_order(3)
+
+        for channel in (kitchen, menu):
+            messages = self.received(channel)
+            self.assertEqual([message['type'] for message in messages], ['new_order'])
+            self.assertEqual(messages[0]['order']['id'], order.pk)
+            self.assertEqual(len(messages[0]['order']['order_items']), 3)
+
+    def test_status_change_is_sent_after_commit_with_one_payload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.create_order(1)
+        channels = [self.subscribe(group) for group in events.order_groups(order.pk)]
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(
+                f'/api/orders/{order.pk}/update_status/', {'status': 'confirmed'}, format='json'
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual([self.received(channel) for channel in channels], [[], [], []])
+
+        for callback in callbacks:
+            callback()
+        payloads = [self.received(channel) for channel in channels]
+        self.assertEqual(payloads[0], payloads[1])
+        self.assertEqual(payloads[0], payloads[2])
+        self.assertEqual(len(payloads[0]), 1)
+        self.assertEqual(payloads[0][0]['type'], 'order_update')
+        self.assertEqual(payloads[0][0]['order']['status'], 'confirmed')
+
+    def test_saves_within_a_transaction_are_coalesced(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.create_order(1)
+        channel = self.subscribe(f'order_{order.pk}')
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                for status in ('preparing', 'ready', 'delivered'):
+                    order.status = status
+                    order.save()
+
+        messages = self.received(channel)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['order']['status'], 'delivered')
+
+    def test_rolled_back_changes_are_not_published(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.create_order(1)
+        channel = self.subscribe('orders')
+        # Something unrelated is still waiting for the commit
+        transaction.on_commit(lambda: None)
+        try:
+            with transaction.atomic():
+                order.status = 'cancelled'
+                order.save()
+                raise ValueError
+        except ValueError:
+            pass
+
+        with self.captureOnCommitCallbacks(execute=True):
+            other = self.create_order(1)
+        messages = self.received(channel)
+        self.assertEqual([message['order']['id'] for message in messages], [other.pk])
+
+
+@override_settings(ORDER_EVENTS_ASYNC=False)
+class OrderTransitionTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order = self.create_order(2)
+
+    def post(self, action, **data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/orders/{self.order.pk}/{action}/', data, format='json')
+
+    def test_status_follows_the_state_machine(self):
+        for version, new_status in enumerate(loadtest.STATUS_FLOW, start=2):
+            response = self.post('update_status', status=new_status)
+            self.assertEqual(response.status_code, 200, new_status)
+            self.assertEqual(response.data['order']['status'], new_status)
+            self.assertEqual(response.data['order']['version'], version)
+
+        # Not a conflict: no retry makes these legal
+        response = self.post('update_status', status='pending')
+        self.assertEqual(response.status_code, 400)
+        response = self.post('cancel', version=Order.objects.get(pk=self.order.pk).version)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cannot move from paid', response.data['error'])
+        self.assertEqual(self.post('update_status', status='lost').status_code, 400)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, 'paid')
+        response = self.client.post(f'/api/orders/{self.order.pk + 1}/update_status/', {'status': 'confirmed'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_status_change_is_one_conditional_update(self):
+        # Another order already opened this hour's confirmed bucket
+        with self.captureOnCommitCallbacks(execute=True):
+            other = self.create_order(1)
+        self.post('update_status', status='confirmed')
+        self.order, other = other, self.order
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post('update_status', status='confirmed')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['order']['status'], 'confirmed')
+        statements = [
+            q['sql'] for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))
+        ]
+        # The write comes first: nothing is read to decide it
+        self.assertTrue(statements[0].startswith('UPDATE "orders_order"'))
+        self.assertIn('"version"', statements[0])
+        self.assertEqual(len([q for q in statements if q.startswith('UPDATE "orders_order"')]), 1)
+        # The response and the event share one reload, both rollup buckets
+        # move in one UPDATE, and the event buffer is not pruned every time
+        self.assertEqual(len([q for q in statements if q.startswith('SELECT')]), 2)
+        self.assertEqual(len([q for q in statements if 'orders_hourlysales' in q]), 1)
+        self.assertEqual(len([q for q in statements if q.startswith('INSERT INTO "orders_orderevent"')]), 1)
+        self.assertEqual(len(statements), 5)
+        self.assertFalse([q for q in statements if 'SUM(' in q])
+        self.assertEqual(
+            dict(HourlySales.objects.values_list('status', 'order_count')),
+            {'pending': 0, 'confirmed': 2},
+        )
+
+    def test_stale_version_is_a_conflict(self):
+        version = self.client.get(f'/api/orders/{self.order.pk}/').json()['version']
+        first = self.post('update_status', status='confirmed', version=version)
+        self.assertEqual(first.status_code, 200)
+        # A second screen acting on what it read before the first change
+        second = self.post('cancel', version=version)
+        self.assertEqual(second.status_code, 409)
+        third = self.post('update_table', table_id=self.table.pk, version=version)
+        self.assertEqual(third.status_code, 409)
+
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertEqual((order.status, order.version), ('confirmed', version + 1))
+        self.assertEqual(self.post('cancel', version=order.version).status_code, 200)
+        self.assertEqual(self.post('update_status', status='confirmed', version='x').status_code, 400)
+
+    def test_edits_cannot_change_the_status(self):
+        self.client.force_authenticate(User.objects.create_user('staff'))
+        url = f'/api/orders/{self.order.pk}/'
+        for method in (self.client.patch, self.client.put):
+            response = method(url, {'table': self.table.pk, 'status': 'paid', 'items': [
+                {'menu_item': self.menu_items[0].pk, 'quantity': 1},
+            ]}, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('status', response.data)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, 'pending')
+
+        response = self.client.patch(url, {'status': 'pending'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_edits_answer_with_the_version_they_committed(self):
+        self.client.force_authenticate(User.objects.create_user('staff'))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f'/api/orders/{self.order.pk}/', {'items': [
+                {'menu_item': self.menu_items[0].pk, 'quantity': 3},
+            ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['version'], Order.objects.get(pk=self.order.pk).version)
+        response = self.post('update_status', status='confirmed', version=response.data['version'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_transitions_keep_events_rollup_and_etag_current(self):
+        channel = async_to_sync(get_channel_layer().new_channel)()
+        async_to_sync(get_channel_layer().group_add)(f'order_{self.order.pk}', channel)
+        etag = self.client.get(f'/api/orders/{self.order.pk}/track/')['ETag']
+
+        other = Table.objects.create(table_number=2, is_occupied=True)
+        self.assertEqual(self.post('update_table', table_id=other.pk).status_code, 200)
+        self.assertEqual(self.post('update_status', status='confirmed').status_code, 200)
+
+        message = async_to_sync(get_channel_layer().receive)(channel)
+        message = async_to_sync(get_channel_layer().receive)(channel)
+        self.assertEqual(message['order']['status'], 'confirmed')
+        self.assertEqual(message['order']['table'], other.pk)
+        self.assertEqual(message['order']['version'], 3)
+        self.assertEqual(
+            list(HourlySales.objects.filter(order_count__gt=0).values_list('status', 'amount')),
+            [('confirmed', Decimal('12.00'))],
+        )
+        response = self.client.get(f'/api/orders/{self.order.pk}/track/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], 3)
+
+
+@override_settings(ORDER_EVENTS_ASYNC=False)
+class OrderStreamTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, events, 'ORDER_EVENT_BUFFER', events.ORDER_EVENT_BUFFER)
+        self.addCleanup(setattr, events, 'ORDER_EVENT_PRUNE_EVERY', events.ORDER_EVENT_PRUNE_EVERY)
+        events.ORDER_EVENT_BUFFER = 5
+        events.ORDER_EVENT_PRUNE_EVERY = 1
+        async_to_sync(get_channel_layer().flush)()
+
+    def publish_status(self, order, status):
+        with self.captureOnCommitCallbacks(execute=True):
+            order.status = status
+            order.save()
+
+    def connect(self, path='/ws/orders/'):
+        async def scenario():
+            communicator = WebsocketCommunicator(application, path)
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            messages = []
+            while not await communicator.receive_nothing(0.05):
+                messages.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return messages
+        return async_to_sync(scenario)()
+
+    def test_fresh_client_gets_bounded_snapshot_of_open_orders(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            open_order = self.create_order(1)
+            unpaid_order = self.create_order(1)
+            closed_order = self.create_order(1)
+        self.publish_status(unpaid_order, 'delivered')
+        self.publish_status(closed_order, 'paid')
+
+        messages = self.connect()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['type'], 'initial_orders')
+        # Delivered orders still wait for payment
+        self.assertEqual(
+            [order['id'] for order in messages[0]['orders']], [unpaid_order.pk, open_order.pk]
+        )
+        self.assertEqual(messages[0]['seq'], OrderEvent.objects.latest('pk').pk)
+
+    def test_reconnect_replays_only_missed_events(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.create_order(1)
+        seen = self.connect()[0]['seq']
+        self.publish_status(order, 'preparing')
+        self.publish_status(order, 'ready')
+
+        messages = self.connect(f'/ws/orders/?since={seen}')
+        self.assertEqual([message['type'] for message in messages], ['order_update', 'order_update'])
+        self.assertEqual([message['order']['status'] for message in messages], ['preparing', 'ready'])
+        self.assertEqual([message['seq'] for message in messages], [seen + 1, seen + 2])
+        self.assertEqual(self.connect(f'/ws/orders/?since={seen + 2}'), [])
+
+    def test_buffer_is_pruned_in_batches(self):
+        events.ORDER_EVENT_PRUNE_EVERY = 3
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.create_order(1)
+        counts = []
+        for status in ('confirmed', 'preparing', 'ready', 'pending') * 3:
+            self.publish_status(order, status)
+            counts.append(OrderEvent.objects.count())
+        self.assertEqual(min(counts[4:]), 5)
+        self.assertEqual(max(counts), 5 + 2)
+
+    def test_locked_database_is_retried_not_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.create_order(1)
+        bulk_create = OrderEvent.objects.bulk_create
+        attempts = []
+
+        def locked_once(records):
+            attempts.append(len(records))
+            if len(attempts) == 1:
+                raise OperationalError('database is locked')
+            return bulk_create(records)
+
+        with mock.patch.object(events.time, 'sleep'), \
+                mock.patch.object(OrderEvent.objects, 'bulk_create', side_effect=locked_once):
+            self.publish_status(order, 'confirmed')
+        self.assertEqual(attempts, [1, 1])
+        self.assertEqual(
+            [event.payload['status'] for event in OrderEvent.objects.filter(order_id=order.pk)],
+            ['pending', 'confirmed'],
+        )
+
+    def test_skipped_ids_are_not_mistaken_for_pruned_events(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.create_order(1)
+        seen = self.connect()[0]['seq']
+        self.publish_status(order, 'preparing')
+        # Ids are not guaranteed to be contiguous
+        OrderEvent.objects.filter(pk=seen + 1).update(id=seen + 3)
+
+        messages = self.connect(f'/ws/orders/?since={seen}')
+        self.assertEqual([message['type'] for message in messages], ['order_update'])
+        self.assertEqual(messages[0]['seq'], seen + 3)
+
+    def test_gap_older_than_buffer_falls_back_to_snapshot(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            order = self.create_order(1)
+        seen = self.connect()[0]['seq']
+        for status in ('confirmed', 'preparing', 'ready', 'pending', 'preparing', 'ready'):
+            self.publish_status(order, status)
+
+        self.assertEqual(OrderEvent.objects.count(), 5)
+        messages = self.connect(f'/ws/orders/?since={seen}')
+        self.assertEqual([message['type'] for message in messages], ['initial_orders'])
+        self.assertEqual(messages[0]['orders'][0]['status'], 'ready')
+
+
+@override_settings(ORDER_EVENTS_ASYNC=False)
+class FilteredStreamTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.layer = get_channel_layer()
+        async_to_sync(self.layer.flush)()
+        bar = Category.objects.create(name='Bar')
+        beer = MenuItem.objects.create(name='Beer', description='', price=Decimal('4.00'), category=bar)
+        patio = Table.objects.create(table_number=2, is_occupied=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.coffee = self.create_order(1)
+            response = self.client.post('/api/orders/', {
+                'table': patio.id, 'items': [{'menu_item': beer.id, 'quantity': 1}],
+            }, format='json')
+        self.beer = Order.objects.get(pk=response.data['id'])
+        self.screens = {
+            'all': '/ws/orders/',
+            'kitchen': '/ws/orders/?status=preparing',
+            'pass': '/ws/orders/?status=preparing,ready',
+            'bar': f'/ws/orders/?category={bar.id}',
+            'patio pickup': f'/ws/orders/?table={patio.id}&status=ready',
+        }
+
+    def publish_status(self, order, status):
+        with self.captureOnCommitCallbacks(execute=True):
+            order.status = status
+            order.save()
+
+    def run_screens(self, changes, query=''):
+        """What each screen gets on connect, and then for ``changes``."""
+        async def scenario():
+            sockets = {
+                name: WebsocketCommunicator(application, path + ('&' if '?' in path else '?') + query)
+                for name, path in self.screens.items()
+            }
+            initial = {}
+            for name, socket in sockets.items():
+                await socket.connect()
+                initial[name] = await socket.receive_json_from()
+            for order, status in changes:
+                await sync_to_async(self.publish_status)(order, status)
+            received = {}
+            for name, socket in sockets.items():
+                received[name] = []
+                while not await socket.receive_nothing(0.05):
+                    message = await socket.receive_json_from()
+                    received[name].append((message['order']['id'], message['order']['status']))
+            groups = {group: len(members) for group, members in self.layer.groups.items()}
+            for socket in sockets.values():
+                await socket.disconnect()
+            return initial, received, groups
+
+        return async_to_sync(scenario)()
+
+    def test_screens_only_receive_matching_orders(self):
+        coffee, beer = self.coffee.pk, self.beer.pk
+        initial, received, groups = self.run_screens([
+            (self.coffee, 'preparing'), (self.coffee, 'ready'), (self.beer, 'ready'),
+        ])
+
+        self.assertEqual(
+            {name: sorted(order['id'] for order in message['orders']) for name, message in initial.items()},
+            {'all': [coffee, beer], 'kitchen': [], 'pass': [], 'bar': [beer], 'patio pickup': []},
+        )
+        self.assertEqual(received, {
+            'all': [(coffee, 'preparing'), (coffee, 'ready'), (beer, 'ready')],
+            # Leaving preparing is news to the kitchen
+            'kitchen': [(coffee, 'preparing'), (coffee, 'ready')],
+            # Reached through both of its status groups, sent once
+            'pass': [(coffee, 'preparing'), (coffee, 'ready'), (beer, 'ready')],
+            'bar': [(beer, 'ready')],
+            'patio pickup': [(beer, 'ready')],
+        })
+        # Only the unfiltered screen is in the group every event goes to
+        self.assertEqual(groups['orders'], 1)
+
+    def test_catch_up_is_filtered_too(self):
+        seq = OrderEvent.objects.latest('pk').pk
+        self.publish_status(self.coffee, 'preparing')
+        self.publish_status(self.beer, 'ready')
+
+        initial, received, _ = self.run_screens([], query=f'since={seq}')
+        self.assertEqual(initial['bar']['order']['id'], self.beer.pk)
+        self.assertEqual(initial['kitchen']['order']['id'], self.coffee.pk)
+        self.assertEqual(received['kitchen'], [])
+        self.assertEqual(received['all'], [(self.beer.pk, 'ready')])
+
+
+    def test_unknown_filter_values_close_the_socket(self):
+        async def scenario(query):
+            socket = WebsocketCommunicator(application, f'/ws/orders/?{query}')
+            connected, _ = await socket.connect()
+            closed = await socket.receive_output()
+            await socket.wait()
+            return connected, closed
+
+        for query in ('status=bogus', 'table=x', f'category={self.category.id},x', 'status=ready&table=x'):
+            with self.subTest(query=query):
+                connected, closed = async_to_sync(scenario)(query)
+                self.assertTrue(connected)
+                self.assertEqual(closed, {'type': 'websocket.close', 'code': consumers.CLOSE_BAD_FILTER})
+        self.assertEqual(self.layer.groups, {})
+
+
+@override_settings(ORDER_EVENTS_ASYNC=False)
+class HttpTrackingTests(OrderFixturesMixin, TestCase):
+    """Long-poll and event-stream tracking, fed by the order_<id> group."""
+
+    def setUp(self):
+        super().setUp()
+        async_to_sync(get_channel_layer().flush)()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order = self.create_order(1)
+        self.version = self.client.get(f'/api/orders/{self.order.pk}/').json()['updated_at']
+
+    def publish_status(self, status):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.status = status
+            self.order.save()
+
+    def request(self, path, query='', headers=()):
+        communicator = ApplicationCommunicator(application, {
+            'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': path, 'query_string': query.encode(), 'headers': list(headers),
+        })
+        return communicator
+
+    async def start(self, communicator):
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        return await communicator.receive_output(1)
+
+    async def read_body(self, communicator):
+        body = b''
+        while True:
+            message = await communicator.receive_output(1)
+            body += message['body']
+            if not message.get('more_body'):
+                return body
+
+    def poll(self, query='', order_id=None):
+        async def scenario():
+            communicator = self.request(f'/api/orders/{order_id or self.order.pk}/poll/', query)
+            start = await self.start(communicator)
+            return start['status'], await self.read_body(communicator)
+        return async_to_sync(scenario)()
+
+    def test_long_poll_answers_at_once_when_behind(self):
+        status, body = self.poll()
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['order']['status'], 'pending')
+
+        status, _ = self.poll(f'since={self.version}&timeout=0.05')
+        self.assertEqual(status, 204)
+        status, _ = self.poll(order_id=9999)
+        self.assertEqual(status, 404)
+
+    def test_long_poll_wakes_on_change(self):
+        async def scenario():
+            communicator = self.request(f'/api/orders/{self.order.pk}/poll/', f'since={self.version}')
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            self.assertTrue(await communicator.receive_nothing(0.1))
+            await sync_to_async(self.publish_status)('preparing')
+            start = await communicator.receive_output(1)
+            return start['status'], await self.read_body(communicator)
+
+        status, body = async_to_sync(scenario)()
+        self.assertEqual(status, 200)
+        message = json.loads(body)
+        self.assertEqual(message['type'], 'order_update')
+        self.assertEqual(message['order']['status'], 'preparing')
+
+    def test_event_stream(self):
+        async def scenario(headers=(), status=None):
+            communicator = self.request(f'/api/orders/{self.order.pk}/events/', headers=headers)
+            start = await self.start(communicator)
+            # The retry hint, then the current order unless the client has it
+            chunks = [await communicator.receive_output(1) for _ in range(1 if headers else 2)]
+            if status:
+                await sync_to_async(self.publish_status)(status)
+            while chunks[-1]['more_body']:
+                chunks.append(await communicator.receive_output(1))
+            return start, b''.join(chunk['body'] for chunk in chunks).decode()
+
+        def sent(body):
+            return [block for block in body.split('\n\n') if block.startswith('id: ')]
+
+        with mock.patch.object(streams, 'ORDER_STREAM_KEEPALIVE', 0.15), \
+                mock.patch.object(streams, 'ORDER_STREAM_TIMEOUT', 0.4):
+            start, body = async_to_sync(scenario)(status='ready')
+            self.assertEqual(dict(start['headers'])[b'content-type'], b'text/event-stream')
+            self.assertEqual(
+                [json.loads(block.split('data: ', 1)[1])['order']['status'] for block in sent(body)],
+                ['pending', 'ready'],
+            )
+            self.assertIn(': keepalive', body)
+
+            # Reconnecting with the state it has: no repeat of it
+            last_event_id = sent(body)[-1].split('\n')[0].removeprefix('id: ')
+            _, body = async_to_sync(scenario)([(b'last-event-id', last_event_id.encode())])
+            self.assertEqual(sent(body), [])
+
+    def test_idle_waiters_make_no_queries(self):
+        waiters = 1000
+
+        async def scenario():
+            queries = CaptureQueriesContext(connection)
+            await sync_to_async(queries.__enter__)()
+            communicators = [
+                self.request(f'/api/orders/{self.order.pk}/poll/', f'since={self.version}')
+                for _ in range(waiters)
+            ]
+            for communicator in communicators:
+                await communicator.send_input({'type': 'http.request', 'body': b''})
+            await asyncio.sleep(0.3)
+            await sync_to_async(queries.__exit__)(None, None, None)
+            idle = all(communicator.output_queue.empty() for communicator in communicators)
+
+            await sync_to_async(self.publish_status)('preparing')
+            statuses = []
+            for communicator in communicators:
+                start = await communicator.receive_output(5)
+                body = await self.read_body(communicator)
+                statuses.append((start['status'], json.loads(body)['order']['status']))
+                await communicator.wait(1)
+            return len(queries), idle, statuses
+
+        queries, idle, statuses = async_to_sync(scenario)()
+        self.assertEqual(queries, 0)
+        self.assertTrue(idle)
+        self.assertEqual(statuses, [(200, 'preparing')] * waiters)
+        self.assertEqual(get_channel_layer().groups.get(f'order_{self.order.pk}', {}), {})
+
+
+class OrderTrackingSocketTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.layer = get_channel_layer()
+        async_to_sync(self.layer.flush)()
+        self.order = self.create_order(2)
+
+    def track(self, *events_to_send):
+        """
+        Connect a tracker, push ``events_to_send`` and return the initial
+        message, what it forwarded and how often it read the order.
+        """
+        async def scenario():
+            communicator = WebsocketCommunicator(application, f'/ws/order/{self.order.pk}/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            initial = await communicator.receive_json_from()
+            for event in events_to_send:
+                await self.layer.group_send(f'order_{self.order.pk}', event)
+            forwarded = []
+            while not await communicator.receive_nothing(0.05):
+                forwarded.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return initial, forwarded
+
+        reads = []
+        get_order = OrderTrackingConsumer.__dict__['get_order'].func
+
+        def counted_get_order(consumer, order_id):
+            reads.append(order_id)
+            return get_order(consumer, order_id)
+
+        with mock.patch.object(
+            OrderTrackingConsumer, 'get_order', database_sync_to_async(counted_get_order)
+        ):
+            initial, forwarded = async_to_sync(scenario)()
+        return initial, forwarded, len(reads)
+
+    def event(self, seq, status, updated_at):
+        return events.as_message(seq, 'order_update', {
+            'id': self.order.pk, 'status': status, 'updated_at': updated_at,
+        })
+
+    def test_updates_come_from_the_payload_without_reads(self):
+        initial, forwarded, reads = self.track(
+            self.event(1, 'preparing', '2099-01-01T10:00:00Z'),
+            self.event(2, 'ready', '2099-01-01T10:05:00Z'),
+        )
+        self.assertEqual(initial['order']['status'], 'pending')
+        self.assertEqual([message['order']['status'] for message in forwarded], ['preparing', 'ready'])
+        self.assertEqual([message['seq'] for message in forwarded], [1, 2])
+        # Only the initial state on connect
+        self.assertEqual(reads, 1)
+
+    def test_out_of_order_events_are_dropped(self):
+        _, forwarded, _ = self.track(
+            self.event(2, 'ready', '2099-01-01T10:05:00Z'),
+            self.event(1, 'preparing', '2099-01-01T10:00:00Z'),
+        )
+        self.assertEqual([message['order']['status'] for message in forwarded], ['ready'])
+
+    def test_events_older_than_initial_state_are_dropped(self):
+        _, forwarded, _ = self.track(self.event(1, 'confirmed', '2000-01-01T00:00:00Z'))
+        self.assertEqual(forwarded, [])
+
+
+@override_settings(ORDER_EVENTS_ASYNC=False)
+class FramingTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        async_to_sync(get_channel_layer().flush)()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order = self.create_order(2)
+
+    def test_event_is_encoded_once_for_all_sockets(self):
+        async def scenario():
+            sockets = [
+                WebsocketCommunicator(application, '/ws/orders/', subprotocols=subprotocols)
+                for subprotocols in (['msgpack'], ['msgpack'], None, None)
+            ]
+            for socket in sockets:
+                connected, subprotocol = await socket.connect()
+                self.assertTrue(connected)
+                await socket.receive_output()  # initial_orders
+
+            with mock.patch('orders.framing.encode', wraps=framing.encode) as encode:
+                await sync_to_async(self.publish_status)('ready')
+                frames = [await socket.receive_output() for socket in sockets]
+            for socket in sockets:
+                await socket.disconnect()
+            return frames, encode.call_count
+
+        frames, encodes = async_to_sync(scenario)()
+        # Once per format, not once per socket
+        self.assertEqual(encodes, 2)
+
+        binary, _, text, _ = frames
+        self.assertEqual(frames[0], frames[1])
+        self.assertEqual(frames[2], frames[3])
+        decoded = msgpack.unpackb(binary['bytes'], raw=False)
+        self.assertEqual(decoded, json.loads(text['text']))
+        self.assertEqual(decoded['order']['status'], 'ready')
+        self.assertLess(len(binary['bytes']), len(text['text'].encode()))
+
+    def publish_status(self, status):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.status = status
+            self.order.save()
+
+    def test_binary_frames_are_accepted_from_msgpack_clients(self):
+        async def scenario():
+            socket = WebsocketCommunicator(
+                application, f'/ws/order/{self.order.pk}/', subprotocols=['msgpack']
+            )
+            connected, subprotocol = await socket.connect()
+            await socket.receive_output()
+            await socket.send_to(bytes_data=msgpack.packb({'type': 'get_status'}))
+            reply = await socket.receive_output()
+            await socket.disconnect()
+            return subprotocol, reply
+
+        subprotocol, reply = async_to_sync(scenario)()
+        self.assertEqual(subprotocol, 'msgpack')
+        self.assertEqual(msgpack.unpackb(reply['bytes'])['order']['id'], self.order.pk)
+
+
+class BurstConsumer(OutboundQueueMixin, FramedConsumerMixin, AsyncWebsocketConsumer):
+    """Sends ``count`` numbered frames whenever the client asks."""
+
+    async def connect(self):
+        await self.channel_layer.group_add('burst', self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard('burst', self.channel_name)
+
+    async def receive(self, text_data):
+        for n in range(json.loads(text_data)['count']):
+            await self.send_message({'type': 'burst', 'n': n})
+
+
+def stalled(app, gate):
+    """``app`` talking to a client that reads nothing until ``gate`` is set."""
+    async def stalled_app(scope, receive, send):
+        async def stalled_send(message):
+            if message['type'] == 'websocket.send':
+                await gate.wait()
+            await send(message)
+        await app(scope, receive, stalled_send)
+    return stalled_app
+
+
+@override_settings(ORDER_EVENTS_ASYNC=False)
+class OutboundQueueTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.layer = get_channel_layer()
+        async_to_sync(self.layer.flush)()
+        outbound.counters.clear()
+        patcher = mock.patch.object(outbound, 'WEBSOCKET_QUEUE_SIZE', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def burst(self, policy, count):
+        """Frames a stalled client gets after a burst of ``count``, once it reads again."""
+        consumer = type('Consumer', (BurstConsumer,), {'outbound_policy': policy})
+
+        async def scenario():
+            gate = asyncio.Event()
+            communicator = WebsocketCommunicator(stalled(consumer.as_asgi(), gate), '/ws/burst/')
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.send_to(text_data=json.dumps({'count': count}))
+            await asyncio.sleep(0.05)
+            groups = dict(self.layer.groups)
+            gate.set()
+            frames = []
+            while not await communicator.receive_nothing(timeout=0.05):
+                frames.append(await communicator.receive_output())
+            await communicator.disconnect()
+            return frames, groups
+
+        return async_to_sync(scenario)()
+
+    def test_order_streams_drop_the_oldest_frames(self):
+        frames, groups = self.burst('drop_oldest', 10)
+
+        self.assertEqual([json.loads(frame['text'])['n'] for frame in frames], [7, 8, 9])
+        self.assertEqual(outbound.counters['dropped'], 7)
+        self.assertIn('burst', groups)
+
+    def test_chat_closes_a_connection_that_falls_behind(self):
+        self.assertEqual(ChatConsumer.outbound_policy, 'close')
+        frames, groups = self.burst('close', 10)
+
+        self.assertEqual(frames, [{'type': 'websocket.close', 'code': outbound.CLOSE_SLOW}])
+        self.assertNotIn('burst', groups)
+        self.assertEqual(outbound.counters['evicted_slow'], 1)
+
+    @mock.patch.object(outbound, 'WEBSOCKET_HEARTBEAT_TIMEOUT', 0.15)
+    @mock.patch.object(outbound, 'WEBSOCKET_HEARTBEAT_INTERVAL', 0.05)
+    def test_heartbeats_reap_silent_clients(self):
+        order = self.create_order(1)
+        group = f'order_{order.pk}'
+
+        async def scenario():
+            communicator = WebsocketCommunicator(application, f'/ws/order/{order.pk}/')
+            await communicator.connect()
+            await communicator.receive_output()  # initial state
+            self.assertEqual(json.loads(await communicator.receive_from()), {'type': 'heartbeat'})
+
+            # Answering keeps the connection; going quiet loses it
+            for _ in range(4):
+                await communicator.send_to(text_data=json.dumps({'type': 'heartbeat'}))
+                await communicator.receive_from()
+            self.assertIn(group, self.layer.groups)
+            while True:
+                output = await communicator.receive_output(timeout=1)
+                if output['type'] == 'websocket.close':
+                    break
+            return output
+
+        closed = async_to_sync(scenario)()
+        self.assertEqual(closed['code'], outbound.CLOSE_DEAD)
+        self.assertNotIn(group, self.layer.groups)
+        self.assertEqual(outbound.counters['evicted_dead'], 1)
+
+
+# Inline, so order events are not written from the background thread while
+# chat messages are saved to the same in-memory database, which SQLite
+# answers with "database table is locked"
+@override_settings(ORDER_EVENTS_ASYNC=False)
+class SocketLoadTestTests(TransactionTestCase):
+    def setUp(self):
+        use_own_cache(self)
+
+    def test_every_socket_receives_every_event(self):
+        from coffee_shop_backend.asgi import application
+
+        result = async_to_sync(loadtest.run)(
+            application, kitchens=2, trackers=3, chats=1, orders=2, events=4,
+            rate=100, chat_rate=100, drain=5,
+        )
+
+        self.assertEqual(result.events, 4)
+        # Two kitchens see all four events; trackers 2 + 1 see two each
+        self.assertEqual(result.order_expected, 4 * 2 + 2 * 2 + 2 * 1)
+        self.assertEqual(len(result.order_latencies), result.order_expected)
+        self.assertEqual(len(result.chat_latencies), result.chat_expected)
+        self.assertGreater(result.chat_expected, 0)
+
+
+class BackgroundPublishTests(OrderFixturesMixin, TransactionTestCase):
+    def test_in_memory_fan_out_is_handed_to_the_server_loop(self):
+        publishing = []
+        publish = events.publish
+
+        def record(*args, **kwargs):
+            publishing.append(threading.current_thread().name)
+            return publish(*args, **kwargs)
+
+        async def scenario():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add('orders', channel)
+            with mock.patch.object(events, 'publish', side_effect=record):
+                order = await database_sync_to_async(self.create_order)(1)
+                message = await asyncio.wait_for(layer.receive(channel), 5)
+            return order, message
+
+        order, message = async_to_sync(scenario)()
+        self.assertEqual((message['type'], message['order']['id']), ('new_order', order.pk))
+        # Loaded and recorded off the request's thread
+        self.assertEqual(len(publishing), 1)
+        self.assertTrue(publishing[0].startswith('order-events'))
+
+
+class PrincipalCacheTests(TestCase):
+    def setUp(self):
+        use_own_cache(self)
+        auth.principals.clear()
+        self.addCleanup(auth.principals.clear)
+        self.user = User.objects.create_user('staff', password='secret', is_staff=True)
+        self.token = str(AccessToken.for_user(self.user))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+
+    def get_orders(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/orders/')
+        return response, [query for query in queries if 'auth_user' in query['sql']]
+
+    def test_steady_state_requests_make_no_auth_queries(self):
+        response, auth_queries = self.get_orders()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(auth_queries), 1)
+
+        response, auth_queries = self.get_orders()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(auth_queries, [])
+
+    def test_deactivating_a_user_takes_effect_at_once(self):
+        self.get_orders()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+
+        response, _ = self.get_orders()
+        self.assertEqual(response.status_code, 401)
+
+    def test_deactivation_in_another_process_takes_effect_at_once(self):
+        self.get_orders()
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        # That process replaces the shared stamp; this one's LRU is untouched
+        with mock.patch.object(auth.principals, 'forget'):
+            auth.forget_user(self.user)
+
+        response, auth_queries = self.get_orders()
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(len(auth_queries), 1)
+
+    def test_entries_are_evicted_by_size_and_age(self):
+        cache = auth.PrincipalCache(size=2, ttl=10)
+        cache.set('1', 'one')
+        cache.set('2', 'two')
+        cache.get('1')
+        cache.set('3', 'three')
+        self.assertIs(cache.get('2'), auth.NOT_CACHED)
+        self.assertEqual(cache.get('1'), 'one')
+
+        later = time.monotonic() + 11
+        with mock.patch('orders.auth.time.monotonic', return_value=later):
+            self.assertIs(cache.get('1'), auth.NOT_CACHED)
+
+    def test_websocket_connects_resolve_tokens_through_the_cache(self):
+        users = []
+
+        async def inner(scope, receive, send):
+            users.append(scope['user'])
+
+        middleware = TokenAuthMiddleware(inner)
+        connect = async_to_sync(middleware)
+        with mock.patch('orders.auth.load_user', wraps=auth.load_user) as load_user:
+            for query_string in [f'token={self.token}'] * 3 + ['token=garbage', '']:
+                connect({'type': 'websocket', 'query_string': query_string.encode()}, None, None)
+
+        self.assertEqual(load_user.call_count, 1)
+        self.assertEqual([user.pk for user in users[:3]], [self.user.pk] * 3)
+        self.assertTrue(all(user.is_anonymous for user in users[3:]))
+
+
+class KeysetPaginationTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(User.objects.create_user('staff'))
+        self.orders = [self.create_order(1) for _ in range(7)]
+        # Ties on created_at must still page deterministically through the id
+        Order.objects.filter(pk__in=[o.pk for o in self.orders[2:5]]).update(
+            created_at=self.orders[2].created_at
+        )
+
+    def walk(self, url):
+        ids, queries_per_page = [], []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(order['id'] for order in response.data['results'])
+            queries_per_page.append(queries)
+            url = response.data['next']
+        return ids, queries_per_page
+
+    def test_pages_cover_every_order_once_in_order(self):
+        ids, _ = self.walk('/api/orders/?page_size=2')
+        expected = list(
+            Order.objects.order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+        self.assertEqual(ids, expected)
+
+    def test_previous_link_returns_the_prior_page(self):
+        first = self.client.get('/api/orders/?page_size=3').data
+        second = self.client.get(first['next']).data
+        back = self.client.get(second['previous']).data
+        self.assertEqual(
+            [o['id'] for o in back['results']], [o['id'] for o in first['results']]
+        )
+
+    def test_deep_pages_cost_the_same_as_the_first(self):
+        _, pages = self.walk('/api/orders/?page_size=2')
+        counts = {len(queries) for queries in pages}
+        self.assertEqual(len(counts), 1)
+        for queries in pages:
+            page_sql = queries.captured_queries[-2]['sql']
+            self.assertIn('LIMIT 3', page_sql)
+            self.assertNotIn('OFFSET', page_sql)
+
+
+class SalesRollupTests(OrderFixturesMixin, TestCase):
+    def bucket_totals(self):
+        return (
+            sorted(HourlySales.objects.filter(order_count__gt=0).values_list(
+                'hour', 'status', 'amount', 'order_count')),
+            sorted(HourlyItemSales.objects.filter(quantity__gt=0).values_list(
+                'hour', 'menu_item_id', 'quantity', 'amount')),
+        )
+
+    def set_status(self, order, new_status):
+        order = Order.objects.get(pk=order.pk)
+        order.status = new_status
+        order.save()
+        return order
+
+    def test_orders_move_between_status_buckets(self):
+        order = self.create_order(2)
+        self.assertEqual(
+            list(HourlySales.objects.filter(order_count__gt=0).values_list('status', 'amount')),
+            [('pending', Decimal('12.00'))],
+        )
+
+        self.set_status(order, 'paid')
+        paid = HourlySales.objects.get(status='paid')
+        self.assertEqual((paid.amount, paid.order_count), (Decimal('12.00'), 1))
+        self.assertEqual(HourlySales.objects.get(status='pending').order_count, 0)
+        self.assertEqual(
+            sorted(HourlyItemSales.objects.values_list('menu_item_id', 'quantity', 'amount')),
+            [(self.menu_items[0].id, 2, Decimal('5.00')), (self.menu_items[1].id, 2, Decimal('7.00'))],
+        )
+
+        self.set_status(order, 'cancelled')
+        self.assertEqual(HourlySales.objects.get(status='paid').order_count, 0)
+        self.assertFalse(HourlyItemSales.objects.filter(quantity__gt=0).exists())
+
+    def test_delete_removes_order_from_rollup(self):
+        order = self.set_status(self.create_order(2), 'paid')
+        order.delete()
+        self.assertEqual(self.bucket_totals(), ([], []))
+
+    def test_rebuild_matches_incremental_rollup(self):
+        for line_count, new_status in [(1, 'paid'), (2, 'paid'), (3, 'ready'), (4, 'cancelled')]:
+            self.set_status(self.create_order(line_count), new_status)
+        incremental = self.bucket_totals()
+        rollups.rebuild()
+        self.assertEqual(self.bucket_totals(), incremental)
+
+    def test_analytics_cost_does_not_grow_with_orders(self):
+        today = self.create_order(1).created_at.date().isoformat()
+        params = {'start_date': today, 'end_date': today, 'period': 'hourly'}
+
+        def analytics():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/orders/analytics/', params)
+            self.assertEqual(response.status_code, 200)
+            return response.data, len(queries)
+
+        for _ in range(2):
+            self.set_status(self.create_order(2), 'paid')
+        data, few = analytics()
+        for _ in range(6):
+            self.set_status(self.create_order(2), 'paid')
+        data, many = analytics()
+
+        self.assertEqual(few, many)
+        self.assertEqual(data['period_sales'], {'amount': 96.0, 'order_count': 8})
+        self.assertEqual(len(data['time_series']), 1)
+        self.assertEqual(data['time_series'][0]['order_count'], 8)
+
+
+class CatalogCacheTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+    def get_menu(self, **headers):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/menu-items/', **headers)
+        return response, len(queries)
+
+    def test_listing_is_served_from_cache(self):
+        first, cold = self.get_menu()
+        second, warm = self.get_menu()
+        self.assertEqual(first.status_code, 200)
+        self.assertGreater(cold, 0)
+        self.assertEqual(warm, 0)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertEqual(len(second.json()), len(self.menu_items))
+
+    def test_matching_etag_returns_304_without_queries(self):
+        first, _ = self.get_menu()
+        response, queries = self.get_menu(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], first['ETag'])
+        self.assertEqual(queries, 0)
+
+    def test_compressed_listing_revalidates_with_weak_etag(self):
+        first, _ = self.get_menu(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(first['Content-Encoding'], 'gzip')
+        self.assertTrue(first['ETag'].startswith('W/"'))
+        self.assertEqual(json.loads(gzip.decompress(first.content)), self.get_menu()[0].json())
+
+        response, queries = self.get_menu(HTTP_IF_NONE_MATCH=first['ETag'], HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(queries, 0)
+
+    def test_menu_change_invalidates_cached_listing(self):
+        first, _ = self.get_menu()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.menu_items[0].price = Decimal('9.99')
+            self.menu_items[0].save()
+
+        response, queries = self.get_menu(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(queries, 0)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertIn('9.99', response.content.decode())
+
+    def test_category_change_invalidates_cached_listing(self):
+        first, _ = self.get_menu()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = 'Hot drinks'
+            self.category.save()
+        response, _ = self.get_menu()
+        self.assertIn('Hot drinks', response.content.decode())
+
+    def test_listing_query_count_does_not_grow_with_items(self):
+        _, few = self.get_menu()
+        for i in range(10):
+            MenuItem.objects.create(name=f'Extra {i}', description='', price=1, category=self.category)
+        bump_catalog_version()
+        _, many = self.get_menu()
+        self.assertEqual(few, many)
+
+
+class ImageVariantTests(OrderFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root, MENU_IMAGE_ASYNC=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, name='latte.jpg', size=(1200, 800)):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, 'brown').save(buffer, 'JPEG')
+        menu_item = self.menu_items[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            menu_item.image = SimpleUploadedFile(name, buffer.getvalue(), 'image/jpeg')
+            menu_item.save()
+        menu_item.refresh_from_db()
+        return menu_item
+
+    def test_upload_generates_hashed_variants(self):
+        menu_item = self.upload()
+        manifest = menu_item.image_variants
+        self.assertEqual(manifest['source'], menu_item.image.name)
+        self.assertEqual(sorted(manifest['webp']), ['160', '320', '640'])
+        for image_format in ('webp', 'jpeg'):
+            for width, name in manifest[image_format].items():
+                self.assertTrue(default_storage.exists(name))
+                with default_storage.open(name) as variant:
+                    self.assertEqual(Image.open(variant).width, int(width))
+
+    def test_narrow_sources_are_not_advertised_wider(self):
+        menu_item = self.upload(size=(400, 300))
+        manifest = menu_item.image_variants
+        self.assertEqual(sorted(manifest['jpeg'], key=int), ['160', '320', '400'])
+        for width, name in manifest['jpeg'].items():
+            with default_storage.open(name) as variant:
+                self.assertEqual(Image.open(variant).width, int(width))
+        self.assertEqual(list(self.upload('tiny.jpg', size=(100, 80)).image_variants['webp']), ['100'])
+
+    def test_serializer_exposes_srcset(self):
+        self.upload()
+        response = self.client.get('/api/menu-items/')
+        item = next(i for i in response.json() if i['id'] == self.menu_items[0].id)
+        webp = item['image_srcset']['webp'].split(', ')
+        self.assertEqual(len(webp), 3)
+        self.assertTrue(webp[0].startswith('http://testserver/media/menu_items/variants/'))
+        self.assertTrue(webp[0].endswith('.160w.webp 160w'))
+
+    def test_variants_are_served_with_far_future_caching(self):
+        menu_item = self.upload()
+        name = menu_item.image_variants['webp']['320']
+        # Routed only under DEBUG, which tests run without
+        with self.assertRaises(Resolver404):
+            resolve(default_storage.url(name))
+        request = RequestFactory().get(default_storage.url(name))
+        response = images.serve_variant(request, name.removeprefix(f'{images.VARIANT_DIR}/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
@@ -1,13 +1,22 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from django.db.models import Sum, Count, F
-from datetime import datetime, timedelta
+from django.db.models import Prefetch, Sum
+from django.db.models.functions import TruncDay, TruncHour, TruncMonth, TruncYear
+from django.utils import timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.models import Group
-from .models import BrokenItem, Category, MenuItem, Order, OrderItem, Table, OrderReview
+from .models import (
+    BrokenItem, Category, InvalidTransition, MenuItem, Order, OrderConflict, OrderItem, Table, OrderReview,
+    HourlySales, HourlyItemSales
+)
+from .catalog import CachedCatalogMixin
+from .conditional import ConditionalOrderMixin
+from .fieldsets import FieldsetViewMixin
+from .pagination import KeysetCursorPagination
 from .serializers import (
     UserSerializer,
     BrokenItemSerializer,
@@ -15,30 +24,33 @@ from .serializers import (
     MenuItemSerializer,
     OrderSerializer,
     OrderItemSerializer,
+    OrderReadSerializer,
     TableSerializer,
     OrderReviewSerializer
 )
 from django.contrib.auth import authenticate
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
 import logging
 
 logger = logging.getLogger(__name__)
 
 # Category Management
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(CachedCatalogMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticated]
 
 
 # Menu Item Management
-class MenuItemViewSet(viewsets.ModelViewSet):
+class MenuItemViewSet(CachedCatalogMixin, FieldsetViewMixin, viewsets.ModelViewSet):
     queryset = MenuItem.objects.all()
     serializer_class = MenuItemSerializer
+    expandable = ('category',)
 
     def get_queryset(self):
+        fieldset = self.get_fieldset()
         queryset = MenuItem.objects.all()
+        if fieldset.wants('category_name') or fieldset.expands('category'):
+            queryset = queryset.select_related('category')
         category = self.request.query_params.get('category', None)
         available = self.request.query_params.get('available', None)
 
@@ -67,9 +79,12 @@ class TableViewSet(viewsets.ModelViewSet):
 
 
 # Order Management
-class OrderViewSet(viewsets.ModelViewSet):
+class OrderViewSet(ConditionalOrderMixin, FieldsetViewMixin, viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
+    pagination_class = KeysetCursorPagination
+    fieldset_actions = ('list', 'retrieve', 'track')
+    expandable = ('table',)
     
     def get_permissions(self):
         if self.action in ['create', 'track', 'update_status', 'cancel', 'update_table', 'review', 'retrieve', 'analytics']:
@@ -79,7 +94,11 @@ class OrderViewSet(viewsets.ModelViewSet):
         return [permission() for permission in permission_classes]
 
     def get_queryset(self):
-        queryset = Order.objects.all()
+        fieldset = self.get_fieldset()
+        queryset = Order.objects.with_details(
+            table=fieldset.wants('table_number') or fieldset.expands('table'),
+            items=fieldset.wants('order_items'),
+        )
         table = self.request.query_params.get('table', None)
         status = self.request.query_params.get('status', None)
         date = self.request.query_params.get('date', None)
@@ -99,31 +118,60 @@ class OrderViewSet(viewsets.ModelViewSet):
 
         return queryset
 
+    def get_read_serializer(self, *args, **kwargs):
+        return OrderReadSerializer(*args, context=self.get_serializer_context(), **kwargs)
+
+    def get_expected_version(self):
+        """
+        The ``version`` the client's change is based on; None when it sent
+        none, and only the state machine guards the change
+        """
+        version = self.request.data.get('version')
+        if version in (None, ''):
+            return None
+        if not str(version).isdigit():
+            raise ValueError('Invalid version')
+        return int(version)
+
+    def rejected(self, error):
+        """The response for a compare-and-set that matched no order"""
+        if isinstance(error, Order.DoesNotExist):
+            return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
+        if isinstance(error, InvalidTransition):
+            # Retrying cannot help, unlike after a concurrent change
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'error': str(error)}, status=status.HTTP_409_CONFLICT)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_read_serializer(page, many=True).data)
+        return Response(self.get_read_serializer(queryset, many=True).data)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(
+            request, lambda: self.get_read_serializer(self.get_object()).data
+        )
+
     def create(self, request, *args, **kwargs):
-        print("Received order data:", request.data)  # Debug log
+        logger.debug(f"Received order data: {request.data}")
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
             order = serializer.save()
-            print("Created order:", order.id)  # Debug log
-            broadcast_new_order(order)  # Broadcast the new order
+            logger.info(f"Created order {order.id}")
             response_data = {
                 'id': order.id,
                 'status': order.status,
                 'message': 'Order created successfully'
             }
-            print("Sending response:", response_data)  # Debug log
             return Response(response_data, status=status.HTTP_201_CREATED)
-        print("Serializer errors:", serializer.errors)  # Debug log
+        logger.debug(f"Rejected order data: {serializer.errors}")
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    def perform_update(self, serializer):
-        order = serializer.save()
-        broadcast_order_update(order)
-
     @action(detail=True, methods=['post'])
     def update_status(self, request, pk=None):
         try:
-            order = self.get_object()
             new_status = request.data.get('status')
             
             if not new_status:
@@ -132,16 +180,22 @@ class OrderViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            # Update order status
-            order.status = new_status
-            order.save()
-            
-            # Broadcast the update
-            broadcast_order_update(order)
+            if new_status not in Order.TRANSITIONS:
+                return Response(
+                    {'error': f'Invalid status: {new_status}'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            # One conditional UPDATE, without loading the order first; a
+            # concurrent change is a 409, a move the state machine forbids a 400
+            try:
+                order = Order.objects.transition(pk, new_status, self.get_expected_version())
+            except (Order.DoesNotExist, InvalidTransition, OrderConflict) as e:
+                return self.rejected(e)
             
             return Response({
                 'status': 'Order status updated',
-                'order': OrderSerializer(order).data
+                'order': OrderReadSerializer(order).data
             })
             
         except Exception as e:
@@ -157,9 +211,9 @@ class OrderViewSet(viewsets.ModelViewSet):
         Endpoint for tracking a specific order
         """
         try:
-            order = self.get_object()
-            serializer = self.get_serializer(order)
-            return Response(serializer.data)
+            return self.conditional_response(
+                request, lambda: self.get_read_serializer(self.get_object()).data
+            )
         except Order.DoesNotExist:
             return Response(
                 {'error': 'Order not found'}, 
@@ -169,10 +223,10 @@ class OrderViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def cancel(self, request, pk=None):
         try:
-            order = self.get_object()
-            order.status = 'cancelled'
-            order.save()
-            broadcast_order_update(order)
+            try:
+                Order.objects.transition(pk, 'cancelled', self.get_expected_version())
+            except (Order.DoesNotExist, InvalidTransition, OrderConflict) as e:
+                return self.rejected(e)
             return Response({'status': 'Order cancelled'})
         except Exception as e:
             return Response(
@@ -206,7 +260,6 @@ class OrderViewSet(viewsets.ModelViewSet):
         Update the table of an order
         """
         try:
-            order = self.get_object()
             table_id = request.data.get('table_id')
             
             # Log the incoming request data
@@ -235,14 +288,13 @@ class OrderViewSet(viewsets.ModelViewSet):
                 )
 
             # Update the order's table
-            order.table = table
-            order.save()
+            try:
+                order = Order.objects.compare_and_set(pk, {'table': table}, self.get_expected_version())
+            except (Order.DoesNotExist, InvalidTransition, OrderConflict) as e:
+                return self.rejected(e)
             
             # Get the updated order data
-            serializer = OrderSerializer(order)
-            
-            # Broadcast the update
-            broadcast_order_update(order)
+            serializer = OrderReadSerializer(order)
             
             logger.info(f"Successfully updated table for order {pk}")
             
@@ -286,23 +338,24 @@ class OrderViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
+            # Everything below reads the hourly rollup maintained by
+            # orders.rollups, so cost follows the number of buckets
+            start_date = timezone.make_aware(start_date)
+            end_date = timezone.make_aware(end_date)
+            paid_buckets = HourlySales.objects.filter(status='paid', order_count__gt=0)
+
             # Get daily sales for the current day
             today = datetime.now().date()
-            daily_sales = Order.objects.filter(
-                created_at__date=today,
-                status='paid'
-            ).aggregate(
-                amount=Sum('total_amount'),
-                order_count=Count('id')
+            daily_sales = paid_buckets.filter(hour__date=today).aggregate(
+                amount=Sum('amount'),
+                order_count=Sum('order_count')
             )
 
             # Get period sales
-            period_sales = Order.objects.filter(
-                created_at__range=(start_date, end_date),
-                status='paid'
-            ).aggregate(
-                amount=Sum('total_amount'),
-                order_count=Count('id')
+            period_buckets = paid_buckets.filter(hour__range=(start_date, end_date))
+            period_sales = period_buckets.aggregate(
+                amount=Sum('amount'),
+                order_count=Sum('order_count')
             )
 
             # Ensure values are not None
@@ -311,68 +364,44 @@ class OrderViewSet(viewsets.ModelViewSet):
             period_sales['amount'] = float(period_sales['amount'] or 0)
             period_sales['order_count'] = int(period_sales['order_count'] or 0)
 
-            # Get top selling items
-            top_items = OrderItem.objects.filter(
-                order__created_at__range=(start_date, end_date),
-                order__status='paid'
-            ).values('menu_item__name').annotate(
+            # Get top selling items; names are looked up afterwards for the
+            # five winners only
+            top_items = list(HourlyItemSales.objects.filter(
+                hour__range=(start_date, end_date)
+            ).values('menu_item_id').annotate(
                 total_quantity=Sum('quantity'),
-                total_sales=Sum(F('quantity') * F('menu_item__price'))
-            ).order_by('-total_quantity')[:5]
+                total_sales=Sum('amount')
+            ).filter(total_quantity__gt=0).order_by('-total_quantity')[:5])
+            menu_item_names = dict(MenuItem.objects.filter(
+                id__in=[item['menu_item_id'] for item in top_items]
+            ).values_list('id', 'name'))
 
             # Get time series data based on period
-            time_series_data = []
-            
-            # Get all orders in the period
-            orders = Order.objects.filter(
-                created_at__range=(start_date, end_date),
-                status='paid'
-            ).order_by('created_at')
-
-            # Group orders by period manually
-            current_period = {}
-            for order in orders:
-                if period == 'hourly':
-                    period_key = order.created_at.strftime('%Y-%m-%d %H:00:00')
-                elif period == 'daily':
-                    period_key = order.created_at.strftime('%Y-%m-%d')
-                elif period == 'monthly':
-                    period_key = order.created_at.strftime('%Y-%m')
-                else:  # yearly
-                    period_key = order.created_at.strftime('%Y')
-
-                if period_key not in current_period:
-                    current_period[period_key] = {
-                        'amount': 0,
-                        'order_count': 0
-                    }
-                
-                current_period[period_key]['amount'] += float(order.total_amount or 0)
-                current_period[period_key]['order_count'] += 1
-
-            # Convert grouped data to time series format
-            for period_key, data in sorted(current_period.items()):
-                if period == 'hourly':
-                    period_dt = datetime.strptime(period_key, '%Y-%m-%d %H:00:00')
-                elif period == 'daily':
-                    period_dt = datetime.strptime(period_key, '%Y-%m-%d')
-                elif period == 'monthly':
-                    period_dt = datetime.strptime(period_key, '%Y-%m')
-                else:  # yearly
-                    period_dt = datetime.strptime(period_key, '%Y')
-
-                time_series_data.append({
-                    'timestamp': period_dt.isoformat(),
-                    'amount': data['amount'],
-                    'order_count': data['order_count']
-                })
+            trunc = {
+                'hourly': TruncHour,
+                'daily': TruncDay,
+                'monthly': TruncMonth,
+            }.get(period, TruncYear)
+            buckets = period_buckets.annotate(
+                period_start=trunc('hour', tzinfo=dt_timezone.utc)
+            ).values('period_start').annotate(
+                amount=Sum('amount'),
+                order_count=Sum('order_count')
+            ).order_by('period_start')
+
+            time_series_data = [{
+                'timestamp': bucket['period_start'].replace(tzinfo=None).isoformat(),
+                'amount': float(bucket['amount'] or 0),
+                'order_count': int(bucket['order_count'] or 0)
+            } for bucket in buckets]
 
             # Convert decimal values to float for JSON serialization
             top_items_list = []
             for item in top_items:
-                if item['menu_item__name']:
+                name = menu_item_names.get(item['menu_item_id'])
+                if name:
                     top_items_list.append({
-                        'menu_item__name': item['menu_item__name'],
+                        'menu_item__name': name,
                         'total_quantity': int(item['total_quantity'] or 0),
                         'total_sales': float(item['total_sales'] or 0)
                     })
@@ -412,10 +441,25 @@ class BrokenItemViewSet(viewsets.ModelViewSet):
 
 
 # Order Review Management
-class OrderReviewViewSet(viewsets.ModelViewSet):
+class OrderReviewViewSet(FieldsetViewMixin, viewsets.ModelViewSet):
     queryset = OrderReview.objects.all().order_by('-created_at')
     serializer_class = OrderReviewSerializer
+    pagination_class = KeysetCursorPagination
     permission_classes = [AllowAny]
+    expandable = ('order',)
+
+    def get_queryset(self):
+        fieldset = self.get_fieldset()
+        queryset = OrderReview.objects.order_by('-created_at')
+        if fieldset.expands('order'):
+            queryset = queryset.select_related('order__table')
+        elif fieldset.wants('order_date'):
+            queryset = queryset.select_related('order')
+        if fieldset.wants('order_items') or fieldset.expands('order'):
+            queryset = queryset.prefetch_related(Prefetch(
+                'order__orderitem_set', queryset=OrderItem.objects.select_related('menu_item'),
+            ))
+        return queryset
 
 
 # User Login API
@@ -436,54 +480,3 @@ class LoginAPIView(APIView):
             })
 
         return Response({"error": "Invalid Credentials"}, status=status.HTTP_400_BAD_REQUEST)
-
-
-
-
-def broadcast_new_order(order):
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        'orders',  # Group name
-        {
-            'type': 'order_update',
-            'content': {
-                'id': order.id,
-                'table': order.table.table_number,
-                'status': order.status,
-                'total_amount': str(order.total_amount),
-                'created_at': order.created_at.isoformat(),
-            }
-        }
-    )
-
-def broadcast_order_update(order):
-    """Broadcast order update to all connected WebSocket clients"""
-    try:
-        channel_layer = get_channel_layer()
-        order_data = OrderSerializer(order).data
-        
-        # Broadcast to order-specific group
-        async_to_sync(channel_layer.group_send)(
-            f'order_{order.id}',
-            {
-                'type': 'order_update',
-                'content': order_data
-            }
-        )
-        
-        # Also broadcast to menu orders group for general updates
-        async_to_sync(channel_layer.group_send)(
-            'menu_orders',
-            {
-                'type': 'order_update',
-                'content': order_data
-            }
-        )
-        
-        logger.info(f"Order update broadcast for order {order.id}")
-    except Exception as e:
-        logger.error(f"Error broadcasting order update: {str(e)}")
-
-def perform_create(self, serializer):
-    order = serializer.save()
-    broadcast_new_order(order)
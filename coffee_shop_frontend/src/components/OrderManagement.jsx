@@ -61,6 +61,13 @@ const OrderManagement = () => {
   const audioRef = useRef(new Audio('/notification.mp3'));
   const trackingUnsubscribes = useRef(new Map());
 
+  // Unread chat messages for every open order, in one request
+  useEffect(() => {
+    api.get('/chat/messages/unread_counts/')
+      .then(response => setUnreadMessages(response.data))
+      .catch(error => console.error('Error fetching unread counts:', error));
+  }, []);
+
   // Connect to main orders WebSocket
   useEffect(() => {
     webSocketService.connect();
@@ -230,6 +237,10 @@ const OrderManagement = () => {
     setChatOpen(true);
     // Connect to chat WebSocket when opening chat
     chatWebSocketService.connect(order.id);
+    // Staff have now read what the customer sent
+    api.post('/chat/messages/mark_as_read/', { order_id: order.id, side: 'admin' })
+      .then(() => setUnreadMessages(prev => ({ ...prev, [order.id]: 0 })))
+      .catch(error => console.error('Error marking chat as read:', error));
   };
 
   const handleChatClose = () => {
@@ -263,17 +274,22 @@ const OrderManagement = () => {
   );
 
   const updateOrderStatus = useMutation(
-    async ({ orderId, status }) => {
+    async ({ orderId, status, version }) => {
       try {
+        // The version this screen last saw; the server answers 409 when
+        // the order changed since
         const response = await api.post(`/orders/${orderId}/update_status/`, {
-          status: status
+          status: status,
+          version: version
         });
         return response.data;
       } catch (error) {
         console.error('Error updating order status:', error);
         toast({
           title: "Error",
-          description: "Failed to update order status",
+          description: error.response?.status === 409
+            ? "This order was just updated elsewhere; check its status and try again"
+            : error.response?.data?.error || "Failed to update order status",
           variant: "destructive",
         });
         throw error;
@@ -458,7 +474,8 @@ const OrderManagement = () => {
                 className={`${nextStatus.color} text-white`}
                 onClick={() => updateOrderStatus.mutate({ 
                   orderId: order.id, 
-                  status: nextStatus.next 
+                  status: nextStatus.next,
+                  version: order.version
                 })}
                 disabled={updateOrderStatus.isLoading}
               >
@@ -470,7 +487,8 @@ const OrderManagement = () => {
                 className="bg-red-500 hover:bg-red-600 text-white"
                 onClick={() => updateOrderStatus.mutate({ 
                   orderId: order.id, 
-                  status: 'cancelled' 
+                  status: 'cancelled',
+                  version: order.version
                 })}
                 disabled={updateOrderStatus.isLoading}
               >
@@ -98,8 +98,10 @@ const OrderTracking = () => {
       try {
         setLoading(true);
         const response = await axios.get(`${API_URL}/orders/${orderId}/`);
-        setOrder(response.data);
-        previousStatusRef.current = response.data.status;
+        if (!isStale(response.data)) {
+          setOrder(response.data);
+          previousStatusRef.current = response.data.status;
+        }
         setError(null);
       } catch (err) {
         console.error('Error fetching order:', err);
@@ -109,6 +111,17 @@ const OrderTracking = () => {
       }
     };
 
+    // Updates can arrive out of order (REST response vs. socket, several
+    // workers); never replace the order with an older version of itself
+    let lastUpdatedAt = 0;
+    const isStale = (orderData) => {
+      const updatedAt = Date.parse(orderData?.updated_at);
+      if (Number.isNaN(updatedAt)) return false;
+      if (updatedAt < lastUpdatedAt) return true;
+      lastUpdatedAt = updatedAt;
+      return false;
+    };
+
     fetchOrder();
 
     // Connect to WebSocket for real-time updates
@@ -122,7 +135,12 @@ const OrderTracking = () => {
     ws.onmessage = (event) => {
       try {
         const data = JSON.parse(event.data);
-        if (data.type === 'order_update') {
+        if (data.type === 'heartbeat') {
+          // The server disconnects clients that stop answering
+          ws.send(JSON.stringify({ type: 'heartbeat' }));
+          return;
+        }
+        if (data.type === 'order_update' && !isStale(data.order)) {
           setOrder(prevOrder => ({
             ...prevOrder,
             ...data.order
@@ -14,7 +14,7 @@ const Reviews = () => {
     const fetchReviews = async () => {
       try {
         const response = await api.get('/reviews/');
-        setReviews(response.data);
+        setReviews(response.data.results ?? response.data);
         setLoading(false);
       } catch (err) {
         setError('Failed to fetch reviews');
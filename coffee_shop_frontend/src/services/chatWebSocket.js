@@ -9,6 +9,8 @@ class ChatWebSocketService {
         this.reconnectTimeout = null;
         this.pingInterval = null;
         this.currentOrderId = null;
+        // Newest message id seen, so a reconnect only fetches what is missing
+        this.lastMessageId = null;
     }
 
     connect(orderId) {
@@ -21,8 +23,12 @@ class ChatWebSocketService {
             this.disconnect();
         }
 
+        if (this.currentOrderId !== orderId) {
+            this.lastMessageId = null;
+        }
         this.currentOrderId = orderId;
-        const wsUrl = `${import.meta.env.VITE_WS_URL}/chat/${orderId}/`;
+        const since = this.lastMessageId === null ? '' : `?since=${this.lastMessageId}`;
+        const wsUrl = `${import.meta.env.VITE_WS_URL}/chat/${orderId}/${since}`;
 
         try {
             this.ws = new WebSocket(wsUrl);
@@ -33,27 +39,27 @@ class ChatWebSocketService {
                 this.reconnectAttempts = 0;
                 this.startPingInterval();
                 this.processMessageQueue();
-                
-                // Request chat history
-                this.sendMessage({
-                    type: 'get_history',
-                    order_id: orderId
-                });
+                // The server sends the history we are missing on connect
             };
 
             this.ws.onmessage = (event) => {
                 const data = JSON.parse(event.data);
                 console.log('Received message:', data);
                 
-                if (data.type === 'chat_history') {
+                if (data.type === 'heartbeat') {
+                    // The server disconnects clients that stop answering
+                    this.ws.send(JSON.stringify({ type: 'heartbeat' }));
+                } else if (data.type === 'chat_history') {
                     // Handle chat history
                     data.messages.forEach(msg => {
-                        this.notifySubscribers({
-                            type: 'chat_message',
-                            ...msg
-                        });
+                        if (this.isNew(msg)) {
+                            this.notifySubscribers({
+                                type: 'chat_message',
+                                ...msg
+                            });
+                        }
                     });
-                } else {
+                } else if (data.type !== 'chat_message' || this.isNew(data)) {
                     this.notifySubscribers(data);
                 }
             };
@@ -76,6 +82,17 @@ class ChatWebSocketService {
         }
     }
 
+    isNew(message) {
+        if (typeof message.id !== 'number') {
+            return true;
+        }
+        if (this.lastMessageId !== null && message.id <= this.lastMessageId) {
+            return false;
+        }
+        this.lastMessageId = message.id;
+        return true;
+    }
+
     disconnect() {
         if (this.ws) {
             this.stopPingInterval();
@@ -51,6 +51,18 @@ class WebSocketConnection {
         this.connecting = false;
         this.heartbeatInterval = null;
         this.lastHeartbeat = null;
+        // Sequence number of the last order event seen, so a reconnect
+        // only receives what was missed
+        this.lastSeq = null;
+    }
+
+    socketUrl() {
+        if (this.lastSeq === null) {
+            return this.url;
+        }
+        const url = new URL(this.url);
+        url.searchParams.set('since', this.lastSeq);
+        return url.toString();
     }
 
     connect() {
@@ -60,7 +72,7 @@ class WebSocketConnection {
 
         this.connecting = true;
         try {
-            this.socket = new WebSocket(this.url);
+            this.socket = new WebSocket(this.socketUrl());
             this.setupSocketHandlers();
             this.startHeartbeat();
         } catch (error) {
@@ -85,6 +97,9 @@ class WebSocketConnection {
                     this.lastHeartbeat = Date.now();
                     return;
                 }
+                if (typeof data.seq === 'number') {
+                    this.lastSeq = Math.max(this.lastSeq ?? 0, data.seq);
+                }
                 this.notifySubscribers(data);
             } catch (error) {
                 this.log('Error processing message:', error);
@@ -210,120 +225,5 @@ class WebSocketConnection {
     }
 }
 
-class WebSocketService {
-    constructor() {
-        this.socket = null;
-        this.subscribers = new Set();
-        this.isConnected = false;
-        this.reconnectAttempts = 0;
-        this.maxReconnectAttempts = 5;
-        this.reconnectTimeout = null;
-    }
-
-    connect() {
-        if (this.socket?.readyState === WebSocket.OPEN) {
-            console.log('WebSocket already connected');
-            return;
-        }
-
-        try {
-            this.socket = new WebSocket(`${import.meta.env.VITE_WS_URL}/orders/`);
-
-            this.socket.onopen = () => {
-                console.log('WebSocket connected');
-                this.isConnected = true;
-                this.reconnectAttempts = 0;
-                this.notifySubscribers({
-                    type: 'connection_status',
-                    status: 'connected'
-                });
-            };
-
-            this.socket.onmessage = (event) => {
-                try {
-                    const data = JSON.parse(event.data);
-                    this.notifySubscribers(data);
-                } catch (error) {
-                    console.error('Error parsing WebSocket message:', error);
-                }
-            };
-
-            this.socket.onclose = () => {
-                console.log('WebSocket disconnected');
-                this.isConnected = false;
-                this.notifySubscribers({
-                    type: 'connection_status',
-                    status: 'disconnected'
-                });
-                this.attemptReconnect();
-            };
-
-            this.socket.onerror = (error) => {
-                console.error('WebSocket error:', error);
-                this.notifySubscribers({
-                    type: 'connection_error',
-                    message: 'Connection error occurred'
-                });
-            };
-        } catch (error) {
-            console.error('Error creating WebSocket:', error);
-            this.attemptReconnect();
-        }
-    }
-
-    disconnect() {
-        if (this.socket) {
-            this.socket.close();
-            this.socket = null;
-        }
-        if (this.reconnectTimeout) {
-            clearTimeout(this.reconnectTimeout);
-            this.reconnectTimeout = null;
-        }
-    }
-
-    attemptReconnect() {
-        if (this.reconnectAttempts < this.maxReconnectAttempts) {
-            this.reconnectAttempts++;
-            console.log(`Attempting to reconnect (${this.reconnectAttempts}/${this.maxReconnectAttempts})`);
-            this.reconnectTimeout = setTimeout(() => {
-                this.connect();
-            }, Math.min(1000 * Math.pow(2, this.reconnectAttempts), 30000));
-        } else {
-            console.log('Max reconnection attempts reached');
-            this.notifySubscribers({
-                type: 'connection_error',
-                message: 'Unable to establish connection'
-            });
-        }
-    }
-
-    subscribe(callback) {
-        this.subscribers.add(callback);
-        return () => {
-            this.subscribers.delete(callback);
-        };
-    }
-
-    notifySubscribers(data) {
-        this.subscribers.forEach(callback => {
-            try {
-                callback(data);
-            } catch (error) {
-                console.error('Error in subscriber callback:', error);
-            }
-        });
-    }
-
-    sendMessage(message) {
-        if (this.socket?.readyState === WebSocket.OPEN) {
-            this.socket.send(JSON.stringify(message));
-        } else {
-            console.error('WebSocket is not connected');
-            this.attemptReconnect();
-        }
-    }
-}
-
 const webSocketManager = new WebSocketManager();
 export { webSocketManager };